@@ -0,0 +1,321 @@
+""" An in-process stand-in for docker.Client.
+
+FakeClient implements the parts of the docker-py 1.x API that dockergrader
+uses, sleeping for a configurable latency in each call instead of talking
+to a daemon. Containers "run" for LATENCIES["run"] seconds after they are
+started and then exit with status 0 (1 if their command is "false"),
+printing `output`. Latencies can be jittered with a seeded random number
+generator so that runs are reproducible. """
+import io
+import itertools
+import random
+import tarfile
+import threading
+import time
+
+# seconds per call
+LATENCIES = {
+    "create_container": 0.02,
+    "start": 0.05,
+    "stop": 0.05,
+    "remove_container": 0.03,
+    "create_network": 0.02,
+    "remove_network": 0.02,
+    "inspect": 0.002,
+    "exec_create": 0.005,
+    "exec_start": 0.02,
+    "put_archive": 0.01,
+    "get_archive": 0.01,
+    "build": 0.5,
+    "tag": 0.005,
+    "logs": 0.005,
+    "run": 0.5,
+}
+
+
+class FakeContainer:
+
+    def __init__(self, id, image, command, name, labels=None, network=None):
+        self.id = id
+        self.image = image
+        self.command = command
+        self.name = name
+        self.labels = labels or {}
+        self.network = network
+        self.started = None
+        self.finish = None
+        self.stopped = None
+        self.exit_code = 1 if command in ("false", ["false"]) else 0
+        self.archive = b''
+
+    def running(self, now=None):
+        now = now or time.time()
+        return self.started is not None and self.stopped is None and \
+            now < self.finish
+
+    def end(self):
+        if self.stopped is not None:
+            return min(self.stopped, self.finish)
+        return self.finish
+
+
+class FakeClient:
+
+    def __init__(self, latencies=None, jitter=0, seed=0,
+                 output=b"Test t1 Passed\n"):
+        self.latencies = dict(LATENCIES, **(latencies or {}))
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.output = output
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self._containers = {}
+        self._networks = {}
+        self.images = {}
+        self.calls = {}
+
+    def _latency(self, op):
+        with self.lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+            latency = self.latencies.get(op, 0)
+            if self.jitter:
+                latency *= 1 + self.random.uniform(-self.jitter, self.jitter)
+        return max(0, latency)
+
+    def _call(self, op):
+        time.sleep(self._latency(op))
+
+    def _new_id(self):
+        return "{:064x}".format(next(self.ids))
+
+    def _container(self, container):
+        if isinstance(container, dict):
+            container = container["Id"]
+        return self._containers[container]
+
+    # configuration helpers
+
+    def create_host_config(self, **kwargs):
+        return kwargs
+
+    def create_networking_config(self, endpoints=None):
+        return {"EndpointsConfig": endpoints}
+
+    def create_endpoint_config(self, **kwargs):
+        return kwargs
+
+    # networks
+
+    def create_network(self, name, internal=False, labels=None, **kwargs):
+        self._call("create_network")
+        network = {"Id": self._new_id(), "Name": name, "Internal": internal,
+                   "Labels": labels or {}}
+        with self.lock:
+            self._networks[network["Id"]] = network
+        return {"Id": network["Id"], "Warning": ""}
+
+    def remove_network(self, net_id):
+        self._call("remove_network")
+        with self.lock:
+            self._networks.pop(net_id)
+
+    def networks(self, names=None, ids=None):
+        with self.lock:
+            # like the daemon, names match by substring
+            return [dict(n) for n in self._networks.values()
+                    if (names is None or any(name in n["Name"]
+                                             for name in names)) and
+                    (ids is None or n["Id"] in ids)]
+
+    def inspect_network(self, net_id):
+        self._call("inspect")
+        with self.lock:
+            network = dict(self._networks[net_id])
+            network["Containers"] = {
+                c.id: {"Name": c.name} for c in self._containers.values()
+                if c.network == network["Name"]}
+        return network
+
+    # containers
+
+    def create_container(self, image, command=None, name=None, labels=None,
+                         networking_config=None, **kwargs):
+        self._call("create_container")
+        network = None
+        if networking_config and networking_config["EndpointsConfig"]:
+            network = next(iter(networking_config["EndpointsConfig"]))
+        container = FakeContainer(self._new_id(), image, command, name,
+                                  labels, network)
+        with self.lock:
+            self._containers[container.id] = container
+        return {"Id": container.id, "Warnings": None}
+
+    def start(self, container, **kwargs):
+        self._call("start")
+        c = self._container(container)
+        c.started = time.time()
+        c.finish = c.started + self._latency("run")
+
+    def wait(self, container, timeout=None):
+        c = self._container(container)
+        remaining = c.end() - time.time()
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            from requests.exceptions import ReadTimeout
+            raise ReadTimeout("wait timed out")
+        time.sleep(max(0, remaining))
+        return c.exit_code
+
+    def stop(self, container, timeout=10):
+        self._call("stop")
+        c = self._container(container)
+        if c.running():
+            c.stopped = time.time()
+            c.exit_code = 137
+
+    def kill(self, container, signal=None):
+        self.stop(container)
+
+    def remove_container(self, container, force=False, **kwargs):
+        self._call("remove_container")
+        if isinstance(container, dict):
+            container = container["Id"]
+        with self.lock:
+            if self._containers.pop(container, None) is None:
+                from docker.errors import NotFound
+                raise NotFound("No such container: {}".format(container),
+                               None)
+
+    def inspect_container(self, container):
+        self._call("inspect")
+        c = self._container(container)
+        return {"Id": c.id, "Name": "/{}".format(c.name),
+                "State": {"Running": c.running(), "ExitCode": c.exit_code}}
+
+    def containers(self, all=False, quiet=False, filters=None):
+        label = (filters or {}).get("label")
+        with self.lock:
+            containers = [c for c in self._containers.values()
+                          if (all or c.running()) and
+                          (label is None or label in c.labels)]
+        if quiet:
+            return [{"Id": c.id} for c in containers]
+        return [{"Id": c.id, "Names": ["/{}".format(c.name)],
+                 "Image": c.image, "Labels": dict(c.labels)}
+                for c in containers]
+
+    def logs(self, container, stdout=True, stderr=True, stream=False,
+             follow=False, **kwargs):
+        self._call("logs")
+        c = self._container(container)
+        output = self.output if stdout else b''
+        if not stream:
+            return output
+
+        def chunks():
+            if follow:
+                time.sleep(max(0, c.end() - time.time()))
+            if output:
+                yield output
+        return chunks()
+
+    def stats(self, container, decode=None, stream=True):
+        c = self._container(container)
+
+        def samples():
+            usage = 0
+            while True:
+                usage += 10**8
+                yield {"cpu_stats": {"cpu_usage": {"total_usage": usage}},
+                       "memory_stats": {"usage": 2**24, "max_usage": 2**25}}
+                if not c.running():
+                    return
+                time.sleep(min(1, max(0, c.end() - time.time())))
+        return samples()
+
+    def events(self, since=None, until=None, filters=None, decode=None):
+        """ Yields a "die" event for each started container once it ends
+        (only "die" events are generated) """
+        key, _, value = (filters or {}).get("label", "").partition('=')
+        reported = set()
+        while True:
+            now = time.time()
+            with self.lock:
+                ended = [c for c in self._containers.values()
+                         if c.started is not None and c.id not in reported and
+                         c.end() <= now and
+                         (not key or c.labels.get(key) == value)]
+            for c in ended:
+                reported.add(c.id)
+                yield {"status": "die", "id": c.id,
+                       "Actor": {"ID": c.id, "Attributes": {
+                           "exitCode": str(c.exit_code)}}}
+            time.sleep(0.01)
+
+    # exec and archives (pooled compile containers)
+
+    def exec_create(self, container, cmd, **kwargs):
+        self._call("exec_create")
+        return {"Id": self._new_id()}
+
+    def exec_start(self, exec_id, **kwargs):
+        self._call("exec_start")
+        return b''
+
+    def exec_inspect(self, exec_id):
+        self._call("inspect")
+        return {"ExitCode": 0}
+
+    def put_archive(self, container, path, data):
+        self._call("put_archive")
+        if not isinstance(data, bytes):
+            data = b''.join(data)
+        self._container(container).archive = data
+        return True
+
+    def get_archive(self, container, path):
+        self._call("get_archive")
+        data = self._container(container).archive
+        if not data:
+            buf = io.BytesIO()
+            tarfile.open(fileobj=buf, mode='w').close()
+            data = buf.getvalue()
+        return iter([data]), {"name": path}
+
+    # images
+
+    def build(self, fileobj=None, tag=None, path=None, **kwargs):
+        if fileobj is not None:
+            for _ in fileobj:
+                pass
+        self._call("build")
+        image = self._new_id()[-12:]
+        with self.lock:
+            self.images[image] = tag
+        return iter([
+            b'{"stream": "Step 1 : FROM ubuntu\\n"}\r\n',
+            '{{"stream": "Successfully built {}\\n"}}\r\n'.format(
+                image).encode()])
+
+    def tag(self, image, repository, tag=None, force=False):
+        self._call("tag")
+        return True
+
+    def inspect_image(self, image):
+        self._call("inspect")
+        return {"Id": image, "Config": {"Cmd": ["make"], "Entrypoint": None,
+                                        "WorkingDir": "/compile"}}
+
+
+def install(client):
+    """ Makes `client` the docker client used by dockergrader. docker-py
+    must be installed, but no daemon is needed. """
+    import docker
+    real = docker.Client
+    docker.Client = lambda *args, **kwargs: client
+    try:
+        from dockergrader import config
+    finally:
+        docker.Client = real
+    config.docker = client
+    return client
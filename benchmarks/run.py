@@ -0,0 +1,304 @@
+""" Benchmarks for the grading pipeline, run against a fake docker client
+(benchmarks.fake_docker) and synthetic submission trees
+(benchmarks.svn_tree), so that they need no daemon and give repeatable
+numbers. From the top of the repository:
+
+    python -m benchmarks.run                # all benchmarks
+    python -m benchmarks.run scan watch --teams 5000
+    python -m benchmarks.run --json before.json
+
+  queue    GradingQueue / FairShareQueue operations per second
+  scan     scan_dir cost for a cold, an unchanged and an incremental scan
+  compile  compile() throughput for each staging mode and the compile pool
+  run      RunTest jobs per second with concurrent graders
+  watch    the watch.py loop end to end: jobs/sec and queue-to-start latency
+
+compile and run need docker-py installed (for its imports only); watch
+--no-docker grades with a script that only sleeps.
+"""
+from pathlib import Path
+from datetime import datetime
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from benchmarks import svn_tree
+from benchmarks.fake_docker import FakeClient, install
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+def timed(f, *args, **kwargs):
+    start = time.perf_counter()
+    result = f(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_queue(args):
+    from dockergrader.watch import GradingQueue, FairShareQueue, QueueEntry, \
+        Source
+    rng = random.Random(args.seed)
+    n = args.teams
+    queue = GradingQueue()
+    entries = [QueueEntry(rng.randint(0, 10), rng.random(), 1,
+                          svn_tree.team_name(i), [], None)
+               for i in range(n)]
+    push, _ = timed(lambda: [queue.push(qe) for qe in entries])
+    updates = rng.sample(entries, n // 10)
+    update, _ = timed(lambda: [queue.push(QueueEntry(
+        qe.attempts, qe.time, 2, qe.name, ["t1"], None)) for qe in updates])
+    sort, _ = timed(lambda: list(queue.sorted()))
+    pop, _ = timed(lambda: [queue.pop() for _ in range(n)])
+
+    fair = FairShareQueue()
+    for s in range(4):
+        source = Source("src{}".format(s), "svn", "*/mp/VERSION", None,
+                        weight=s + 1)
+        for i in range(n // 4):
+            source.queue.push(QueueEntry(0, i, 1, svn_tree.team_name(i), [],
+                                         None, source))
+        fair.add_source(source)
+    fair_sort, _ = timed(lambda: list(fair.sorted()))
+    fair_pop, _ = timed(lambda: [fair.pop() for _ in range(len(fair))])
+    return {"entries": n,
+            "push_per_sec": n / push,
+            "update_per_sec": len(updates) / update,
+            "sorted_sec": sort,
+            "pop_per_sec": n / pop,
+            "fair_sorted_sec": fair_sort,
+            "fair_pop_per_sec": n // 4 * 4 / fair_pop}
+
+
+def _source(watch, root, name="bench", script="run_tests.py"):
+    source = watch.Source(name, root / "svn", "*/mp1/VERSION",
+                          str(root / "attempts-{}.jsonl".format(name)),
+                          script=script)
+    source.open()
+    return source
+
+
+def bench_scan(args):
+    import dockergrader.watch as watch
+    dump_queue, watch.dump_queue = watch.dump_queue, lambda: None
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            versions = svn_tree.generate(root / "svn", args.teams,
+                                         seed=args.seed)
+            source = _source(watch, root)
+            cold, _ = timed(watch.scan_dir, source)
+            queued = len(source.queue)
+            warm, _ = timed(watch.scan_dir, source)
+            changed = svn_tree.bump(versions, args.changed, seed=args.seed)
+            paths = watch.parse_svn_update("".join(
+                "U    {}\n".format(p) for p in changed).encode())
+            incremental, _ = timed(watch.scan_dir, source, paths)
+            source.attempts.close()
+    finally:
+        watch.dump_queue = dump_queue
+    return {"teams": args.teams,
+            "queued": queued,
+            "cold_scan_sec": cold,
+            "unchanged_scan_sec": warm,
+            "incremental_scan_sec": incremental,
+            "incremental_changed": len(changed),
+            "unchanged_us_per_team": warm / args.teams * 1e6}
+
+
+def _concurrently(jobs, threads, f):
+    """ Runs f(i) for i in range(jobs) on `threads` threads; returns
+    jobs/sec """
+    counter = iter(range(jobs))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            f(i)
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return jobs / (time.perf_counter() - start)
+
+
+def bench_compile(args):
+    install(FakeClient(_latencies(args), jitter=args.jitter, seed=args.seed))
+    from dockergrader import compile as compile_module
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        svn_tree.generate(root / "svn", args.jobs, seed=args.seed)
+        srcs = sorted(str(p) for p in (root / "svn").glob("*/mp1"))
+        for mode in ["copy", "reflink", "pool"]:
+            dst = root / mode
+            pool = compile_module.CompilePool("bench") if mode == "pool" \
+                else None
+
+            def job(i):
+                out = str(dst / str(i))
+                compile_module.compile(srcs[i], out, "mp1", pool=pool,
+                                       staging="copy" if pool else mode)
+            results[mode + "_jobs_per_sec"] = _concurrently(
+                len(srcs), args.concurrency, job)
+            if pool:
+                pool.close()
+    return results
+
+
+def bench_run(args):
+    client = install(FakeClient(_latencies(args), jitter=args.jitter,
+                                seed=args.seed))
+    from dockergrader.run_tests import RunTest
+    from dockergrader.trace import TRACER
+    TRACER.enable()
+
+    def job(i):
+        run_test = RunTest("bench{}".format(i))
+        run_test.create_network()
+        run_test.add_command("server", "./server")
+        run_test.add_command("client", "./client")
+        run_test.run_commands(timeout=60, delay=client.latencies["start"])
+        run_test.logs("bench{}-1".format(i))
+        run_test.cleanup()
+    rate = _concurrently(args.jobs, args.concurrency, job)
+    return {"jobs": args.jobs, "concurrency": args.concurrency,
+            "jobs_per_sec": rate,
+            "phases": {name: {"p50": s["p50"], "p99": s["p99"]}
+                       for name, s in TRACER.summary().items()}}
+
+
+def bench_watch(args):
+    import dockergrader.watch as watch
+    from dockergrader.scheduler import ResourceScheduler
+    from dockergrader.trace import TRACER
+    TRACER.enable()
+    env = {"BENCH_LATENCIES": json.dumps(_latencies(args)),
+           "PYTHONPATH": os.pathsep.join(
+               filter(None, [str(REPO), os.environ.get("PYTHONPATH")]))}
+    if args.no_docker:
+        env["BENCH_NO_DOCKER"] = "1"
+    os.environ.update(env)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        os.chdir(tmp)
+        try:
+            svn_tree.generate(root / "svn", args.jobs, seed=args.seed)
+            source = _source(watch, root,
+                             script=str(REPO / "benchmarks" /
+                                        "grade_script.py"))
+            watch.SOURCES = [source]
+            watch.QUEUE.add_source(source)
+            watch.SCHEDULER = ResourceScheduler(
+                cpus=args.concurrency, mem=args.concurrency * 2**31,
+                max_jobs=args.concurrency, load=lambda: 0,
+                available_memory=lambda: args.concurrency * 2**31)
+            start = time.perf_counter()
+            with watch.STATE_LOCK:
+                scan, _ = timed(watch.scan_dir, source)
+            while len(source.attempts) < args.jobs:
+                watch.WAKEUP.wait(1)
+                watch.WAKEUP.clear()
+                with watch.STATE_LOCK:
+                    watch.grade_one()
+                watch.flush_status()
+            elapsed = time.perf_counter() - start
+            for g in watch.GRADERS:
+                g.join()
+            source.attempts.close()
+        finally:
+            os.chdir(cwd)
+    summary = TRACER.summary()
+    wait = summary["queue.wait"]
+    return {"jobs": args.jobs, "concurrency": args.concurrency,
+            "jobs_per_sec": args.jobs / elapsed,
+            "scan_sec": scan,
+            "queue_to_start_p50": wait["p50"],
+            "queue_to_start_p99": wait["p99"],
+            "grade_p50": summary["grade"]["p50"],
+            "status_writes": watch.STATUS.writes}
+
+
+BENCHMARKS = {
+    "queue": bench_queue,
+    "scan": bench_scan,
+    "compile": bench_compile,
+    "run": bench_run,
+    "watch": bench_watch,
+}
+
+
+def _latencies(args):
+    latencies = {}
+    if args.run_time is not None:
+        latencies["run"] = args.run_time
+    return {op: latency * args.latency_scale
+            for op, latency in dict(FakeClient().latencies,
+                                    **latencies).items()}
+
+
+def report(name, result, indent=2):
+    print("{}:".format(name))
+    for key, value in result.items():
+        if isinstance(value, dict):
+            print("{}{}:".format(' ' * indent, key))
+            for k, v in value.items():
+                if isinstance(v, dict):
+                    v = ' '.join("{} {:.4f}".format(*i) for i in v.items())
+                print("{}{:<28} {}".format(' ' * (indent + 2), k, v))
+        elif isinstance(value, float):
+            print("{}{:<30} {:.4f}".format(' ' * indent, key, value))
+        else:
+            print("{}{:<30} {}".format(' ' * indent, key, value))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the grading pipeline against a fake docker")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="one of {} (default: all)".format(
+                            ', '.join(sorted(BENCHMARKS))))
+    parser.add_argument("--teams", type=int, default=2000,
+                        help="teams for the queue and scan benchmarks")
+    parser.add_argument("--changed", type=float, default=0.05,
+                        help="fraction of teams changed for the incremental "
+                        "scan")
+    parser.add_argument("--jobs", type=int, default=50,
+                        help="jobs for the compile, run and watch benchmarks")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="multiplies all fake docker latencies")
+    parser.add_argument("--run-time", type=float, default=None,
+                        help="seconds each fake container runs")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="relative random jitter on latencies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-docker", action="store_true",
+                        help="watch: grade with a script that only sleeps")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark {}".format(name))
+    results = {"time": datetime.now().isoformat(), "args": vars(args)}
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        results[name] = BENCHMARKS[name](args)
+        report(name, results[name])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+""" Synthetic submission trees shaped like the course's svn checkout:
+svn/<team>/<mp>/VERSION plus a few source files per team. """
+from pathlib import Path
+import random
+
+SOURCE_FILES = {
+    "Makefile": "all:\n\tgcc -o server server.c\n",
+    "server.c": "int main() { return 0; }\n" * 40,
+    "client.c": "int main() { return 0; }\n" * 40,
+}
+
+
+def team_name(i):
+    return "team{:05d}".format(i)
+
+
+def generate(root, teams, mp="mp1", max_version=3, seed=0,
+             with_svn_dirs=True):
+    """ Creates `teams` submissions under `root` with random versions up to
+    `max_version`; returns the paths of the VERSION files """
+    rng = random.Random(seed)
+    root = Path(root)
+    versions = []
+    for i in range(teams):
+        parent = root / team_name(i) / mp
+        parent.mkdir(parents=True, exist_ok=True)
+        if with_svn_dirs:
+            (root / team_name(i) / ".svn").mkdir(exist_ok=True)
+        for name, content in SOURCE_FILES.items():
+            (parent / name).write_text(content)
+        version = parent / "VERSION"
+        version.write_text("{}\n".format(rng.randint(1, max_version)))
+        versions.append(version)
+    return versions
+
+
+def bump(version_files, fraction, seed=0, tests=()):
+    """ Submits a new version for `fraction` of the teams, as svn update
+    would; returns the VERSION files that changed """
+    rng = random.Random(seed)
+    changed = rng.sample(list(version_files),
+                         int(len(version_files) * fraction))
+    for path in changed:
+        version = int(path.read_text().split()[0]) + 1
+        path.write_text(' '.join([str(version)] + list(tests)) + '\n')
+    return changed
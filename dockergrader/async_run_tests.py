@@ -0,0 +1,210 @@
+""" An asyncio version of RunTest, so that one event loop can drive the
+containers of many test cases at once.
+
+docker-py is blocking, so individual API calls run on a shared thread pool.
+Waiting for containers does not tie up a thread per container: a single
+thread follows docker's "die" events for this process's containers and
+wakes up the coroutines waiting for them, which also re-check now and then
+in case an event is missed. """
+from . import config
+from .run_tests import RunTest, OWNER_LABEL, OWNER
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import logging
+import threading
+import time
+
+MAX_API_THREADS = 32
+# how often a waiting container is checked without an event, in seconds
+FALLBACK_POLL = 5
+
+_executor = None
+
+
+def _default_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=MAX_API_THREADS)
+    return _executor
+
+
+def _set_result(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ExitEvents:
+    """ Follows the "die" events of the containers this process created and
+    resolves the futures of the coroutines waiting for them """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = defaultdict(list)   # container id -> [(loop, future)]
+        self.thread = None
+
+    def exited(self, container_id):
+        """ Returns a future that is resolved when `container_id` exits. It
+        may be resolved late or never if an event is lost. """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.lock:
+            self.waiters[container_id].append((loop, future))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._follow,
+                                               daemon=True)
+                self.thread.start()
+        return future
+
+    def forget(self, container_id, future):
+        """ Drops the waiter for `future`, which is no longer needed """
+        with self.lock:
+            waiters = self.waiters.get(container_id, [])
+            waiters[:] = [w for w in waiters if w[1] is not future]
+            if not waiters:
+                self.waiters.pop(container_id, None)
+
+    def _follow(self):
+        try:
+            events = config.docker.events(
+                decode=True, filters={"event": "die", "label": "{}={}".format(
+                    OWNER_LABEL, OWNER)})
+            for event in events:
+                with self.lock:
+                    waiters = self.waiters.pop(event.get("id"), [])
+                for loop, future in waiters:
+                    try:
+                        loop.call_soon_threadsafe(_set_result, future)
+                    except RuntimeError:
+                        pass    # the loop is closed
+        except Exception:
+            logging.warning("Lost the docker event stream", exc_info=True)
+        finally:
+            with self.lock:
+                self.thread = None
+
+
+EXIT_EVENTS = ExitEvents()
+
+
+class AsyncRunTest:
+    """ Same interface as RunTest, with coroutines instead of blocking
+    methods. Can be used as an async context manager, which always cleans
+    up, after any API calls still in flight have finished. """
+
+    def __init__(self, testcase_name, executor=None, **kwargs):
+        self.run_test = RunTest(testcase_name, **kwargs)
+        self.executor = executor or _default_executor()
+        self.pending = set()
+
+    @property
+    def testcase_name(self):
+        return self.run_test.testcase_name
+
+    @property
+    def containers(self):
+        return self.run_test.containers
+
+    def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.executor,
+                                      functools.partial(fn, *args, **kwargs))
+        # tracked so that cleanup can wait for e.g. a create_container
+        # whose caller was cancelled
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+
+    async def create_network(self, internal=False):
+        await self._call(self.run_test.create_network, internal=internal)
+
+    async def add_command(self, *args, **kwargs):
+        await self._call(self.run_test.add_command, *args, **kwargs)
+
+    async def _state(self, name):
+        info = await self._call(config.docker.inspect_container,
+                                self.containers[name]["Id"])
+        return info["State"]
+
+    async def wait_ready(self, name, timeout, interval=0.2):
+        deadline = time.time() + timeout
+        while True:
+            ready = await self._call(self.run_test.check_ready, name)
+            if ready is not None:
+                return ready
+            if time.time() + interval > deadline:
+                logging.info("Container %s not ready after %ss", name, timeout)
+                return False
+            await asyncio.sleep(interval)
+
+    async def _wait(self, name, timeout):
+        container = self.containers[name]
+        deadline = timeout and time.time() + timeout
+        exited = EXIT_EVENTS.exited(container["Id"])
+        try:
+            while True:
+                state = await self._state(name)
+                if not state["Running"]:
+                    container["StatusCode"] = state["ExitCode"]
+                    break
+                remaining = FALLBACK_POLL
+                if deadline:
+                    remaining = min(remaining, deadline - time.time())
+                    if remaining <= 0:
+                        logging.info("Timeout waiting for container %s",
+                                     container["Id"])
+                        container["StatusCode"] = -1
+                        await self._call(config.docker.stop, container["Id"])
+                        break
+                try:
+                    await asyncio.wait_for(asyncio.shield(exited), remaining)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # the container may have exited without an event for it
+            EXIT_EVENTS.forget(container["Id"], exited)
+        if self.run_test.fail_fast and container["StatusCode"] != 0:
+            await self._call(self.run_test.check_exit, name)
+
+    async def run_commands(self, timeout=None, nowait=[], delay=10):
+        """ See RunTest.run_commands """
+        steps = self.run_test.start_steps(nowait)
+        while True:
+            # starting a container is a blocking call
+            step = await self._call(next, steps, None)
+            if step is None:
+                break
+            kind, previous = step
+            if kind == "ready":
+                await self.wait_ready(previous, delay)
+            else:
+                await asyncio.sleep(delay)
+
+        await asyncio.gather(*[self._wait(name, timeout)
+                               for name in self.run_test.waited(nowait)])
+        return await self._call(self.run_test.finish, nowait)
+
+    async def logs(self, name, stdout=True, stderr=True):
+        return await self._call(self.run_test.logs, name, stdout, stderr)
+
+    async def cleanup(self):
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+        await self._call(self.run_test.cleanup)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        # finish cleaning up even if we are being cancelled
+        await asyncio.shield(self.cleanup())
+
+
+async def run_testcase(testcase_name, body, timeout=None, executor=None,
+                       **kwargs):
+    """ Runs the coroutine function `body` with a fresh AsyncRunTest and
+    returns its result. If `timeout` passes or the task is cancelled, `body`
+    is cancelled; the test's containers and network are always removed. """
+    async with AsyncRunTest(testcase_name, executor, **kwargs) as test:
+        return await asyncio.wait_for(body(test), timeout)
@@ -0,0 +1,101 @@
+""" Append-only store of graded attempts.
+
+Every graded attempt is appended to a log file as one JSON line and fsynced,
+so recording an attempt costs one small write no matter how many attempts
+have been recorded. The log is read back into a per-team index on startup.
+A partially written last line (from a crash mid-append) is truncated; other
+damaged lines are skipped and logged, and left in place. """
+from collections import namedtuple, defaultdict
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+Attempt = namedtuple('Attempt', ['team', 'version', 'time', 'result'])
+
+
+class AttemptsStore:
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self.teams = defaultdict(dict)  # team -> {version: Attempt}
+        self.lock = threading.Lock()
+        self._load()
+        self.file = open(path, 'a')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        good = 0
+        with open(self.path, 'rb') as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.endswith(b'\n'):
+                    # only the last line can be incomplete; it is removed so
+                    # that the next record starts on a line of its own
+                    log.warning("Discarding incomplete attempts record at "
+                                "line %d of %s", lineno, self.path)
+                    break
+                good += len(line)
+                try:
+                    record = json.loads(line.decode())
+                    attempt = Attempt(record["team"], record["version"],
+                                      record["time"], record.get("result"))
+                except (ValueError, KeyError, TypeError):
+                    log.warning("Skipping damaged attempts record at line %d "
+                                "of %s", lineno, self.path)
+                    continue
+                self._index(attempt)
+        if good != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(good)
+
+    def _index(self, attempt):
+        self.teams[attempt.team][attempt.version] = attempt
+
+    def add(self, team, version, result=None, time=None):
+        """ Records that `team`'s `version` was graded """
+        attempt = Attempt(team, version,
+                          time or datetime.now().isoformat(), result)
+        line = json.dumps(attempt._asdict()) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if self.sync:
+                os.fsync(self.file.fileno())
+            self._index(attempt)
+        return attempt
+
+    def has(self, team, version):
+        return version in self.teams.get(team, ())
+
+    def get(self, team, version):
+        return self.teams.get(team, {}).get(version)
+
+    def versions(self, team):
+        return set(self.teams.get(team, ()))
+
+    def attempts(self, team):
+        """ Number of distinct versions graded for `team` """
+        return len(self.teams.get(team, ()))
+
+    def history(self, team):
+        return sorted(self.teams.get(team, {}).values(),
+                      key=lambda a: (a.time, a.version))
+
+    def import_graded(self, graded):
+        """ Imports a {team: set of versions} mapping, as kept by older
+        versions of watch.py """
+        for team, versions in graded.items():
+            for version in sorted(versions):
+                if not self.has(team, version):
+                    self.add(team, version)
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return sum(len(v) for v in self.teams.values())
@@ -1,14 +1,23 @@
 from . import config
-import tarfile
-from tempfile import NamedTemporaryFile, TemporaryFile
+from .tarstream import tar_stream, walk
+from .trace import TRACER
 from pathlib import Path
 import re
 import logging
 import json
+import hashlib
+import codecs
+import os
+import stat
+import threading
+from collections import deque
+from itertools import chain
+from docker.errors import NotFound
 
 log = logging.getLogger(__name__)
 
 BUILD_SUCCESSFUL = re.compile(r'Successfully built ([0-9a-f]+)')
+FROM_LINE = re.compile(r'^\s*FROM\s+(\S+)', re.IGNORECASE | re.MULTILINE)
 
 
 class BuildError(Exception):
@@ -17,53 +26,252 @@ class BuildError(Exception):
         self.output = output
 
 
-def _parse_build_output(stream):
-    decstream = list(json.loads(l) for s in stream for l in
-                     s.decode().split('\n') if l)   # capture output
-    output = [x["stream"] for x in decstream if "stream" in x]
-    m = re.search(BUILD_SUCCESSFUL, output[-1])
-    if m:
-        image = m.group(1)
-        log.debug("Built image %s, output %s", m, output)
+BUILD_OUTPUT_TAIL = 50
+
+
+def _iter_build_output(stream):
+    """ Incrementally decodes the JSON records in a build stream. Records may
+    be split across chunks or several may share one chunk. """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buf = ''
+    for chunk in stream:
+        if isinstance(chunk, bytes):
+            chunk = utf8.decode(chunk)
+        buf += chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos == len(buf):
+                break
+            try:
+                record, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # incomplete record, wait for the next chunk
+                break
+            yield record
+        buf = buf[pos:]
+    if buf.strip():
+        log.warning("Trailing garbage in build output: %r", buf)
+
+
+def _parse_build_output(stream, progress=None, tail=BUILD_OUTPUT_TAIL):
+    """ Consumes a build stream and returns the built image ID. Only the last
+    `tail` lines of output are kept; they are passed to `BuildError` if the
+    build fails. `progress`, if given, is called with every output line as
+    it arrives. """
+    output = deque(maxlen=tail)
+    image = None
+    for record in _iter_build_output(stream):
+        if "error" in record:
+            log.error("Could not build image: %s; %s", record, list(output))
+            raise BuildError(record, list(output))
+        if "stream" in record:
+            line = record["stream"]
+            output.append(line)
+            if progress:
+                progress(line)
+            m = re.search(BUILD_SUCCESSFUL, line)
+            if m:
+                image = m.group(1)
+        elif "ID" in record.get("aux", {}):
+            image = record["aux"]["ID"]
+    if image is None:
+        log.error("Could not build image: %s", list(output))
+        raise BuildError(None, list(output))
+    log.debug("Built image %s, output %s", image, list(output))
+    return image
+
+
+def _context_paths(paths):
+    if not isinstance(paths, dict):
+        paths = {'': paths}
+    return paths
+
+
+def _context_entries(paths):
+    """ Walks the context directories and yields (arcname, path) pairs for
+    every entry that ends up in the build context, in sorted order """
+    for n, d in sorted(_context_paths(paths).items(), key=lambda x: str(x[0])):
+        for arcname, path in walk(d, n):
+            if arcname == Path("Dockerfile"):
+                # skip dockerfile
+                continue
+            yield arcname, path
+
+
+def base_image_ids(dockerfile_str, known=None):
+    """ Returns (name, image ID) for each FROM line of the Dockerfile. IDs
+    are taken from `known` ({name: image ID}) or looked up in the daemon;
+    images it does not have get an ID of None. """
+    ids = []
+    for name in FROM_LINE.findall(dockerfile_str):
+        image = (known or {}).get(name)
+        if image is None and name != "scratch":
+            try:
+                image = config.docker.inspect_image(name)["Id"]
+            except NotFound:
+                pass
+        ids.append((name, image))
+    return ids
+
+
+def context_digest(dockerfile_str, paths, bases=()):
+    """ Computes a digest over the Dockerfile, the IDs of its base images
+    (see base_image_ids) and the names, modes and contents of every file in
+    the context """
+    h = hashlib.sha256()
+    h.update(dockerfile_str.encode())
+    for name, image in bases:
+        h.update("\0FROM {} {}".format(name, image).encode())
+    for arcname, path in _context_entries(paths):
+        st = path.lstat()
+        h.update("\0{}\0{:o}\0".format(arcname, st.st_mode).encode())
+        if stat.S_ISLNK(st.st_mode):
+            h.update(os.readlink(str(path)).encode())
+        elif stat.S_ISREG(st.st_mode):
+            with path.open('rb') as f:
+                for chunk in iter(lambda: f.read(1 << 16), b''):
+                    h.update(chunk)
+    return h.hexdigest()
+
+
+def _context_stream(dockerfile_str, paths, reproducible=False):
+    """ Generates the tar build context on the fly, without staging it or the
+    Dockerfile on disk """
+    dockerfile = [(Path("Dockerfile"), dockerfile_str.encode())]
+    return tar_stream(chain(dockerfile, _context_entries(paths)),
+                      reproducible=reproducible)
+
+
+class BuildCache:
+    """ Maps context digests to image IDs so that unchanged images are not
+    rebuilt. If `path` is given, the cache is persisted there as JSON. """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+    def get(self, digest):
+        """ Returns the cached image for `digest` if it still exists,
+        dropping the entry otherwise """
+        with self.lock:
+            image = self.entries.get(digest)
+        if image is not None and not _image_exists(image):
+            log.info("Cached image %s was removed, evicting", image)
+            with self.lock:
+                self.entries.pop(digest, None)
+                self._save()
+            image = None
+        with self.lock:
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
         return image
-    else:
-        error = [x for x in decstream if "error" in x]
-        if len(error) == 1:
-            error = error[0]
-        log.error("Could not build image: %s; %s", error, output)
-        raise BuildError(error, output)
 
+    def put(self, digest, image):
+        with self.lock:
+            self.entries[digest] = image
+            self._save()
+
+    def evict(self):
+        """ Drops all entries whose images no longer exist; returns the
+        number of evicted entries """
+        with self.lock:
+            entries = list(self.entries.items())
+        stale = [d for d, image in entries if not _image_exists(image)]
+        with self.lock:
+            for d in stale:
+                self.entries.pop(d, None)
+            if stale:
+                self._save()
+        return len(stale)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "BuildCache({} entries, {} hits, {} misses)".format(
+            len(self.entries), self.hits, self.misses)
+
+
+def _image_exists(image):
+    try:
+        config.docker.inspect_image(image)
+    except NotFound:
+        return False
+    return True
 
-def build_custom_image(dockerfile_str, paths, tag=None):
+
+def _tag_image(image, tag):
+    repository, _, tagname = tag.rpartition(':')
+    if not repository or '/' in tagname:
+        repository, tagname = tag, None
+    config.docker.tag(image, repository, tag=tagname, force=True)
+
+
+def build_cached(dockerfile_str, paths, cache, tag=None, progress=None,
+                 reproducible=False, base_images=None):
+    """ Like build_custom_image, but looks the context up in `cache` first.
+    The cache key includes the IDs of the base images, so a rebuilt base
+    invalidates its dependents; `base_images` ({name: image ID}) gives the
+    IDs of bases built just before. Returns a tuple (image, cached) """
+    with TRACER.span("build.digest", tag=tag):
+        digest = context_digest(dockerfile_str, paths,
+                                base_image_ids(dockerfile_str, base_images))
+    image = cache.get(digest)
+    if image is not None:
+        log.debug("Build cache hit for %s: %s", tag, image)
+        if tag:
+            _tag_image(image, tag)
+        return image, True
+    image = build_custom_image(dockerfile_str, paths, tag=tag,
+                               progress=progress, reproducible=reproducible)
+    cache.put(digest, image)
+    return image, False
+
+
+def build_custom_image(dockerfile_str, paths, tag=None, cache=None,
+                       progress=None, reproducible=False):
     """ Specifies a dockerfile as a string, and a path to create a custom
-    context """
-    with TemporaryFile() as context_file:
-        tar = tarfile.open(fileobj=context_file, mode='w')
-        with NamedTemporaryFile('w') as dockerfile:
-            dockerfile.write(dockerfile_str)
-            dockerfile.flush()
-            tar.add(dockerfile.name, arcname="Dockerfile")
-        if not isinstance(paths, dict):
-            paths = {'': paths}
-        for n, d in paths.items():
-            arcname = Path(n)
-            path = Path(d)
-            for name in path.glob("*"):
-                if arcname / name.relative_to(path) == Path("Dockerfile"):
-                    # skip dockerfile
-                    continue
-                tar.add(str(name), arcname=str(arcname /
-                                               name.relative_to(path)))
-        tar.close()
-        context_file.seek(0)
-        stream = config.docker.build(fileobj=context_file, custom_context=True,
-                                     rm=True, tag=tag)
+    context. If a `BuildCache` is given, an unchanged context reuses the
+    previously built image instead of contacting the daemon. `progress` is
+    called with each line of build output.
 
-        return _parse_build_output(stream)
+    The context tar is streamed to the daemon as it is generated. Pass
+    `reproducible=True` to get byte-identical contexts for identical inputs,
+    so the daemon's layer cache is hit. """
+    if cache is not None:
+        return build_cached(dockerfile_str, paths, cache, tag=tag,
+                            progress=progress,
+                            reproducible=reproducible)[0]
+    with TRACER.span("build", tag=tag):
+        context = _context_stream(dockerfile_str, paths,
+                                  reproducible=reproducible)
+        stream = config.docker.build(fileobj=context, custom_context=True,
+                                     rm=True, tag=tag)
+        return _parse_build_output(stream, progress)
 
 
-def build_image(path, tag=None):
+def build_image(path, tag=None, progress=None):
     """ Builds an image for a path. This is just a simple wrapper around
     docker.Client.build, with output parsing added on """
-    stream = config.docker.build(path=path, tag=tag, rm=True)
-    return _parse_build_output(stream)
+    with TRACER.span("build", tag=tag):
+        stream = config.docker.build(path=path, tag=tag, rm=True)
+        return _parse_build_output(stream, progress)
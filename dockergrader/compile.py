@@ -1,24 +1,289 @@
 from . import config
-import shutil
+from .stage import stage, unstage
+from .tarstream import extract, tar_stream, walk
+from .trace import TRACER
 import os
 import logging
+import tarfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from requests.exceptions import ReadTimeout
+from docker.errors import APIError
 
-def compile(src, dst, mp, timeout=config.TIMEOUT):
-    shutil.copytree(src, dst + "/compile")
+POOL_SIZE = 2
+POOL_MAX_SIZE = 4
+POOL_IDLE_TIMEOUT = 300
 
-    container = config.docker.create_container(image=config.container_name(mp,"compile"),
-        host_config=config.docker.create_host_config(binds={ os.path.abspath(dst + "/compile"): { 'bind': "/compile", 'mode': 'rw' }}))
-    if not container["Warnings"] is None:
-        logging.warning("Warning starting container: {}".format(container["Warnings"]))
-    config.docker.start(container["Id"])
+# keeps pooled containers alive; any CMD arguments end up in $1... and are
+# ignored
+KEEPALIVE = ["sh", "-c", "exec tail -f /dev/null", "keepalive"]
+# kills anything a build left running and empties /compile and /tmp, the
+# only writable places in a pooled container, so that it can be reused
+RESET = ["sh", "-c",
+         "kill -9 -1 2>/dev/null; "
+         "cd /compile && rm -rf ..?* .[!.]* * && cd /tmp && rm -rf ..?* .[!.]* *"]
+
+
+class _StreamReader:
+    """ File-like wrapper around an iterator of byte chunks """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buf) < size:
+            try:
+                self.buf += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buf)
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+
+class CompilePool:
+    """ A pool of pre-created, running compile containers for one image.
+    Submissions are copied into a ready container with put_archive, the
+    image's command is run with exec, and the results are copied back to
+    the destination directory. Containers are reset and reused afterwards,
+    or discarded if they are unhealthy or the pool is full.
+
+    Pooled containers run untrusted builds one after another, so their root
+    filesystem is read-only: builds can only write to /compile (a volume)
+    and /tmp (a tmpfs), which are emptied between submissions. """
+
+    def __init__(self, image, size=POOL_SIZE, max_size=POOL_MAX_SIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT, ignore=config.STAGING_IGNORE):
+        self.image = image
+        self.ignore = ignore
+        self.size = size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.idle = deque()     # (container id, time returned to pool)
+        self.lock = threading.Lock()
+        self._command = None
+        self.closed = False
+
+    @property
+    def command(self):
+        """ The image's own command, run from its working directory """
+        if self._command is None:
+            image_config = config.docker.inspect_image(self.image)["Config"]
+            cmd = (image_config.get("Entrypoint") or []) + \
+                (image_config.get("Cmd") or [])
+            workdir = image_config.get("WorkingDir") or "/"
+            self._command = ["sh", "-c", 'cd "$0" && exec "$@"', workdir] + cmd
+        return self._command
+
+    def _exec(self, container_id, cmd):
+        exec_id = config.docker.exec_create(container_id, cmd)["Id"]
+        output = config.docker.exec_start(exec_id)
+        return config.docker.exec_inspect(exec_id)["ExitCode"], output
+
+    def _create(self):
+        container = config.docker.create_container(
+            image=self.image, entrypoint=KEEPALIVE, volumes=["/compile"],
+            host_config=config.docker.create_host_config(
+                read_only=True, tmpfs={"/tmp": ""}))
+        if not container["Warnings"] is None:
+            logging.warning("Warning starting container: {}".format(
+                container["Warnings"]))
+        config.docker.start(container["Id"])
+        exit_code, output = self._exec(container["Id"], RESET)
+        if exit_code != 0:
+            self._discard(container["Id"])
+            raise RuntimeError("Could not prepare compile container: {}".format(
+                output))
+        logging.debug("Created pooled compile container %s", container["Id"])
+        return container["Id"]
+
+    def _discard(self, container_id):
+        try:
+            config.docker.remove_container(container_id, force=True, v=True)
+        except APIError:
+            logging.warning("Could not remove compile container %s",
+                            container_id)
+
+    def _healthy(self, container_id):
+        try:
+            state = config.docker.inspect_container(container_id)["State"]
+        except APIError:
+            return False
+        return state["Running"]
+
+    def reap(self):
+        """ Discards containers that have been idle for too long """
+        now = time.time()
+        with self.lock:
+            expired = [c for c, t in self.idle if now - t > self.idle_timeout]
+            self.idle = deque((c, t) for c, t in self.idle
+                              if now - t <= self.idle_timeout)
+        for c in expired:
+            logging.debug("Discarding idle compile container %s", c)
+            self._discard(c)
+
+    def fill(self):
+        """ Creates containers until `size` are ready """
+        while not self.closed:
+            with self.lock:
+                if len(self.idle) >= self.size:
+                    return
+            container_id = self._create()
+            with self.lock:
+                self.idle.append((container_id, time.time()))
+
+    def _fill_background(self):
+        def fill():
+            try:
+                self.fill()
+            except (APIError, RuntimeError):
+                logging.exception("Could not refill compile pool for %s",
+                                  self.image)
+        threading.Thread(target=fill, daemon=True).start()
+
+    def acquire(self):
+        self.reap()
+        container_id = None
+        while container_id is None:
+            with self.lock:
+                if not self.idle:
+                    break
+                container_id, _ = self.idle.popleft()
+            if not self._healthy(container_id):
+                logging.info("Discarding unhealthy compile container %s",
+                             container_id)
+                self._discard(container_id)
+                container_id = None
+        if container_id is None:
+            container_id = self._create()
+        self._fill_background()
+        return container_id
+
+    def release(self, container_id, reuse=True):
+        if reuse and not self.closed:
+            with self.lock:
+                reuse = len(self.idle) < self.max_size
+        if reuse and self._healthy(container_id):
+            exit_code, _ = self._exec(container_id, RESET)
+            if exit_code == 0:
+                with self.lock:
+                    self.idle.append((container_id, time.time()))
+                return
+        self._discard(container_id)
+
+    def compile(self, src, dst, timeout=config.TIMEOUT):
+        with TRACER.span("compile.acquire"):
+            container_id = self.acquire()
+        reuse = False
+        try:
+            with TRACER.span("compile.copy_in"):
+                config.docker.put_archive(container_id, "/compile",
+                                          tar_stream(walk(src,
+                                                          ignore=self.ignore)))
+            result = {}
+
+            def run():
+                result["exitCode"], result["output"] = self._exec(
+                    container_id, self.command)
+            runner = threading.Thread(target=run, daemon=True)
+            with TRACER.span("compile.exec"):
+                runner.start()
+                runner.join(timeout)
+            if runner.is_alive():
+                # discarding the container ends the exec
+                logging.warning("Timeout running compilation")
+                return False
+            logging.debug("Compile output: %s", result.get("output"))
+
+            os.makedirs(dst, exist_ok=True)
+            with TRACER.span("compile.copy_out"):
+                stream, _ = config.docker.get_archive(container_id,
+                                                      "/compile")
+                if not hasattr(stream, "read"):
+                    stream = _StreamReader(stream)
+                with tarfile.open(fileobj=stream, mode='r|') as tar:
+                    extract(tar, dst)
+            reuse = True
+            return result.get("exitCode") == 0
+        finally:
+            self.release(container_id, reuse)
+
+    def close(self):
+        self.closed = True
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for c, _ in idle:
+            self._discard(c)
+
+
+POOLS = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(mp, **kwargs):
+    """ Returns the shared compile pool for `mp`, creating it if needed """
+    image = config.container_name(mp, "compile")
+    with _pools_lock:
+        if image not in POOLS:
+            POOLS[image] = CompilePool(image, **kwargs)
+        return POOLS[image]
+
+
+def compile(src, dst, mp, timeout=config.TIMEOUT, pool=None,
+            staging=config.STAGING):
+    """ Compiles the submission in `src`, leaving the results in
+    `dst`/compile. If `pool` is a CompilePool (or True, for the shared pool
+    for `mp`), a warm container is used instead of creating a new one.
+    Otherwise the submission is staged using the `staging` mode (see
+    dockergrader.stage). With "overlay", `dst`/compile stays mounted for the
+    tests to use until it is unstaged: by leaving `compiled()`, by calling
+    stage.unstage(dst + "/compile"), or when the process exits. """
+    if pool is True:
+        pool = get_pool(mp)
+    with TRACER.span("compile", mp=mp, pooled=bool(pool)) as span:
+        if pool:
+            ok = pool.compile(src, dst, timeout)
+        else:
+            ok = _compile(src, dst, mp, timeout, staging)
+        span.set(ok=ok)
+        return ok
+
+
+def _compile(src, dst, mp, timeout, staging):
+    with TRACER.span("compile.stage", mode=staging):
+        stage(src, dst + "/compile", mode=staging,
+              ignore=config.STAGING_IGNORE)
+
+    with TRACER.span("compile.start"):
+        container = config.docker.create_container(image=config.container_name(mp,"compile"),
+            host_config=config.docker.create_host_config(binds={ os.path.abspath(dst + "/compile"): { 'bind': "/compile", 'mode': 'rw' }}))
+        if not container["Warnings"] is None:
+            logging.warning("Warning starting container: {}".format(container["Warnings"]))
+        config.docker.start(container["Id"])
     try:
-        exitCode = config.docker.wait(container["Id"], timeout=timeout)
+        with TRACER.span("compile.wait"):
+            exitCode = config.docker.wait(container["Id"], timeout=timeout)
     except ReadTimeout: # timeout
         logging.warning("Timeout running compilation")
+        # the container must not keep using the staged tree
+        config.docker.kill(container["Id"])
         return False
     return exitCode == 0
 
+
+@contextmanager
+def compiled(src, dst, mp, **kwargs):
+    """ Runs compile() and yields its result; on exit, the staged tree is
+    unmounted if it was staged with "overlay" """
+    try:
+        yield compile(src, dst, mp, **kwargs)
+    finally:
+        unstage(dst + "/compile")
+
 if __name__ == "__main__":
     import sys
     src,dst,mp = sys.argv[1:]
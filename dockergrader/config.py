@@ -2,6 +2,16 @@ import os
 TEST_DIR = os.path.expanduser("~/tests")
 TERM = "fa16"
 TIMEOUT = 60
+# how compile() stages submissions; see dockergrader.stage
+STAGING = "copy"
+STAGING_IGNORE = (".svn",)
+# maximum bytes of output kept per container
+LOG_LIMIT = 16 * 2**20
+BUILD_CACHE = os.path.expanduser("~/.dockergrader-build-cache.json")
+# test networks kept for reuse, of each kind (internal/external); leases are
+# flocks on files in NETWORK_LOCK_DIR
+NETWORK_POOL_SIZE = 8
+NETWORK_LOCK_DIR = "/tmp/dockergrader-networks"
 
 def container_name(mp,task,term=TERM):
 	return "csece438/{}-{}:{}".format(mp,task,term)
@@ -0,0 +1,292 @@
+""" Grading across several hosts.
+
+A coordinator (watch.py -d HOST:PORT) keeps the grading queue; workers on
+other hosts (python -m dockergrader.distributed HOST:PORT) pull jobs from it,
+grade them against their own docker daemon and stream the output back.
+
+The protocol is one JSON object per line over TCP. Each worker slot holds
+one connection, which starts with {"op": "auth", "token": ...}; the
+coordinator closes connections that do not present the shared token, which
+is read from $DOCKERGRADER_TOKEN or ~/.dockergrader-token on both sides.
+The coordinator listens on 127.0.0.1 unless a host is given.
+
+Once authenticated, the worker asks for jobs with {"op": "pull"}; the coordinator
+answers {"op": "job", "job": ...}, with a null job if there is nothing to
+do. Output is sent as {"op": "output", "id": ..., "data": <base64>} and the
+result as {"op": "done", "id": ..., "returncode": ...}. If the connection
+drops or stays silent for `lease_timeout` seconds while a job is out, the
+job is handed back to the queue. """
+from .tarstream import extract, tar_stream, walk
+from .results import ENV_FAIL_FAST
+from .trace import ENV_ID
+from pathlib import Path
+from subprocess import Popen, PIPE
+import base64
+import hmac
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import tarfile
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+LEASE_TIMEOUT = 60
+POLL_INTERVAL = 1
+# the worker sends at least this often while a job runs
+HEARTBEAT_INTERVAL = 10
+CHUNK_SIZE = 1 << 16
+ENV_TOKEN = "DOCKERGRADER_TOKEN"
+TOKEN_FILE = os.path.expanduser("~/.dockergrader-token")
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return host or "127.0.0.1", int(port)
+
+
+def load_token():
+    """ Returns the shared token that workers present to the coordinator """
+    token = os.environ.get(ENV_TOKEN)
+    if not token and os.path.exists(TOKEN_FILE):
+        with open(TOKEN_FILE) as f:
+            token = f.read().strip()
+    if not token:
+        raise ValueError("No worker token: set ${} or write one to {}".format(
+            ENV_TOKEN, TOKEN_FILE))
+    return token
+
+
+def _send(wfile, message):
+    wfile.write(json.dumps(message).encode() + b'\n')
+    wfile.flush()
+
+
+def pack_submission(path, ignore=(".svn",)):
+    """ Returns the submission in `path` as a base64-encoded tar """
+    return base64.b64encode(b''.join(tar_stream(walk(path, ignore=ignore)))
+                            ).decode()
+
+
+def unpack_submission(archive, path):
+    with tarfile.open(fileobj=io.BytesIO(base64.b64decode(archive))) as tar:
+        extract(tar, path)
+
+
+class Coordinator:
+    """ Serves jobs to remote workers. The callbacks are:
+
+    - take_job(): returns (job id, job) for the next job, or None
+    - job_output(job id, chunk): a chunk of output arrived
+    - job_done(job id, returncode): the job finished
+    - requeue(job id): the worker was lost; the job should run again
+
+    Workers must present `token` (by default, load_token()) before anything
+    else on each connection.
+    """
+
+    def __init__(self, address, take_job, job_output, job_done, requeue,
+                 lease_timeout=LEASE_TIMEOUT, token=None):
+        self.token = token or load_token()
+        self.take_job = take_job
+        self.job_output = job_output
+        self.job_done = job_done
+        self.requeue = requeue
+        self.lease_timeout = lease_timeout
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                coordinator._handle(self)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(parse_address(address),
+                                                      Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+
+    def _authenticate(self, handler, peer):
+        try:
+            message = json.loads(handler.rfile.readline().decode())
+            token = message.get("token") if message.get("op") == "auth" \
+                else None
+        except (ValueError, AttributeError):
+            token = None
+        if not isinstance(token, str) or \
+                not hmac.compare_digest(token.encode(), self.token.encode()):
+            log.warning("Rejected worker %s: bad or missing token", peer)
+            return False
+        _send(handler.wfile, {"op": "auth", "ok": True})
+        return True
+
+    def _handle(self, handler):
+        peer = "{}:{}".format(*handler.client_address[:2])
+        handler.connection.settimeout(self.lease_timeout)
+        job_id = None
+        try:
+            if not self._authenticate(handler, peer):
+                return
+            for line in handler.rfile:
+                message = json.loads(line.decode())
+                op = message["op"]
+                if op == "pull" and job_id is None:
+                    job = self.take_job()
+                    if job is not None:
+                        job_id, job = job
+                        log.info("Job %s leased to %s", job_id, peer)
+                        job = dict(job, id=job_id)
+                    _send(handler.wfile, {"op": "job", "job": job})
+                elif op == "output" and message["id"] == job_id:
+                    self.job_output(job_id, base64.b64decode(message["data"]))
+                elif op == "done" and message["id"] == job_id:
+                    log.info("Job %s finished on %s", job_id, peer)
+                    self.job_done(job_id, message["returncode"])
+                    job_id = None
+                elif op == "heartbeat":
+                    pass
+                else:
+                    log.warning("Unexpected message from %s: %s", peer, op)
+        except (OSError, ValueError, KeyError):
+            log.warning("Lost connection to worker %s", peer, exc_info=True)
+        finally:
+            if job_id is not None:
+                log.warning("Worker %s lost with job %s, requeueing", peer,
+                            job_id)
+                self.requeue(job_id)
+
+    def start(self):
+        t = threading.Thread(target=self.server.serve_forever, daemon=True)
+        t.start()
+        return self
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_submission(job, output):
+    """ Default job runner for workers: unpacks the submission and runs the
+    grading script on it, like watch.Grader does locally """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        parent = Path(tmpdir) / job["name"] / Path(job["parent"]).name
+        parent.mkdir(parents=True)
+        unpack_submission(job["archive"], str(parent))
+        env = dict(os.environ)
+        if job.get("trace"):
+            env[ENV_ID] = job["trace"]
+        if job.get("fail_fast"):
+            env[ENV_FAIL_FAST] = "1"
+        p = Popen(["python3", job.get("script", "run_tests.py"), str(parent)] +
+                  job["tests"], stdout=PIPE, env=env)
+        for chunk in iter(lambda: p.stdout.read1(CHUNK_SIZE), b''):
+            output(chunk)
+        return p.wait()
+
+
+class Worker:
+    """ Pulls jobs from a coordinator and runs them with `run_job(job,
+    output)`, which streams output through `output(chunk)` and returns the
+    exit code. Each of the `slots` runs one job at a time. `token` (by
+    default, load_token()) is presented to the coordinator. """
+
+    def __init__(self, address, run_job=run_submission, slots=1,
+                 poll_interval=POLL_INTERVAL, token=None):
+        self.token = token or load_token()
+        self.address = address
+        self.run_job = run_job
+        self.slots = slots
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def _slot(self):
+        while not self.stopping.is_set():
+            try:
+                with socket.create_connection(self.address) as sock, \
+                        sock.makefile('rb') as rfile, \
+                        sock.makefile('wb') as wfile:
+                    self._serve(rfile, wfile)
+            except OSError:
+                log.warning("Lost connection to coordinator %s:%s",
+                            *self.address[:2])
+            self.stopping.wait(self.poll_interval)
+
+    def _serve(self, rfile, wfile):
+        lock = threading.Lock()
+        last_sent = [time.time()]
+
+        def send(message):
+            with lock:
+                _send(wfile, message)
+                last_sent[0] = time.time()
+
+        send({"op": "auth", "token": self.token})
+        line = rfile.readline()
+        if not line or not json.loads(line.decode()).get("ok"):
+            log.error("Coordinator %s:%s rejected our token",
+                      *self.address[:2])
+            return
+        while not self.stopping.is_set():
+            send({"op": "pull"})
+            line = rfile.readline()
+            if not line:
+                return
+            job = json.loads(line.decode())["job"]
+            if job is None:
+                self.stopping.wait(self.poll_interval)
+                continue
+
+            def output(chunk):
+                send({"op": "output", "id": job["id"],
+                      "data": base64.b64encode(chunk).decode()})
+
+            done = threading.Event()
+
+            def heartbeat():
+                while not done.wait(HEARTBEAT_INTERVAL):
+                    if time.time() - last_sent[0] >= HEARTBEAT_INTERVAL:
+                        send({"op": "heartbeat"})
+            threading.Thread(target=heartbeat, daemon=True).start()
+            try:
+                returncode = self.run_job(job, output)
+            except Exception:
+                log.exception("Error running job %s", job["id"])
+                returncode = -1
+            finally:
+                done.set()
+            send({"op": "done", "id": job["id"], "returncode": returncode})
+
+    def start(self):
+        for _ in range(self.slots):
+            t = threading.Thread(target=self._slot, daemon=True)
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        for t in self.threads:
+            t.join()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Grade jobs from a coordinator")
+    parser.add_argument("coordinator", help="HOST:PORT of the coordinator")
+    parser.add_argument("-s", "--slots", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)-15s %(message)s",
+                        level=logging.INFO)
+    from .run_tests import reap_orphans
+    reap_orphans()
+    worker = Worker(parse_address(args.coordinator), slots=args.slots).start()
+    try:
+        for t in worker.threads:
+            t.join()
+    except KeyboardInterrupt:
+        worker.stopping.set()
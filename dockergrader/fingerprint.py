@@ -0,0 +1,76 @@
+""" Content fingerprints of submissions.
+
+A fingerprint is a digest of the relative paths and contents of the files
+in a submission that can affect grading: those matching the MP's include
+patterns (all files by default), minus svn metadata, the VERSION file and
+previous grading outputs. File digests are cached by mtime and size, so
+fingerprinting an unchanged tree only costs a stat per file. """
+from fnmatch import fnmatch
+import hashlib
+import os
+import threading
+
+DEFAULT_EXCLUDE = (".svn", "VERSION", "GRADING_OUTPUT*", "*.lock")
+CHUNK_SIZE = 1 << 16
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _matches(relpath, patterns):
+    name = os.path.basename(relpath)
+    return any(fnmatch(relpath, p) or fnmatch(name, p) for p in patterns)
+
+
+class FingerprintCache:
+
+    def __init__(self):
+        self.digests = {}   # path -> ((mtime_ns, size), digest)
+        self.lock = threading.Lock()
+
+    def digest(self, path):
+        st = os.stat(path)
+        key = (st.st_mtime_ns, st.st_size)
+        with self.lock:
+            entry = self.digests.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        digest = file_digest(path)
+        with self.lock:
+            self.digests[path] = (key, digest)
+        return digest
+
+    def files(self, root, include=None, exclude=DEFAULT_EXCLUDE):
+        """ Yields the relative paths under `root` that go into its
+        fingerprint, in sorted order """
+        root = str(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            rel_dir = os.path.relpath(dirpath, root)
+            rel_dir = '' if rel_dir == '.' else rel_dir + '/'
+            dirnames[:] = sorted(d for d in dirnames
+                                 if not _matches(rel_dir + d, exclude))
+            for name in sorted(filenames):
+                relpath = rel_dir + name
+                if _matches(relpath, exclude):
+                    continue
+                if include is None or _matches(relpath, include):
+                    yield relpath
+
+    def fingerprint(self, root, include=None, exclude=DEFAULT_EXCLUDE,
+                    extra=()):
+        """ Returns the fingerprint of the submission in `root`. `extra`
+        strings (e.g. test image IDs) are mixed in, so that a change to
+        them changes the fingerprint too. """
+        h = hashlib.sha256()
+        for item in extra:
+            h.update("extra {}\0".format(item).encode())
+        for relpath in self.files(root, include, exclude):
+            h.update("{}\0{}\0".format(
+                relpath, self.digest(os.path.join(str(root), relpath))
+            ).encode())
+        return h.hexdigest()
@@ -0,0 +1,144 @@
+""" Builds all the images needed for a term from a manifest, e.g.:
+
+    [{"mp": "mp1", "task": "compile", "dockerfile": "mp1/Dockerfile.compile",
+      "paths": "mp1/compile"},
+     {"mp": "mp1", "task": "test", "dockerfile": "mp1/Dockerfile.test",
+      "paths": {"tests": "mp1/tests", "bin": "common/bin"}}]
+
+Relative paths are resolved against the manifest's directory. Images whose
+FROM line names another image in the manifest are built after it; everything
+else is built concurrently. """
+from . import config
+from .build import BuildCache, build_cached, BuildError, FROM_LINE
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from docker.errors import APIError
+from pathlib import Path
+import json
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+MAX_WORKERS = 4
+
+PrebuildEntry = namedtuple('PrebuildEntry',
+                           ['mp', 'task', 'dockerfile', 'paths', 'tag'])
+
+PrebuildResult = namedtuple('PrebuildResult',
+                            ['entry', 'image', 'cached', 'seconds', 'error'])
+
+
+def load_manifest(manifest_path, term=config.TERM):
+    manifest_path = Path(manifest_path)
+    base = manifest_path.parent
+    with manifest_path.open() as f:
+        manifest = json.load(f)
+    entries = []
+    for e in manifest:
+        with (base / e["dockerfile"]).open() as dockerfile:
+            dockerfile_str = dockerfile.read()
+        paths = e.get("paths", {})
+        if isinstance(paths, dict):
+            paths = {n: base / d for n, d in paths.items()}
+        else:
+            paths = base / paths
+        entries.append(PrebuildEntry(e["mp"], e["task"], dockerfile_str, paths,
+                                     config.container_name(e["mp"], e["task"],
+                                                           term)))
+    return entries
+
+
+def build_order(entries):
+    """ Groups entries into stages; each entry's base image (if it is built
+    from the manifest) is in an earlier stage """
+    by_tag = {e.tag: e for e in entries}
+    depends = {e.tag: {t for t in FROM_LINE.findall(e.dockerfile)
+                       if t in by_tag and t != e.tag}
+               for e in entries}
+    done = set()
+    stages = []
+    while len(done) < len(entries):
+        stage = [e for e in entries
+                 if e.tag not in done and depends[e.tag] <= done]
+        if not stage:
+            raise ValueError("Circular FROM dependency among {}".format(
+                ', '.join(sorted(set(by_tag) - done))))
+        stages.append(stage)
+        done.update(e.tag for e in stage)
+    return stages
+
+
+def _build_one(entry, cache, built):
+    start = time.time()
+    try:
+        image, cached = build_cached(entry.dockerfile, entry.paths, cache,
+                                     tag=entry.tag, reproducible=True,
+                                     base_images=built)
+    except (BuildError, APIError, OSError) as e:
+        log.error("%s: build failed: %r", entry.tag, e)
+        return PrebuildResult(entry, None, False, time.time() - start, e)
+    result = PrebuildResult(entry, image, cached, time.time() - start, None)
+    log.info("%s: %s in %.1fs%s", entry.tag, image, result.seconds,
+             " (cached)" if cached else "")
+    return result
+
+
+def prebuild(entries, max_workers=MAX_WORKERS, cache=None):
+    """ Builds `entries` stage by stage, running each stage on a bounded pool
+    of workers. Entries whose base image failed to build are skipped.
+    Returns a list of PrebuildResults. """
+    if cache is None:
+        cache = BuildCache(config.BUILD_CACHE)
+    results = []
+    failed = set()
+    built = {}      # tag -> image ID, for the cache keys of later stages
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for stage in build_order(entries):
+            futures = []
+            for e in stage:
+                bases = set(FROM_LINE.findall(e.dockerfile)) & failed
+                if bases:
+                    log.error("Skipping %s, base image %s failed", e.tag,
+                              ', '.join(sorted(bases)))
+                    results.append(PrebuildResult(e, None, False, 0,
+                                                  "base image failed"))
+                    failed.add(e.tag)
+                    continue
+                futures.append(executor.submit(_build_one, e, cache,
+                                               dict(built)))
+            for f in futures:
+                result = f.result()
+                if result.error:
+                    failed.add(result.entry.tag)
+                else:
+                    built[result.entry.tag] = result.image
+                results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Build the grading images listed in a manifest")
+    parser.add_argument("manifest")
+    parser.add_argument("-j", "--jobs", type=int, default=MAX_WORKERS)
+    parser.add_argument("-t", "--term", default=config.TERM)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)-15s %(message)s",
+                        level=logging.INFO)
+
+    cache = BuildCache(config.BUILD_CACHE)
+    start = time.time()
+    results = prebuild(load_manifest(args.manifest, args.term), args.jobs,
+                       cache)
+    for r in results:
+        if r.error:
+            status = "FAILED"
+        else:
+            status = "cached" if r.cached else "built"
+        print("{:<40} {:>8} {:7.1f}s {}".format(r.entry.tag, status, r.seconds,
+                                                r.image or ''))
+    print("{} images in {:.1f}s; {}".format(len(results), time.time() - start,
+                                           cache))
+    raise SystemExit(1 if any(r.error for r in results) else 0)
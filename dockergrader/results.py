@@ -0,0 +1,100 @@
+""" Per-test results parsed from grading output.
+
+Grading scripts report each test on a line like "Test echo_server Passed",
+"Test echo_server Failed" or "Test echo_server Skipped (...)". TestResults
+picks these lines out of the output as it streams in and times each test
+from the previous result (or the start of grading), so that the results can
+be stored with the attempt instead of being recovered from the output file
+later. Skipped tests count as failed, so that re-tests run them again.
+
+TestPlan is the other side: grading scripts can use it to run their tests
+and print these lines. In fail-fast mode (watch.py -f), it skips tests whose
+prerequisites failed. """
+from collections import OrderedDict
+import logging
+import os
+import re
+import time
+
+TEST_LINE = re.compile(rb"Test ([\w_.]+) (Passed|Failed|Skipped)")
+# set to "1" in the environment of grading scripts in fail-fast mode
+ENV_FAIL_FAST = "DOCKERGRADER_FAIL_FAST"
+
+
+def fail_fast_mode():
+    return os.environ.get(ENV_FAIL_FAST) == "1"
+
+
+class TestResults:
+
+    def __init__(self):
+        self.results = OrderedDict()    # test -> {"passed": .., "seconds": ..}
+        self.buf = b''
+        self.last = time.time()
+
+    def _line(self, line):
+        m = TEST_LINE.search(line)
+        if m:
+            now = time.time()
+            result = {"passed": m.group(2) == b"Passed",
+                      "seconds": round(now - self.last, 3)}
+            if m.group(2) == b"Skipped":
+                result["skipped"] = True
+            self.results[m.group(1).decode()] = result
+            self.last = now
+
+    def feed(self, chunk):
+        lines = (self.buf + chunk).split(b'\n')
+        self.buf = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def close(self):
+        if self.buf:
+            self._line(self.buf)
+            self.buf = b''
+        return self.results
+
+    def failed(self):
+        return failed_tests(self.results)
+
+
+def failed_tests(results):
+    return [test for test, r in results.items() if not r["passed"]]
+
+
+def parse_output(f):
+    """ Returns the failed tests listed in a grading output file (opened in
+    binary mode), for attempts recorded without results """
+    return [m.group(1).decode() for m in map(TEST_LINE.search, f)
+            if m and m.group(2) != b"Passed"]
+
+
+class TestPlan:
+    """ Runs a grading script's tests in order, printing a result line for
+    each. In `fail_fast` mode (by default, when the script is run by
+    watch.py -f), a test is skipped if one of the tests it `requires` ran
+    and did not pass, and the skipped line says which. """
+
+    def __init__(self, fail_fast=None):
+        self.fail_fast = fail_fast_mode() if fail_fast is None else fail_fast
+        self.passed = OrderedDict()     # test -> whether it passed
+
+    def run(self, name, test, *args, requires=()):
+        """ Runs `test(*args)`, which passes by returning a true value;
+        returns whether it passed """
+        failed = [r for r in requires if self.passed.get(r) is False]
+        if self.fail_fast and failed:
+            self.passed[name] = False
+            print("Test {} Skipped ({} did not pass)".format(
+                name, ', '.join(failed)), flush=True)
+            return False
+        try:
+            ok = bool(test(*args))
+        except Exception:
+            logging.exception("Test %s raised an exception", name)
+            ok = False
+        self.passed[name] = ok
+        print("Test {} {}".format(name, "Passed" if ok else "Failed"),
+              flush=True)
+        return ok
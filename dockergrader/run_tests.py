@@ -1,31 +1,471 @@
 from . import config
+from .results import fail_fast_mode
+from .trace import TRACER
+import functools
 import logging
+import os
+import re
+import socket
+import threading
 import time
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from fcntl import flock, LOCK_EX, LOCK_NB
 import random
+from docker.errors import APIError, NotFound
+
+NETWORK_PREFIX = "dockergrader-testnet-"
+
+
+def _process_start(pid):
+    """ The start time of process `pid`, in clock ticks since boot, or None
+    if it cannot be told """
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the fields after the command name, which may contain spaces
+    return stat[stat.rindex(')') + 2:].split()[19]
+
+
+# containers and private networks are labeled with the host, pid and start
+# time of the process that created them, so that the janitor can tell which
+# ones were left behind by dead graders, even once their pid is reused
+OWNER_LABEL = "dockergrader.owner"
+OWNER = "{}:{}:{}".format(socket.gethostname(), os.getpid(),
+                          _process_start(os.getpid()) or '')
+CLEANUP_THREADS = 8
+# seconds containers get to exit when a test is stopped early
+STOP_TIMEOUT = 1
+# how often started containers are checked while later ones start, in
+# fail-fast mode
+FAIL_FAST_POLL = 0.5
+
+
+class PortProbe:
+    """ Ready once the container accepts TCP connections on `port` """
+
+    def __init__(self, port, timeout=1):
+        self.port = port
+        self.timeout = timeout
+
+    def __call__(self, run_test, name):
+        settings = config.docker.inspect_container(
+            run_test.containers[name]["Id"])["NetworkSettings"]
+        network = settings.get("Networks", {}).get(run_test.network_name, {})
+        ip = network.get("IPAddress") or settings.get("IPAddress")
+        if not ip:
+            return False
+        try:
+            socket.create_connection((ip, self.port), self.timeout).close()
+        except OSError:
+            return False
+        return True
+
+
+class LogProbe:
+    """ Ready once the container's output matches `pattern` """
+
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern)
+
+    def __call__(self, run_test, name):
+        return bool(self.pattern.search(
+            config.docker.logs(run_test.containers[name]["Id"]).decode(
+                errors='replace')))
+
+
+class ExecProbe:
+    """ Ready once `command` exits successfully inside the container """
+
+    def __init__(self, command):
+        self.command = command
+
+    def __call__(self, run_test, name):
+        exec_id = config.docker.exec_create(run_test.containers[name]["Id"],
+                                            self.command)["Id"]
+        config.docker.exec_start(exec_id)
+        return config.docker.exec_inspect(exec_id)["ExitCode"] == 0
+
+
+class BoundedBuffer:
+    """ Keeps the first and last `limit`/2 bytes written to it """
+
+    def __init__(self, limit):
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        if len(self.head) < self.head_limit:
+            n = self.head_limit - len(self.head)
+            self.head += data[:n]
+            data = data[n:]
+        self.tail += data
+        if len(self.tail) > self.tail_limit:
+            del self.tail[:len(self.tail) - self.tail_limit]
+
+    @property
+    def truncated(self):
+        return self.total - len(self.head) - len(self.tail)
+
+    def getvalue(self):
+        if self.truncated:
+            return bytes(self.head) + "\n[... {} bytes omitted ...]\n".format(
+                self.truncated).encode() + bytes(self.tail)
+        return bytes(self.head + self.tail)
+
+
+class LogCapture:
+    """ Streams a container's combined output while it runs, keeping at most
+    `limit` bytes of it (the start and the end). Each complete line is
+    checked against `patterns`; matches are recorded in `matches` as
+    (pattern, line) and passed to `on_match`, if given.
+
+    One thread follows each container. docker does not say which channel
+    streamed output came from, so stdout or stderr alone is read from
+    docker when it is asked for, bounded in the same way. """
+
+    def __init__(self, container_id, limit=config.LOG_LIMIT, patterns=(),
+                 on_match=None):
+        self.container_id = container_id
+        self.buffer = BoundedBuffer(limit)
+        self.limit = limit
+        self.patterns = [re.compile(p.encode() if isinstance(p, str) else p)
+                         for p in patterns]
+        self.on_match = on_match
+        self.matches = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._follow, daemon=True)
+        self.thread.start()
+        return self
+
+    def _follow(self):
+        partial = bytearray()
+        try:
+            stream = config.docker.logs(self.container_id, stdout=True,
+                                        stderr=True, stream=True,
+                                        follow=True)
+            for chunk in stream:
+                with self.lock:
+                    self.buffer.write(chunk)
+                if self.patterns:
+                    self._lines(chunk, partial)
+        except Exception:
+            logging.debug("Log stream for %s ended", self.container_id,
+                          exc_info=True)
+        if partial:
+            self._match(bytes(partial))
+
+    def _lines(self, chunk, partial):
+        """ Matches the lines completed by `chunk`; the unfinished rest
+        stays in `partial` (at most `limit` bytes of it) """
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            if end < 0:
+                break
+            partial += chunk[start:end]
+            self._match(bytes(partial))
+            del partial[:]
+            start = end + 1
+        partial += chunk[start:]
+        if len(partial) > self.limit:
+            del partial[:len(partial) - self.limit]
+
+    def _match(self, line):
+        for pattern in self.patterns:
+            if pattern.search(line):
+                with self.lock:
+                    self.matches.append((pattern.pattern, line))
+                if self.on_match:
+                    self.on_match(pattern.pattern, line)
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+    def output(self, stdout=True, stderr=True):
+        if stdout and stderr:
+            with self.lock:
+                return self.buffer.getvalue()
+        if not (stdout or stderr):
+            return b''
+        buf = BoundedBuffer(self.limit)
+        for chunk in config.docker.logs(self.container_id, stdout=stdout,
+                                        stderr=stderr, stream=True):
+            buf.write(chunk)
+        return buf.getvalue()
+
+
+class ContainerStats:
+    """ Follows a container's resource usage while it runs, keeping its
+    CPU time and peak memory use """
+
+    def __init__(self, container_id):
+        self.container_id = container_id
+        self.cpu_seconds = None
+        self.mem_max = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._follow, daemon=True)
+        self.thread.start()
+        return self
+
+    def _follow(self):
+        try:
+            for stats in config.docker.stats(self.container_id, decode=True):
+                usage = stats.get("cpu_stats", {}).get("cpu_usage", {})
+                if usage.get("total_usage"):
+                    self.cpu_seconds = usage["total_usage"] / 1e9
+                mem = stats.get("memory_stats", {})
+                peak = mem.get("max_usage") or mem.get("usage")
+                if peak:
+                    self.mem_max = max(self.mem_max or 0, peak)
+        except Exception:
+            logging.debug("Stats stream for %s ended", self.container_id,
+                          exc_info=True)
+
+    def join(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+
+
+NetworkLease = namedtuple('NetworkLease', ['name', 'id', 'lock_file'])
+
+
+class NetworkPool:
+    """ Test networks that are created once and then leased to one RunTest
+    at a time, instead of being created and removed for every test. Leases
+    are flocks on files in `lock_dir`, so they are shared by all grading
+    processes on the host and released automatically if a grader dies. """
+
+    def __init__(self, size=config.NETWORK_POOL_SIZE,
+                 lock_dir=config.NETWORK_LOCK_DIR):
+        self.size = size
+        self.lock_dir = lock_dir
+
+    def name(self, internal, index):
+        return "{}pool-{}-{}".format(NETWORK_PREFIX,
+                                     "int" if internal else "ext", index)
+
+    def _lock(self, name):
+        """ Returns the open lock file for `name` if it could be locked """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        lock_file = open(os.path.join(self.lock_dir, name + ".lock"), 'w')
+        try:
+            flock(lock_file.fileno(), LOCK_EX | LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def is_pooled(self, name):
+        return name.startswith(NETWORK_PREFIX + "pool-")
+
+    def lease(self, internal=False):
+        """ Leases a free network, creating it if needed; returns None if
+        all `size` networks are in use """
+        for index in range(self.size):
+            name = self.name(internal, index)
+            lock_file = self._lock(name)
+            if lock_file is None:
+                continue
+            try:
+                network_id = _find_network(name)
+                if network_id is None:
+                    network_id = config.docker.create_network(
+                        name, internal=internal)["Id"]
+                else:
+                    # left behind by a grader that died while holding it
+                    _remove_containers(_network_containers(network_id))
+            except Exception:
+                lock_file.close()
+                raise
+            logging.debug("Leased network %s", name)
+            return NetworkLease(name, network_id, lock_file)
+        return None
+
+    def release(self, lease):
+        lease.lock_file.close()
+
+    def in_use(self, name):
+        lock_file = self._lock(name)
+        if lock_file is None:
+            return True
+        lock_file.close()
+        return False
+
+
+NETWORK_POOL = NetworkPool()
+
+
+def _find_network(name):
+    # the daemon matches names by substring
+    for network in config.docker.networks(names=[name]):
+        if network["Name"] == name:
+            return network["Id"]
+    return None
+
+
+def _network_containers(network_id):
+    return list(config.docker.inspect_network(network_id).get("Containers")
+                or {})
+
+
+def _remove_container(container_id):
+    try:
+        config.docker.remove_container(container_id, force=True)
+    except NotFound:
+        pass
+
+
+def _stop_container(container_id):
+    try:
+        config.docker.stop(container_id, timeout=STOP_TIMEOUT)
+    except APIError:
+        logging.debug("Could not stop container %s", container_id,
+                      exc_info=True)
+
+
+def _for_each(f, container_ids):
+    """ Calls f on each container ID, in parallel """
+    container_ids = list(container_ids)
+    if len(container_ids) <= 1:
+        for container_id in container_ids:
+            f(container_id)
+        return
+    with ThreadPoolExecutor(min(CLEANUP_THREADS, len(container_ids))) as pool:
+        # list() re-raises the first error
+        list(pool.map(f, container_ids))
+
+
+def _remove_containers(container_ids):
+    """ Force-removes containers in parallel """
+    _for_each(_remove_container, container_ids)
+
+
+def _owner_alive(owner):
+    """ Whether the process in an OWNER label (host:pid:start, or host:pid
+    from older versions) may still be running """
+    host, _, rest = owner.partition(':')
+    pid, _, start = rest.partition(':')
+    if host != socket.gethostname():
+        return True     # can't tell; leave it to the janitor on that host
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    if start and _process_start(pid) not in (None, start):
+        return False    # the pid now belongs to another process
+    return True
+
+
+def reap_orphans(pool=NETWORK_POOL):
+    """ Removes the test containers and private test networks of grader
+    processes that are gone. Networks without an owner label are left
+    alone, since a live grader may be about to use them. Meant to be run
+    when grading starts. """
+    orphans = [c["Id"] for c in config.docker.containers(
+                   all=True, filters={"label": OWNER_LABEL})
+               if not _owner_alive(c.get("Labels", {}).get(OWNER_LABEL, ""))]
+    if orphans:
+        logging.info("Removing %d orphaned test containers", len(orphans))
+        _remove_containers(orphans)
+    for network in config.docker.networks():
+        name = network["Name"]
+        if not name.startswith(NETWORK_PREFIX):
+            continue
+        if pool.is_pooled(name):
+            continue    # kept for reuse; cleared when leased
+        owner = (network.get("Labels") or {}).get(OWNER_LABEL)
+        if owner is None or _owner_alive(owner):
+            continue
+        try:
+            _remove_containers(_network_containers(network["Id"]))
+            logging.info("Removing orphaned test network %s", name)
+            config.docker.remove_network(network["Id"])
+        except APIError:
+            logging.warning("Could not remove test network %s", name,
+                            exc_info=True)
 
 
 class RunTest:
 
-    def __init__(self, testcase_name):
+    def __init__(self, testcase_name, log_limit=config.LOG_LIMIT,
+                 log_patterns=(), fail_fast=None, fail_patterns=()):
+        """ Container output is captured while the containers run, keeping
+        at most `log_limit` bytes per container (set it to None to fetch the
+        logs from docker afterwards instead). Lines that match one of
+        `log_patterns` are collected in `matches`.
+
+        In `fail_fast` mode (by default, when the script is run by watch.py
+        -f), the test is stopped early (see `stop`) as soon as a container
+        that is waited for exits with a non-zero status, or a line of output
+        matches one of `fail_patterns` (which needs `log_limit`). """
         self.testcase_name = testcase_name
         self.containers = OrderedDict()
+        self.probes = {}
+        self.log_limit = log_limit
+        self.log_patterns = log_patterns
+        self.fail_fast = fail_fast_mode() if fail_fast is None else fail_fast
+        self.fail_patterns = {p.encode() if isinstance(p, str) else p
+                              for p in fail_patterns}
+        # why the test was stopped early, if it was
+        self.stopped = None
+        self._stopping = threading.Event()
+        self._stop_lock = threading.Lock()
+        self.captures = {}
+        self.stats = {}
+        self.started = {}
         self.network = None
-        self.network_name = "dockergrader-testnet-{}-{:05x}".format(
-            self.testcase_name, random.randrange(2**20))
+        self.pool = None
+        self.lease = None
+        # keeps container and network names apart between concurrent tests
+        self.suffix = "{:05x}".format(random.randrange(2**20))
+        self.network_name = "{}{}-{}".format(NETWORK_PREFIX,
+                                             self.testcase_name, self.suffix)
 
-    def create_network(self, internal=False):
-        self.network = config.docker.create_network(
-            self.network_name, internal=internal)
+    def create_network(self, internal=False, pool=NETWORK_POOL):
+        """ Leases a network from `pool`, or creates a private one if
+        `pool` is None or has no free network """
+        with TRACER.span("network.create", internal=internal):
+            if pool:
+                self.lease = pool.lease(internal)
+            if self.lease:
+                self.pool = pool
+                self.network_name = self.lease.name
+                self.network = {"Id": self.lease.id}
+            else:
+                self.network = config.docker.create_network(
+                    self.network_name, internal=internal,
+                    labels={OWNER_LABEL: OWNER})
 
     def remove_network(self):
-        config.docker.remove_network(self.network["Id"])
+        if self.lease:
+            self.pool.release(self.lease)
+            self.lease = None
+        else:
+            config.docker.remove_network(self.network["Id"])
+        self.network = None
 
     def add_command(self, image, command, name=None, ports=None, binds=[], caps=[],
-                    mem_limit='1G', memswap_limit='1G'):
+                    mem_limit='1G', memswap_limit='1G', ready=None):
         """
         Arguments:
             `binds`  a list of docker-style "-v" parameters; e.g., /tmp/foo:/bar:rw
+            `ready`  a readiness probe (PortProbe, LogProbe, ExecProbe); the
+                     next container is started as soon as it succeeds
         """
         host_config = None
         if not name:
@@ -35,49 +475,247 @@ class RunTest:
                                                        memswap_limit=memswap_limit)
         network_config = None
         if self.network:
+            # other containers on the network reach this one as `name`
             network_config = config.docker.create_networking_config({
-                self.network_name: config.docker.create_endpoint_config()})
-        container = config.docker.create_container(
-            image=image,
-            command=command,
-            name=name,
-            ports=ports,
-            host_config=host_config,
-            networking_config=network_config)
+                self.network_name: config.docker.create_endpoint_config(
+                    aliases=[name])})
+        with TRACER.span("container.create", container=name, image=image):
+            container = config.docker.create_container(
+                image=image,
+                command=command,
+                name="{}-{}".format(name, self.suffix),
+                ports=ports,
+                host_config=host_config,
+                networking_config=network_config,
+                labels={OWNER_LABEL: OWNER,
+                        "dockergrader.testcase": self.testcase_name})
         logging.debug("Created container: %s", container)
         self.containers[name] = container
+        if ready:
+            self.probes[name] = ready
+
+    def wait_ready(self, name, timeout, interval=0.2):
+        """ Polls the readiness probe of container `name` until it succeeds,
+        the container exits, or `timeout` seconds pass """
+        with TRACER.span("container.ready", container=name) as span:
+            ready = self._wait_ready(name, timeout, interval)
+            span.set(ready=ready)
+            return ready
+
+    def _wait_ready(self, name, timeout, interval):
+        deadline = time.time() + timeout
+        while True:
+            ready = self.check_ready(name)
+            if ready is not None:
+                return ready
+            if time.time() + interval > deadline:
+                logging.info("Container %s not ready after %ss", name, timeout)
+                return False
+            time.sleep(interval)
+
+    def check_ready(self, name):
+        """ Runs the readiness probe of container `name` once. Returns True
+        if it succeeded, False if the container has exited and None if it is
+        not ready yet. """
+        try:
+            if self.probes[name](self, name):
+                logging.debug("Container %s is ready", name)
+                return True
+        except Exception:
+            logging.debug("Readiness probe for %s failed", name,
+                          exc_info=True)
+        state = config.docker.inspect_container(
+            self.containers[name]["Id"])["State"]
+        if not state["Running"]:
+            logging.info("Container %s exited before becoming ready", name)
+            return False
+        return None
+
+    def start_container(self, name):
+        container = self.containers[name]
+        with TRACER.span("container.start", container=name):
+            config.docker.start(container["Id"])
+        with self._stop_lock:
+            self.started[name] = time.time()
+            stopped = self.stopped is not None
+        if stopped:
+            # stopped while it was starting
+            _stop_container(container["Id"])
+        logging.debug("Started container: %s", container["Id"])
+        if TRACER.enabled:
+            self.stats[name] = ContainerStats(container["Id"]).start()
+        if self.log_limit:
+            patterns, on_match = self.log_patterns, None
+            if self.fail_fast and self.fail_patterns:
+                patterns = list(patterns) + list(self.fail_patterns)
+                on_match = functools.partial(self._on_match, name)
+            self.captures[name] = LogCapture(container["Id"], self.log_limit,
+                                             patterns, on_match).start()
+
+    def _on_match(self, name, pattern, line):
+        if pattern in self.fail_patterns:
+            self.stop("container {} printed {!r}".format(
+                name, line.decode(errors='replace').strip()))
+
+    def stop(self, reason):
+        """ Stops the test early: the running containers are stopped and
+        the ones not started yet are skipped. `reason` is kept in `stopped`
+        and printed, so that it appears in the grading output. """
+        with self._stop_lock:
+            if self.stopped is not None:
+                return
+            self.stopped = reason
+            self._stopping.set()
+            started = [self.containers[name]["Id"] for name in self.started]
+        logging.info("Stopping test %s early: %s", self.testcase_name, reason)
+        print("Stopping {} early: {}".format(self.testcase_name, reason),
+              flush=True)
+        with TRACER.span("stop", testcase=self.testcase_name):
+            _for_each(_stop_container, started)
+
+    def check_exit(self, name):
+        """ In fail-fast mode, stops the test if container `name` exited
+        with a non-zero status """
+        status = self.containers[name].get("StatusCode")
+        if not self.fail_fast or status in (0, None):
+            return
+        if status == -1:
+            self.stop("container {} did not finish".format(name))
+        else:
+            self.stop("container {} exited with status {}".format(name,
+                                                                  status))
+
+    @property
+    def matches(self):
+        """ (container name, pattern, line) for every captured line that
+        matched one of `log_patterns` """
+        return [(name,) + m for name, capture in self.captures.items()
+                for m in capture.matches]
+
+    def _wait(self, name, timeout):
+        container = self.containers[name]
+        try:
+            with TRACER.span("container.wait", container=name):
+                container["StatusCode"] = config.docker.wait(
+                    container["Id"], timeout)
+        except:
+            logging.info("Exception waiting for container %s",
+                         container["Id"])
+            container["StatusCode"] = -1
+            config.docker.stop(container["Id"])
+        self.check_exit(name)
+
+    def _check_started(self, nowait):
+        """ Stops the test if a started container that is waited for has
+        already failed """
+        for name in list(self.started):
+            if name in nowait:
+                continue
+            state = config.docker.inspect_container(
+                self.containers[name]["Id"])["State"]
+            if not state["Running"] and state["ExitCode"]:
+                self.containers[name]["StatusCode"] = state["ExitCode"]
+                self.check_exit(name)
+                return
+
+    def _delay(self, delay, nowait):
+        if not self.fail_fast:
+            time.sleep(delay)
+            return
+        deadline = time.time() + delay
+        while not self.stopped and time.time() < deadline:
+            self._stopping.wait(max(0, min(FAIL_FAST_POLL,
+                                           deadline - time.time())))
+            self._check_started(nowait)
 
     def run_commands(self, timeout=None, nowait=[], delay=10):
-        for i, container in enumerate(self.containers.values()):
-            if i > 0:
+        """ Starts the containers in order and waits for them to finish.
+        Before each container is started, the previous one is given `delay`
+        seconds to start up; if it has a readiness probe, the next container
+        starts as soon as the probe succeeds. All containers not in `nowait`
+        are then waited for concurrently, for at most `timeout` seconds.
+
+        In fail-fast mode, containers not in `nowait` are watched from the
+        time they start, and the remaining containers are not started once
+        the test is stopped. Returns False if the test was stopped early. """
+        for step, previous in self.start_steps(nowait):
+            if step == "ready":
+                self.wait_ready(previous, delay)
+            else:
                 # sleep between starting containers to ensure
                 # they have time to start up
-                time.sleep(delay)
-            config.docker.start(container["Id"])
-            logging.debug("Started container: %s", container["Id"])
+                with TRACER.span("run.delay", container=previous):
+                    self._delay(delay, nowait)
 
         logging.debug("Waiting for containers to finish")
-        for name, container in self.containers.items():
-            if name in nowait:
-                continue
-            try:
-                container["StatusCode"] = config.docker.wait(
-                    container["Id"], timeout)
-            except:
-                logging.info("Exception waiting for container %s",
-                             container["Id"])
-                container["StatusCode"] = -1
-                config.docker.stop(container["Id"])
+        waiters = [threading.Thread(target=self._wait, args=(name, timeout))
+                   for name in self.waited(nowait)]
+        for t in waiters:
+            t.start()
+        for t in waiters:
+            t.join()
+        return self.finish(nowait)
+
+    def start_steps(self, nowait=()):
+        """ Starts the containers in order. Before starting each container
+        but the first, yields what the caller should wait for: ("ready",
+        previous) if the previous container has a readiness probe, or
+        ("delay", previous) otherwise. Stops starting containers once the
+        test is stopped. """
+        previous = None
+        for name in self.containers:
+            if previous is not None:
+                yield ("ready" if previous in self.probes else "delay",
+                       previous)
+                if self.fail_fast:
+                    self._check_started(nowait)
+            if self.stopped:
+                return
+            self.start_container(name)
+            previous = name
+
+    def waited(self, nowait=()):
+        """ The started containers that run_commands waits for """
+        return [name for name in list(self.started) if name not in nowait]
+
+    def finish(self, nowait=()):
+        """ Stops the containers in `nowait` once the others are done;
+        returns False if the test was stopped early """
         for name in nowait:
-            logging.debug("Stopping container %s", self.containers[name]["Id"])
-            config.docker.stop(self.containers[name]["Id"])
+            if name in self.started:
+                logging.debug("Stopping container %s",
+                              self.containers[name]["Id"])
+                config.docker.stop(self.containers[name]["Id"])
         logging.debug("Containers are done")
+        return self.stopped is None
+
+    def logs(self, name, stdout=True, stderr=True):
+        with TRACER.span("logs", container=name):
+            if name in self.captures:
+                # the stream ends shortly after the container exits
+                self.captures[name].join(timeout=10)
+                return self.captures[name].output(stdout, stderr)
+            return config.docker.logs(self.containers[name]["Id"],
+                                      stdout=stdout, stderr=stderr)
 
-    def logs(self, name):
-        return config.docker.logs(self.containers[name]["Id"])
+    def _record_container(self, name):
+        """ Records a span for the life of container `name`, with its
+        resource usage """
+        container = self.containers[name]
+        stats = self.stats.get(name)
+        if stats:
+            stats.join(timeout=1)
+        TRACER.record("container", self.started[name], time.time(),
+                      container=name, status=container.get("StatusCode"),
+                      cpu_seconds=stats and stats.cpu_seconds,
+                      mem_max=stats and stats.mem_max)
 
     def cleanup(self):
-        for container in self.containers.values():
-            config.docker.remove_container(container["Id"], force=True)
-        if self.network:
-            self.remove_network()
+        with TRACER.span("cleanup", testcase=self.testcase_name):
+            if TRACER.enabled:
+                for name in self.containers:
+                    if name in self.started:
+                        self._record_container(name)
+            _remove_containers(c["Id"] for c in self.containers.values())
+            if self.network:
+                self.remove_network()
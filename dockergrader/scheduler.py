@@ -0,0 +1,192 @@
+""" Resource-aware admission of grading jobs.
+
+Each job declares a CPU and memory budget per test, defaulting to one CPU
+and one container with the 1G `mem_limit` RunTest gives each container. A
+test's memory budget covers all of its containers that run at once. Jobs are
+admitted as long as the running jobs' budgets fit on the host and the
+concurrency limit allows. The limit starts at `start_jobs` and adapts to
+live host load: it shrinks while the host is overloaded or short of memory
+and grows while there is spare capacity, up to `max_jobs`, which defaults to
+the number of jobs with the default budget that fit on the host. """
+from collections import namedtuple, deque
+import json
+import logging
+import os
+import re
+import time
+
+log = logging.getLogger(__name__)
+
+Budget = namedtuple('Budget', ['cpus', 'mem'])
+
+DEFAULT_BUDGET = Budget(1, 2**30)
+# the fixed number of concurrent graders watch.py used to run; the
+# concurrency limit starts here
+START_JOBS = 6
+
+# fraction of host memory that running jobs may reserve
+MEM_FRACTION = 0.8
+# grow the limit below LOW_LOAD * cpus load average, shrink above HIGH_LOAD
+LOW_LOAD = 0.7
+HIGH_LOAD = 1.2
+# shrink the limit when less than this fraction of memory is available
+LOW_MEM = 0.1
+ADJUST_INTERVAL = 10
+
+Decision = namedtuple('Decision', ['time', 'key', 'admitted', 'reason'])
+
+_MEM_UNITS = {'': 1, 'b': 1, 'k': 2**10, 'm': 2**20, 'g': 2**30, 't': 2**40}
+
+
+def parse_mem(mem):
+    """ Parses docker-style memory sizes, e.g. '512m' or '1G' """
+    if isinstance(mem, int):
+        return mem
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([bkmgt]?)b?\s*$', mem, re.IGNORECASE)
+    if not m:
+        raise ValueError("Invalid memory size {!r}".format(mem))
+    return int(float(m.group(1)) * _MEM_UNITS[m.group(2).lower()])
+
+
+def load_budgets(path):
+    """ Reads per-test budgets from a JSON file like
+    {"test_name": {"cpus": 2, "mem": "1G", "containers": 3}}, where "mem" is
+    the memory limit of each container and "containers" the number of them
+    the test runs at once (1 by default) """
+    with open(path) as f:
+        budgets = json.load(f)
+    return {test: Budget(b.get("cpus", DEFAULT_BUDGET.cpus),
+                         parse_mem(b.get("mem", DEFAULT_BUDGET.mem)) *
+                         b.get("containers", 1))
+            for test, b in budgets.items()}
+
+
+def _meminfo():
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            info[key] = int(value.split()[0]) * 1024
+    return info
+
+
+def host_memory():
+    try:
+        return _meminfo()["MemTotal"]
+    except (OSError, KeyError):
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def host_available_memory():
+    try:
+        return _meminfo()["MemAvailable"]
+    except (OSError, KeyError):
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+
+def host_load():
+    return os.getloadavg()[0]
+
+
+class ResourceScheduler:
+
+    def __init__(self, cpus=None, mem=None, budgets=None,
+                 default_budget=DEFAULT_BUDGET, max_jobs=None, min_jobs=1,
+                 start_jobs=START_JOBS,
+                 load=host_load, available_memory=host_available_memory):
+        self.cpus = cpus or os.cpu_count() or 1
+        self.mem = mem or host_memory()
+        self.budgets = budgets or {}
+        self.default_budget = default_budget
+        self.max_jobs = max_jobs or max(start_jobs, self.host_capacity())
+        self.min_jobs = min_jobs
+        self.limit = min(start_jobs, self.max_jobs)
+        self.load = load
+        self.available_memory = available_memory
+        self.running = {}
+        self.decisions = deque(maxlen=1000)
+        self.last_adjust = None
+
+    def budget(self, tests):
+        """ The budget of a job running `tests` one after another, i.e. that
+        of its largest test; an empty list means all tests """
+        if tests:
+            budgets = [self.budgets.get(t, self.default_budget) for t in tests]
+        else:
+            budgets = list(self.budgets.values()) + [self.default_budget]
+        return Budget(max(b.cpus for b in budgets), max(b.mem for b in budgets))
+
+    def host_capacity(self):
+        """ The number of jobs with the default budget that fit on the host """
+        jobs = int(self.mem * MEM_FRACTION // self.default_budget.mem)
+        if self.default_budget.cpus:
+            jobs = min(jobs, int(self.cpus // self.default_budget.cpus))
+        return max(1, jobs)
+
+    def cpu_capacity(self):
+        """ CPUs that running jobs may reserve. Graders mostly wait on their
+        containers, so this never holds jobs with the default budget below
+        `max_jobs`; the adaptive limit takes care of a host that is really
+        overloaded. """
+        return max(self.cpus, self.max_jobs * self.default_budget.cpus)
+
+    def adjust(self, now=None):
+        """ Adapts the concurrency limit to the host's load """
+        now = now if now is not None else time.time()
+        if self.last_adjust is not None and \
+                now - self.last_adjust < ADJUST_INTERVAL:
+            return
+        self.last_adjust = now
+        load = self.load()
+        available = self.available_memory()
+        old = self.limit
+        if load > self.cpus * HIGH_LOAD or available < self.mem * LOW_MEM:
+            self.limit = max(self.min_jobs, min(self.limit, len(self.running)) - 1)
+        elif load < self.cpus * LOW_LOAD and len(self.running) >= self.limit:
+            self.limit = min(self.max_jobs, self.limit + 1)
+        if self.limit != old:
+            log.info("Concurrency limit %d -> %d (load %.1f, %d MB available)",
+                     old, self.limit, load, available // 2**20)
+
+    def _decide(self, key, admitted, reason):
+        decision = Decision(time.time(), key, admitted, reason)
+        self.decisions.append(decision)
+        log.debug("%s %s: %s", "Admitted" if admitted else "Deferred", key,
+                  reason)
+        return decision
+
+    def admit(self, key, tests):
+        """ Decides whether the job `key` running `tests` can start now; if
+        so, its budget is reserved until `release(key)` """
+        self.adjust()
+        budget = self.budget(tests)
+        cpus = sum(b.cpus for b in self.running.values())
+        mem = sum(b.mem for b in self.running.values())
+        # a job always runs on an idle host, even if it is over budget
+        if self.running:
+            if len(self.running) >= self.limit:
+                return self._decide(key, False, "concurrency limit {}".format(
+                    self.limit)).admitted
+            if cpus + budget.cpus > self.cpu_capacity():
+                return self._decide(key, False, "{} of {} CPUs reserved".format(
+                    cpus, self.cpu_capacity())).admitted
+            if mem + budget.mem > self.mem * MEM_FRACTION:
+                return self._decide(key, False, "{} MB of memory reserved".format(
+                    mem // 2**20)).admitted
+            if budget.mem > self.available_memory():
+                return self._decide(key, False, "host memory low").admitted
+        self.running[key] = budget
+        return self._decide(key, True, "{} CPUs, {} MB".format(
+            budget.cpus, budget.mem // 2**20)).admitted
+
+    def release(self, key):
+        self.running.pop(key, None)
+
+    def __len__(self):
+        return len(self.running)
+
+    def __str__(self):
+        return "{}/{} jobs, {} CPUs, {} MB reserved".format(
+            len(self.running), self.limit,
+            sum(b.cpus for b in self.running.values()),
+            sum(b.mem for b in self.running.values()) // 2**20)
@@ -0,0 +1,123 @@
+""" Staging of submissions into a grading directory.
+
+Three modes are supported:
+
+- "copy" copies the tree with shutil.copytree
+- "reflink" copies the tree the same way, but clones each file as a
+  copy-on-write reflink where the filesystem supports it (btrfs, XFS), so
+  staging does not copy any data and writes to the staged files never reach
+  the source. Elsewhere it is the same as "copy".
+- "overlay" mounts an overlayfs with the submission as the read-only lower
+  layer and a fresh upper layer receiving all writes. Mounting and creating
+  the whiteouts for ignored files require root. The mount must be removed
+  with `unstage` once it is no longer needed; mounts still in place when the
+  process exits are removed then.
+
+In every mode, files and directories whose name matches one of the `ignore`
+glob patterns are left out.
+"""
+from pathlib import Path
+from subprocess import check_call
+import atexit
+import errno
+import fcntl
+import fnmatch
+import logging
+import os
+import shutil
+
+log = logging.getLogger(__name__)
+
+MODES = ("copy", "reflink", "overlay")
+FICLONE = 0x40049409    # from linux/fs.h
+
+
+def _ignored(name, ignore):
+    return any(fnmatch.fnmatch(name, pat) for pat in ignore)
+
+
+def _clone(src, dst):
+    """ Copies `src` to `dst` as a reflink, falling back to a plain copy """
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                           errno.EINVAL, errno.EPERM):
+            raise
+        # not supported by the filesystem, or on different filesystems
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+# overlay mounts made by this process that have not been unstaged
+_mounts = set()
+
+
+def _overlay_dir(dst):
+    dst = Path(dst)
+    return dst.parent / ".{}.overlay".format(dst.name)
+
+
+def _overlay(src, dst, ignore):
+    base = _overlay_dir(dst)
+    upper = base / "upper"
+    work = base / "work"
+    for d in (upper, work, Path(dst)):
+        d.mkdir(parents=True)
+    # hide ignored entries of the lower layer with whiteouts
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        for name in [n for n in dirs + files if _ignored(n, ignore)]:
+            whiteout = upper / rel / name
+            whiteout.parent.mkdir(parents=True, exist_ok=True)
+            os.mknod(str(whiteout), 0o600 | 0o020000, os.makedev(0, 0))
+        dirs[:] = [d for d in dirs if not _ignored(d, ignore)]
+    check_call(["mount", "-t", "overlay", "overlay", "-o",
+                "lowerdir={},upperdir={},workdir={}".format(
+                    os.path.abspath(src), upper, work),
+                str(dst)])
+    if not _mounts:
+        atexit.register(unstage_all)
+    _mounts.add(os.path.abspath(str(dst)))
+
+
+def stage(src, dst, mode="copy", ignore=()):
+    """ Stages the submission in `src` at `dst`, which must not exist """
+    if mode == "copy":
+        shutil.copytree(src, dst, ignore=shutil.ignore_patterns(*ignore))
+    elif mode == "reflink":
+        shutil.copytree(src, dst, ignore=shutil.ignore_patterns(*ignore),
+                        copy_function=_clone)
+    elif mode == "overlay":
+        if os.geteuid() != 0:
+            raise PermissionError("overlay staging requires root")
+        _overlay(src, dst, ignore)
+    else:
+        raise ValueError("Unknown staging mode {}; expected one of {}".format(
+            mode, ', '.join(MODES)))
+    log.debug("Staged %s at %s (%s)", src, dst, mode)
+
+
+def unstage(dst):
+    """ Removes the overlay mount created by stage(), if any, along with its
+    mount point and layers. Copies are left in place for the caller to
+    remove. """
+    if os.path.ismount(dst):
+        check_call(["umount", str(dst)])
+        os.rmdir(str(dst))
+    _mounts.discard(os.path.abspath(str(dst)))
+    base = _overlay_dir(dst)
+    if base.exists():
+        shutil.rmtree(str(base))
+
+
+def unstage_all():
+    """ Removes all overlay mounts this process still has in place """
+    for dst in list(_mounts):
+        try:
+            unstage(dst)
+        except Exception:
+            log.exception("Could not unstage %s", dst)
+            _mounts.discard(dst)
@@ -0,0 +1,249 @@
+""" Queue status page.
+
+The status is kept as a list of rows in memory. Callers mark it changed
+whenever the queue or the running graders change; `flush` rebuilds the rows
+at most every `min_interval` seconds and only rewrites queue.html and
+queue.json when the rows actually differ, or when they were last written
+`heartbeat` seconds ago, so that "Last updated" shows the grader is alive
+even while the queue stands still. Files are replaced atomically, so
+readers never see a half-written page. The same content can be served from
+memory by a small HTTP server. """
+from collections import namedtuple
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import html
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# started is None for submissions that are still waiting
+Row = namedtuple('Row', ['team', 'source', 'version', 'tests', 'since',
+                         'attempts', 'started'])
+
+MIN_INTERVAL = 1
+HEARTBEAT = 60
+
+
+def atomic_write(path, data):
+    """ Replaces `path` with `data` (bytes) so that readers see either the
+    old or the new content """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix="." + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _team(row):
+    if row.source:
+        return "{} <small>({})</small>".format(html.escape(row.team),
+                                               html.escape(row.source))
+    return html.escape(row.team)
+
+
+def _tests(row):
+    return html.escape(row.tests and ', '.join(row.tests) or "all")
+
+
+def render_html(running, waiting, updated):
+    parts = ['''
+<!DOCTYPE html>
+<html lang="en">
+  <head>
+    <meta charset="utf-8">
+    <meta http-equiv="X-UA-Compatible" content="IE=edge">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <meta http-equiv="refresh" content="60">
+    <title>Autograder Queue</title>
+    <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css" integrity="sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u" crossorigin="anonymous">
+    <script>
+''']
+    parts.append('''
+      const update_time = new Date({0}, {1}-1, {2}, {3}, {4}, {5});
+'''.format(*updated.timetuple()))
+    parts.append('''
+      function update() {
+        var now = new Date();
+        var delta = Math.floor((now - update_time)/1000);
+        var html = '';
+        if (delta > 60) {
+          if (delta > 3600) {
+            html = Math.floor(delta/3600) + " hours, ";
+          }
+          html += Math.floor(delta/60) % 60 + " minutes, ";
+        }
+        html += delta % 60 + " seconds ago";
+        document.getElementById('ago').innerHTML = html;
+      }
+      setInterval(update, 1000);
+      update();
+
+      </script>
+''')
+
+    parts.append('''
+</head>
+<body>
+  <div class="container">
+  <h1>Autograder Queue</h1>
+
+  <p>Last updated: {}, <span id="ago"></p>
+
+  <table class="table">
+  <thead>
+      <tr>
+          <th>Team</th>
+          <th>Version</th>
+          <th>Test to run</th>
+          <th>Waiting since</th>
+          <th>Total attempts</th>
+     </tr>
+   </thead>
+   <tbody>
+'''.format(updated.ctime()))
+
+    for row in running:
+        parts.append('''
+        <tr class="info">
+            <td>{}<br><small>Started @ {}</small></td>
+            <td>{}</td>
+            <td>{}</td>
+            <td>{}</td>
+            <td>{}</td>
+        </tr>
+'''.format(_team(row), row.started.strftime("%H:%M"), row.version, _tests(row),
+           row.since.strftime("%H:%M"), row.attempts))
+
+    for row in waiting:
+        parts.append('''
+        <tr>
+            <td>{}</td>
+            <td>{}</td>
+            <td>{}</td>
+            <td>{}</td>
+            <td>{}</td>
+        </tr>
+'''.format(_team(row), row.version, _tests(row), row.since.strftime("%H:%M"),
+           row.attempts))
+
+    parts.append('''
+    </tbody>
+</table>
+</div>
+</body>
+</html>
+''')
+    return ''.join(parts)
+
+
+def _row_json(row):
+    return {"team": row.team, "source": row.source, "version": row.version,
+            "tests": row.tests, "since": row.since.isoformat(),
+            "attempts": row.attempts,
+            "started": row.started and row.started.isoformat()}
+
+
+def render_json(running, waiting, updated):
+    return json.dumps({"updated": updated.isoformat(),
+                       "running": [_row_json(r) for r in running],
+                       "waiting": [_row_json(r) for r in waiting]}, indent=1)
+
+
+class QueueStatus:
+    """ `rows` is called (with the queue locked) to get the current
+    (running, waiting) rows. `html_path` or `json_path` may be None to skip
+    writing that file. `heartbeat` may be None to only write on changes. """
+
+    def __init__(self, rows, html_path="queue.html", json_path="queue.json",
+                 min_interval=MIN_INTERVAL, heartbeat=HEARTBEAT):
+        self.rows = rows
+        self.html_path = html_path
+        self.json_path = json_path
+        self.min_interval = min_interval
+        self.heartbeat = heartbeat
+        self.dirty = True
+        self.last_flush = 0
+        self.last_write = 0
+        self.current = None
+        self.updated = None
+        self.html = b''
+        self.json = b''
+        self.writes = 0
+
+    def changed(self):
+        self.dirty = True
+
+    def delay(self):
+        """ Seconds until a pending change is due to be flushed, or None """
+        if not self.dirty:
+            return None
+        return max(0, self.last_flush + self.min_interval - time.time())
+
+    def flush(self, force=False):
+        """ Writes the status out if it changed or the heartbeat is due;
+        returns whether it did """
+        now = time.time()
+        beat = bool(self.heartbeat) and \
+            now - self.last_write >= self.heartbeat
+        if not beat and (not self.dirty or (not force and self.delay() > 0)):
+            return False
+        self.dirty = False
+        self.last_flush = now
+        rows = self.rows()
+        rows = (list(rows[0]), list(rows[1]))
+        if rows == self.current and not beat:
+            return False
+        self.current = rows
+        self.last_write = now
+        self.updated = datetime.now()
+        self.html = render_html(*rows, updated=self.updated).encode()
+        self.json = render_json(*rows, updated=self.updated).encode()
+        if self.html_path:
+            atomic_write(self.html_path, self.html)
+        if self.json_path:
+            atomic_write(self.json_path, self.json)
+        self.writes += 1
+        return True
+
+    def serve(self, address):
+        """ Serves the status page at / and the JSON at /queue.json from
+        memory; `address` is HOST:PORT """
+        status = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path in ("/", "/queue.html"):
+                    body, content_type = status.html, "text/html"
+                elif self.path == "/queue.json":
+                    body, content_type = status.json, "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 content_type + "; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        host, _, port = address.rpartition(':')
+        server = Server((host or "0.0.0.0", int(port)), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
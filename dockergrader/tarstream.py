@@ -0,0 +1,119 @@
+""" Helpers for generating tar archives on the fly, for sending to the
+docker daemon without staging them on disk """
+from pathlib import Path
+import fnmatch
+import logging
+import os
+import stat
+import tarfile
+import time
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+
+
+def walk(path, arcname='', ignore=()):
+    """ Yields (arcname, path) pairs for everything under `path`, in sorted
+    order, leaving out names that match one of the `ignore` glob patterns.
+    Symlinks are not followed. """
+    path = Path(path)
+    arcname = Path(arcname)
+    for root, dirs, files in os.walk(str(path)):
+        dirs[:] = sorted(d for d in dirs if not
+                         any(fnmatch.fnmatch(d, pat) for pat in ignore))
+        files = [f for f in files if not
+                 any(fnmatch.fnmatch(f, pat) for pat in ignore)]
+        root = Path(root)
+        for name in sorted(dirs + files):
+            yield arcname / (root / name).relative_to(path), root / name
+
+
+def _header(info):
+    return info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING,
+                      "surrogateescape")
+
+
+def _padding(size):
+    return tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+
+def _tarinfo(arcname, source, reproducible):
+    info = tarfile.TarInfo(str(arcname))
+    if isinstance(source, bytes):
+        info.size = len(source)
+        info.mode = 0o644
+        if not reproducible:
+            info.mtime = int(time.time())
+        return info
+    st = source.lstat()
+    info.mode = stat.S_IMODE(st.st_mode)
+    if not reproducible:
+        info.mtime = int(st.st_mtime)
+        info.uid = st.st_uid
+        info.gid = st.st_gid
+    if stat.S_ISDIR(st.st_mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(str(source))
+    elif stat.S_ISREG(st.st_mode):
+        info.size = st.st_size
+    else:
+        return None
+    return info
+
+
+def tar_stream(entries, reproducible=False, chunk_size=CHUNK_SIZE):
+    """ Generates a tar archive from (arcname, source) pairs, where source is
+    either a Path or the contents of a file as bytes. File contents are read
+    in chunks, so memory use does not depend on the size of the archive.
+    With `reproducible`, mtimes and ownership are zeroed so that identical
+    inputs give byte-identical archives. """
+    total = 0
+    for arcname, source in entries:
+        info = _tarinfo(arcname, source, reproducible)
+        if info is None:
+            log.warning("Skipping special file %s", source)
+            continue
+        buf = _header(info)
+        if isinstance(source, bytes):
+            buf += source + _padding(info.size)
+        yield buf
+        total += len(buf)
+        if info.isreg() and not isinstance(source, bytes):
+            remaining = info.size
+            with source.open('rb') as f:
+                while remaining:
+                    chunk = f.read(min(chunk_size, remaining))
+                    if not chunk:
+                        # file shrank while we were reading it
+                        chunk = tarfile.NUL * min(chunk_size, remaining)
+                    remaining -= len(chunk)
+                    yield chunk
+            buf = _padding(info.size)
+            yield buf
+            total += info.size + len(buf)
+    # end of archive: two empty blocks, padded to a full record
+    end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    total += len(end)
+    yield end + tarfile.NUL * (-total % tarfile.RECORDSIZE)
+
+
+def extract(tar, dst):
+    """ Extracts the regular files and directories in `tar` (which may be
+    opened in stream mode) under `dst`. Since archives from submissions and
+    compile containers are untrusted, links, device files and paths that
+    would end up outside `dst` are skipped, and special mode bits are
+    cleared. """
+    root = os.path.realpath(dst)
+    for member in tar:
+        path = os.path.realpath(os.path.join(root, member.name))
+        if not (member.isfile() or member.isdir()):
+            log.warning("Skipping %s: not a regular file or directory",
+                        member.name)
+        elif path != root and not path.startswith(root + os.sep):
+            log.warning("Skipping unsafe path %s", member.name)
+        else:
+            member.mode &= 0o755
+            tar.extract(member, root)
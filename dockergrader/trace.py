@@ -0,0 +1,211 @@
+""" Timing of the phases of grading jobs.
+
+Code wraps each phase in `TRACER.span(name, **attrs)`. Spans that finish
+are appended as JSON lines to the trace file, if one is set, and their
+durations are kept for percentile summaries. Spans belong to the trace (job)
+that is current in their thread, or to the process's default trace.
+
+The trace file and the default trace are taken from the DOCKERGRADER_TRACE
+and DOCKERGRADER_TRACE_ID environment variables, so the grading scripts that
+watch.py runs add their spans to the same file and the same job. Summarize a
+trace file with
+
+    python -m dockergrader.trace trace.jsonl
+"""
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import threading
+import time
+
+ENV_FILE = "DOCKERGRADER_TRACE"
+ENV_ID = "DOCKERGRADER_TRACE_ID"
+
+# durations kept per span name for summaries
+SUMMARY_SAMPLES = 10000
+PERCENTILES = (50, 90, 99)
+
+
+class Span:
+
+    def __init__(self, tracer, name, trace, parent, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.trace = trace
+        self.parent = parent
+        self.attrs = attrs
+        self.id = None
+        self.start = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.id = self.tracer._next_id()
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self.tracer._stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self._t0
+        self.tracer._stack().pop()
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer._emit(self.name, self.trace, self.id, self.parent,
+                          self.start, duration, self.attrs)
+
+
+class _NullSpan:
+    """ Stands in for spans while tracing is off """
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """ Records spans to `path` (if given) and for `summary`. Tracing is off
+    until a path is given or `enable` is called. """
+
+    def __init__(self, path=None, trace_id=None):
+        self.trace_id = trace_id
+        self.enabled = False
+        self.fd = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.durations = defaultdict(lambda: deque(maxlen=SUMMARY_SAMPLES))
+        if path:
+            self.open(path)
+
+    def open(self, path):
+        """ Appends spans to `path` from now on """
+        self.close()
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.enabled = True
+
+    def enable(self):
+        self.enabled = True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def _next_id(self):
+        return "{}-{}".format(os.getpid(), next(self.ids))
+
+    def current_trace(self):
+        return getattr(self.local, "trace", None) or self.trace_id
+
+    @contextmanager
+    def trace(self, trace_id):
+        """ Makes `trace_id` the current trace in this thread """
+        saved = getattr(self.local, "trace", None)
+        self.local.trace = trace_id
+        try:
+            yield
+        finally:
+            self.local.trace = saved
+
+    def span(self, name, **attrs):
+        """ Context manager timing the phase `name` """
+        if not self.enabled:
+            return _NULL_SPAN
+        stack = self._stack()
+        return Span(self, name, self.current_trace(),
+                    stack[-1].id if stack else None, attrs)
+
+    def record(self, name, start, end, **attrs):
+        """ Records a span that was timed elsewhere (times from time.time) """
+        if self.enabled:
+            stack = self._stack()
+            self._emit(name, self.current_trace(), self._next_id(),
+                       stack[-1].id if stack else None, start, end - start,
+                       attrs)
+
+    def _emit(self, name, trace, span_id, parent, start, duration, attrs):
+        record = dict(attrs, name=name, trace=trace, span=span_id,
+                      parent=parent, start=round(start, 6),
+                      duration=round(duration, 6))
+        line = (json.dumps(record, default=str) + '\n').encode()
+        with self.lock:
+            self.durations[name].append(duration)
+            if self.fd is not None:
+                # a single O_APPEND write, so that lines from several
+                # processes do not interleave
+                os.write(self.fd, line)
+
+    def summary(self):
+        return summarize(self.durations)
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of sorted `values` """
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))
+    return values[int(k)]
+
+
+def summarize(durations):
+    """ Summarizes a {span name: durations} mapping """
+    summary = {}
+    for name, values in durations.items():
+        values = sorted(values)
+        stats = {"count": len(values), "total": sum(values),
+                 "max": values[-1] if values else None}
+        for p in PERCENTILES:
+            stats["p{}".format(p)] = percentile(values, p)
+        summary[name] = stats
+    return summary
+
+
+def load(path):
+    """ Returns the span durations in a trace file, by span name """
+    durations = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            durations[record["name"]].append(record["duration"])
+    return durations
+
+
+def format_summary(summary):
+    columns = ["count", "total"] + ["p{}".format(p) for p in PERCENTILES] + \
+        ["max"]
+    lines = ["{:<28}".format("span") +
+             ''.join("{:>10}".format(c) for c in columns)]
+    for name, stats in sorted(summary.items(), key=lambda i: -i[1]["total"]):
+        lines.append("{:<28}{:>10}".format(name, stats["count"]) +
+                     ''.join("{:>10.3f}".format(stats[c]) for c in columns[1:]))
+    return '\n'.join(lines)
+
+
+TRACER = Tracer(os.environ.get(ENV_FILE), os.environ.get(ENV_ID))
+
+
+if __name__ == "__main__":
+    import sys
+    print(format_summary(summarize(load(sys.argv[1]))))
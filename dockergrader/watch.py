@@ -1,17 +1,33 @@
 from pathlib import Path
-from collections import namedtuple, defaultdict
+from collections import OrderedDict, namedtuple
 from datetime import datetime
 from heapq import heappush, heappop
 from subprocess import *
+import os
 import sys
 import time
 import logging
 import shelve
+import dbm
 import re
+import json
+import shutil
+from contextlib import ExitStack
 from fcntl import flock, LOCK_EX
 from functools import total_ordering
+from itertools import count
 
-from threading import Thread, Lock
+from threading import Thread, Lock, RLock, Event
+from queue import Queue, Empty
+
+from dockergrader.attempts import AttemptsStore
+from dockergrader.distributed import Coordinator, pack_submission
+from dockergrader.fingerprint import FingerprintCache
+from dockergrader.scheduler import ResourceScheduler, load_budgets
+from dockergrader.results import TestResults, failed_tests, parse_output, \
+    ENV_FAIL_FAST, fail_fast_mode
+from dockergrader.status import QueueStatus, Row
+from dockergrader.trace import TRACER, ENV_FILE, ENV_ID, format_summary
 
 QueueEntryBase = namedtuple(
     'QueueEntryBase', ['attempts', 'time', 'version', 'name', 'tests', 'parent'])
@@ -24,13 +40,20 @@ svn_lock = Lock()
 @total_ordering
 class QueueEntry:
 
-    def __init__(self, attempts, time, version, name, tests, parent):
+    def __init__(self, attempts, time, version, name, tests, parent,
+                 source=None):
         self.attempts = attempts
         self.time = time
         self.version = version
         self.name = name
         self.tests = tests
         self.parent = parent
+        self.source = source    # not part of the ordering
+
+    @property
+    def key(self):
+        """ Identifies the team across sources """
+        return (self.source and self.source.name, self.name)
 
     @property
     def _adj_attempts(self):
@@ -63,190 +86,497 @@ class GradingQueue():
     """ Grading queue is sorted by:
     - smallest # of attempts
     - then by earliest addition time
+
+    It is kept as a binary heap with the position of each team's entry
+    indexed, so that a team's entry can be updated or removed in place
+    in O(log n) and the heap only ever holds one entry per team.
     """
 
     def __init__(self):
         self.queue = []
-        self.names = {}
+        self.index = {}     # name -> position in self.queue
 
-    def push(self, qe):
-        if qe.name in self.names and qe.version == self.names[qe.name].version:
-            return
-            # already in queue, don't bother waiting
-        heappush(self.queue, qe)
-        self.names[qe.name] = qe
+    def _swap(self, i, j):
+        q = self.queue
+        q[i], q[j] = q[j], q[i]
+        self.index[q[i].name] = i
+        self.index[q[j].name] = j
 
-    def pop(self):
+    def _sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if not self.queue[i] < self.queue[parent]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        n = len(self.queue)
         while True:
-            qe = heappop(self.queue)
-            if qe == self.names.get(qe.name, None):
-                # this one actually needs to be processed
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and self.queue[child] < self.queue[smallest]:
+                    smallest = child
+            if smallest == i:
                 break
-        del self.names[qe.name]
+            self._swap(i, smallest)
+            i = smallest
+
+    def _fix(self, i):
+        self._sift_up(i)
+        self._sift_down(i)
+
+    def push(self, qe):
+        """ Adds `qe`, or updates the team's queued entry. A new version
+        replaces the entry; new tests for the same version update it but
+        keep its place in line. """
+        i = self.index.get(qe.name)
+        if i is None:
+            self.queue.append(qe)
+            self.index[qe.name] = len(self.queue) - 1
+            self._sift_up(len(self.queue) - 1)
+            return
+        old = self.queue[i]
+        if qe.version == old.version:
+            if qe.tests == old.tests:
+                # already in queue, don't bother waiting
+                return
+            qe.time = old.time
+        self.queue[i] = qe
+        self._fix(i)
+
+    def get(self, name):
+        i = self.index.get(name)
+        return None if i is None else self.queue[i]
+
+    def remove(self, name):
+        """ Removes and returns the entry for `name` """
+        i = self.index[name]
+        last = len(self.queue) - 1
+        if i != last:
+            self._swap(i, last)
+        qe = self.queue.pop()
+        del self.index[name]
+        if i != last:
+            self._fix(i)
         return qe
 
+    def peek(self):
+        """ Returns the entry pop() would return, without removing it """
+        return self.queue[0]
+
+    def pop(self):
+        return self.remove(self.queue[0].name)
+
     def sorted(self):
-        for qe in sorted(self.queue):
-            if self.names.get(qe.name, None) != qe:
-                continue
-            yield qe
+        """ Yields the entries in order, without sorting the whole queue:
+        getting the first k entries takes O(k log k) """
+        if not self.queue:
+            return
+        frontier = [(self.queue[0]._sortkey, 0)]
+        while frontier:
+            _, i = heappop(frontier)
+            yield self.queue[i]
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(self.queue):
+                    heappush(frontier, (self.queue[child]._sortkey, child))
+
+    def __contains__(self, name):
+        return name in self.index
 
     def __str__(self):
         return '[{}]'.format(', '.join("{}v{} ({})".format(qe.name, qe.version,
                                                            qe.attempts) for qe in self.queue))
 
     def __len__(self):
-        return len(self.names)
+        return len(self.queue)
 
     def __bool__(self):
-        return bool(self.names)
+        return bool(self.queue)
+
 
+class FairShareQueue():
+    """ Weighted fair queuing across the grading queues of several sources.
 
-QUEUE = GradingQueue()
+    Each source has a virtual time that advances by cost / weight for every
+    job taken from it; the next job comes from the waiting source with the
+    smallest virtual time. Within a source, its GradingQueue order is kept.
+    A source that was idle resumes at the current virtual time, so it cannot
+    bank credit while it has nothing to grade.
+    """
+
+    def __init__(self):
+        self.sources = []
+        self.vtime = {}
+        self.virtual = 0
+        self.active = set()
+
+    def add_source(self, source):
+        self.sources.append(source)
+        self.vtime[source.name] = self.virtual
+
+    def cost(self, qe):
+        """ Expected grading time of `qe`, from the test durations recorded
+        for its source """
+        return qe.source.estimate(qe.tests) if qe.source else 1
+
+    def _waiting(self):
+        waiting = [src for src in self.sources if src.queue]
+        for src in waiting:
+            if src.name not in self.active:
+                self.vtime[src.name] = max(self.vtime[src.name], self.virtual)
+        self.active = {src.name for src in waiting}
+        return waiting
+
+    def _next_source(self):
+        waiting = self._waiting()
+        if not waiting:
+            raise IndexError("pop from empty queue")
+        return min(waiting, key=lambda src: self.vtime[src.name])
+
+    def peek(self):
+        return self._next_source().queue.peek()
+
+    def pop(self):
+        src = self._next_source()
+        qe = src.queue.pop()
+        self.virtual = self.vtime[src.name]
+        self.vtime[src.name] += self.cost(qe) / src.weight
+        return qe
+
+    def sorted(self):
+        """ Yields the entries in the order they would be popped, assuming
+        nothing else is queued in the meantime """
+        self._waiting()
+        frontier = []
+        for i, src in enumerate(self.sources):
+            entries = src.queue.sorted()
+            qe = next(entries, None)
+            if qe is not None:
+                heappush(frontier, (self.vtime[src.name], i, qe, entries))
+        while frontier:
+            vtime, i, qe, entries = heappop(frontier)
+            yield qe
+            vtime += self.cost(qe) / self.sources[i].weight
+            qe = next(entries, None)
+            if qe is not None:
+                heappush(frontier, (vtime, i, qe, entries))
+
+    def __str__(self):
+        return ', '.join("{}: {}".format(src.name, src.queue)
+                         for src in self.sources)
+
+    def __len__(self):
+        return sum(len(src.queue) for src in self.sources)
+
+    def __bool__(self):
+        return any(src.queue for src in self.sources)
+
+
+QUEUE = FairShareQueue()
 
 GRADERS = []
 
 
-def dump_queue(queue=QUEUE, output="queue.html"):
-    logging.info("Queue is %s", queue)
-    with open(output, 'w') as outfile:
-        outfile.write('''
-<!DOCTYPE html>
-<html lang="en">
-  <head>
-    <meta charset="utf-8">
-    <meta http-equiv="X-UA-Compatible" content="IE=edge">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <meta http-equiv="refresh" content="60">
-    <title>Autograder Queue</title>
-    <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css" integrity="sha384-BVYiiSIFeK1dGmJRAkycuHAHRg32OmUcww7on3RYdg4Va+PmSTsz/K68vbdEjh4u" crossorigin="anonymous">
-    <script>
-''')
-        outfile.write('''
-      const update_time = new Date({0}, {1}-1, {2}, {3}, {4}, {5});
-'''.format(*datetime.now().timetuple()))
-        outfile.write('''
-      function update() {
-        var now = new Date();
-        var delta = Math.floor((now - update_time)/1000);
-        var html = '';
-        if (delta > 60) {
-          if (delta > 3600) {
-            html = Math.floor(delta/3600) + " hours, ";
-          }
-          html += Math.floor(delta/60) % 60 + " minutes, ";
-        }
-        html += delta % 60 + " seconds ago";
-        document.getElementById('ago').innerHTML = html;
-      }
-      setInterval(update, 1000);
-      update();
-
-      </script>
-''')
-
-        outfile.write('''
-</head>
-<body>
-  <div class="container">
-  <h1>Autograder Queue</h1>
-
-  <p>Last updated: {}, <span id="ago"></p>
-
-  <table class="table">
-  <thead>
-      <tr>
-          <th>Team</th>
-          <th>Version</th>
-          <th>Test to run</th>
-          <th>Waiting since</th>
-          <th>Total attempts</th>
-     </tr>
-   </thead>
-   <tbody>
-'''.format(datetime.now().ctime()))
+def _status_row(qe, started=None):
+    source = qe.source.name if len(QUEUE.sources) > 1 and qe.source else None
+    return Row(qe.name, source, qe.version, list(qe.tests), qe.time,
+               qe.attempts, started)
+
+
+def _status_rows():
+    return ([_status_row(g.qe, g.start_time) for g in GRADERS],
+            [_status_row(qe) for qe in QUEUE.sorted()])
+
+
+STATUS = QueueStatus(_status_rows)
+
+
+def dump_queue():
+    """ Marks the queue status as changed; the main loop writes it out """
+    STATUS.changed()
+    WAKEUP.set()
+
+
+def flush_status(force=False):
+    with STATE_LOCK:
+        if STATUS.flush(force):
+            logging.info("Queue is %s", QUEUE)
+            logging.info("Scheduler: %s", SCHEDULER)
 
-        for g in GRADERS:
-            outfile.write('''
-        <tr class="info">
-            <td>{}<br><small>Started @ {}</small></td>
-            <td>{}</td>
-            <td>{}</td>
-            <td>{}</td>
-            <td>{}</td>
-        </tr>
-'''.format(g.qe.name, g.start_time.strftime("%H:%M"), g.qe.version, g.qe.tests and
-                ', '.join(g.qe.tests) or "all", g.qe.time.strftime("%H:%M"), g.qe.attempts))
-
-        entries = list(queue.sorted())
-        for qe in entries:
-            outfile.write('''
-        <tr>
-            <td>{}</td>
-            <td>{}</td>
-            <td>{}</td>
-            <td>{}</td>
-            <td>{}</td>
-        </tr>
-'''.format(qe.name, qe.version, qe.tests and ', '.join(qe.tests) or "all", qe.time.strftime("%H:%M"), qe.attempts))
-
-        outfile.write('''
-    </tbody>
-</table>
-</div>
-</body>
-</html>
-''')
-
-
-GRADED = None   # make sure it's a global variable
 
 OUTFILE = "GRADING_OUTPUTv1"
 STOPFILE = Path("STOP_AUTOGRADER")
 
 
-def scan_dir(svn_dir, version_pat):
-    for version_filename in svn_dir.glob(version_pat):
-        if not version_filename.is_file():
-            log.error("{} not a file!".format(str(version_filename)))
-            continue
-        tests = []
-        with version_filename.open() as version_file:
+# svn update output: status columns, then the path
+SVN_UPDATE_LINE = re.compile(r'^[ADUCGERB ]{2,4}\s(\S.*)$')
+
+
+def parse_svn_update(out):
+    """ Returns the set of paths reported as changed by `svn update` """
+    if isinstance(out, bytes):
+        out = out.decode(errors='replace')
+    changed = set()
+    for line in out.splitlines():
+        m = SVN_UPDATE_LINE.match(line)
+        if m:
+            changed.add(Path(m.group(1).strip()))
+    return changed
+
+
+class VersionIndex:
+    """ Caches the parsed contents of VERSION files, keyed by path and
+    validated by mtime and size, so that unchanged files are not reopened """
+
+    def __init__(self):
+        self.entries = {}
+
+    def read(self, path):
+        """ Returns (version, tests, changed) for `path`; raises ValueError
+        if the file is malformed """
+        st = path.stat()
+        key = (st.st_mtime_ns, st.st_size)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == key:
+            return entry[1], list(entry[2]), False
+        with path.open() as version_file:
+            version_line = version_file.readline().strip().split()
+        try:
+            version = int(version_line[0])
+        except (IndexError, ValueError):
+            self.entries.pop(path, None)
+            raise ValueError(version_line)
+        tests = version_line[1:]
+        self.entries[path] = (key, version, tests)
+        return version, list(tests), True
+
+
+# how long test image IDs are cached for fingerprints
+IMAGE_ID_TTL = 60
+# the images a grade depends on by default, by task (see config.container_name)
+MEMO_TASKS = ("compile", "test")
+# cost of a job before any test durations have been recorded
+DEFAULT_JOB_SECONDS = 60
+# weight of the newest observation in the test duration averages
+DURATION_WEIGHT = 0.3
+
+
+class Source:
+    """ A directory of submissions for one MP, with its own grading queue,
+    attempts store and grading script. Several sources can share a watcher,
+    which divides its capacity between them by `weight`. """
+
+    def __init__(self, name, svn_dir, version_pat, attempts_file, weight=1,
+                 script="run_tests.py", memoize=False, include=None,
+                 images=()):
+        """ With `memoize`, a submission whose files matching `include`
+        (all files by default) are unchanged since a previous grade reuses
+        that grade's results, as long as the grading script and the test
+        `images` are unchanged too. """
+        self.name = name
+        self.svn_dir = Path(svn_dir)
+        self.version_pat = version_pat
+        self.attempts_file = attempts_file
+        self.attempts = None    # AttemptsStore, see open()
+        self.weight = weight
+        self.script = script
+        self.queue = GradingQueue()
+        self.version_index = VersionIndex()
+        # VERSION files that need another look even if they have not
+        # changed, because their team was being graded when last scanned
+        self.rescan = set()
+        self.last_full_scan = None
+        # test -> moving average of its grading time in seconds
+        self.durations = {}
+        self.memoize = memoize
+        self.include = include
+        self.images = images
+        self.fingerprints = FingerprintCache()
+        self._image_ids = None
+        self._image_ids_time = None
+
+    def open(self, legacy_attempts_file=None):
+        """ Opens the attempts store, importing the shelve kept by older
+        versions of watch.py if the store is new """
+        new_store = not Path(self.attempts_file).exists()
+        self.attempts = AttemptsStore(self.attempts_file)
+        if new_store and legacy_attempts_file:
             try:
-                version_line = version_file.readline().strip().split()
-                version = int(version_line[0])
-                if len(version_line) > 1:
-                    tests = version_line[1:]
-            except Exception as e:
-                log.error("Incorrect version format: %s (%s)", version_line, ve.args)
+                with shelve.open(legacy_attempts_file, flag='r') as db:
+                    log.info("Importing attempts from %s", legacy_attempts_file)
+                    self.attempts.import_graded(db.get("attempts", {}))
+            except dbm.error:
+                pass
+        for attempt in sorted((a for versions in self.attempts.teams.values()
+                               for a in versions.values()),
+                              key=lambda a: a.time):
+            self.record_durations(attempt.result)
+
+    def record_durations(self, result):
+        for test, r in ((result or {}).get("results") or {}).items():
+            if r.get("skipped"):
                 continue
+            prev = self.durations.get(test)
+            self.durations[test] = r["seconds"] if prev is None else \
+                (1 - DURATION_WEIGHT) * prev + DURATION_WEIGHT * r["seconds"]
+
+    def image_ids(self):
+        """ IDs of the test images, looked up at most every IMAGE_ID_TTL
+        seconds """
+        if not self.images:
+            return []
+        now = time.time()
+        if self._image_ids is None or now - self._image_ids_time > IMAGE_ID_TTL:
+            from dockergrader import config
+            from docker.errors import NotFound
+            ids = []
+            for image in self.images:
+                try:
+                    ids.append(config.docker.inspect_image(image)["Id"])
+                except NotFound:
+                    # e.g. an MP without a compile step
+                    ids.append("missing " + image)
+            self._image_ids = ids
+            self._image_ids_time = now
+        return self._image_ids
+
+    def fingerprint(self, parent):
+        """ Identifies what a grade of the submission in `parent` depends
+        on: its files, the grading script and the test images """
+        extra = ["script " + self.fingerprints.digest(self.script)] + \
+            ["image " + image_id for image_id in self.image_ids()]
+        return self.fingerprints.fingerprint(parent, self.include,
+                                             extra=extra)
+
+    def estimate(self, tests):
+        """ Expected grading time in seconds for `tests` (all if empty) """
+        if not self.durations:
+            return DEFAULT_JOB_SECONDS
+        if not tests:
+            return sum(self.durations.values())
+        default = sum(self.durations.values()) / len(self.durations)
+        return sum(self.durations.get(test, default) for test in tests)
+
+    def __str__(self):
+        return self.name
+
+
+def mp_images(mp):
+    """ The images an MP is graded with, for sources that don't list their
+    test images """
+    from dockergrader import config
+    return [config.container_name(mp, task) for task in MEMO_TASKS]
+
+
+def load_sources(path):
+    """ Reads the sources to grade from a JSON file like
+    [{"name": "cs438-mp1", "svn_dir": "svn", "mp": "mp1", "weight": 2}]
+
+    "version_pattern" may be given instead of "mp"; "attempts" (default
+    attempts-<name>.jsonl) and "script" (default run_tests.py) are optional.
+    "memoize": true reuses results for unchanged submissions (see Source),
+    with optional "include" patterns and test "images" (by default the
+    MP's compile and test images).
+    """
+    with open(path) as f:
+        config = json.load(f)
+    sources = []
+    for c in config:
+        version_pat = c.get("version_pattern") or \
+            "*/{}/VERSION".format(c["mp"])
+        attempts = c.get("attempts", "attempts-{}.jsonl".format(c["name"]))
+        images = c.get("images")
+        if images is None:
+            images = ()
+            if c.get("memoize") and "mp" in c:
+                images = mp_images(c["mp"])
+            elif c.get("memoize"):
+                log.warning("Source %s memoizes without test images; set "
+                            "\"images\" so that rebuilt images are noticed",
+                            c["name"])
+        sources.append(Source(c["name"], c["svn_dir"], version_pat,
+                              attempts, weight=c.get("weight", 1),
+                              script=c.get("script", "run_tests.py"),
+                              memoize=c.get("memoize", False),
+                              include=c.get("include"),
+                              images=images))
+    return sources
+
+
+SOURCES = []
+
+
+def scan_dir(source, changed=None):
+    """ Queues submissions with new versions. If `changed` is given, only
+    those paths (e.g. from parse_svn_update) are considered; otherwise the
+    whole directory is scanned. Either way, VERSION files that have not
+    changed since the last scan are skipped without being reopened. """
+    if changed is None:
+        candidates = set(source.svn_dir.glob(source.version_pat))
+    else:
+        candidates = {p for p in changed if p.match(source.version_pat)}
+    candidates |= source.rescan
+    queued = False
+    for version_filename in sorted(candidates):
+        rescan = version_filename in source.rescan
+        source.rescan.discard(version_filename)
+        if not version_filename.is_file():
+            if version_filename.exists():
+                log.error("{} not a file!".format(str(version_filename)))
+            continue
+        try:
+            version, tests, modified = source.version_index.read(version_filename)
+        except ValueError as e:
+            log.error("Incorrect version format: %s (%s)", version_filename, e.args)
+            continue
+        if not modified and not rescan:
+            continue
         name = version_filename.parts[-3]
-        # for output_path in (version_filename.parent.glob("{}.*".format(OUTFILE))):
-        #     output_name = str(output_path)
-        #     dot = output_name.rfind('.')
-        #     GRADED[name].add(int(output_name[dot+1:]))
-        if name in {g.qe.name for g in GRADERS}:
-        # skip currently graded user
+        if (source.name, name) in {g.qe.key for g in GRADERS}:
+            # skip currently graded user
+            source.rescan.add(version_filename)
             continue
-        if version in GRADED[name]:
+        if source.attempts.has(name, version):
             continue
-        prev_output = version_filename.parent / \
-            "{}.{}".format(OUTFILE, version - 1)
-        if not tests and prev_output.exists():
-            with prev_output.open() as prev_output_file:
-                for l in prev_output_file:
-                    m = re.search(r"Test ([\w_.]+) Failed", l)
-                    if m:
-                        tests.append(m.group(1))
+        if not tests:
+            tests = previous_failures(source, name, version,
+                                      version_filename.parent)
         if tests == ["all"]:
             tests = []
-        attempts = len(GRADED[name])
-        QUEUE.push(QueueEntry(attempts, datetime.now(), version, name,
-                              tests, version_filename.parent))
+        attempts = source.attempts.attempts(name)
+        source.queue.push(QueueEntry(attempts, datetime.now(), version, name,
+                                     tests, version_filename.parent, source))
+        queued = True
+
+    if queued:
+        dump_queue()
+        WAKEUP.set()
+
+def previous_failures(source, name, version, parent):
+    """ The tests that failed in `name`'s previous version, from its
+    recorded results, or from its output for attempts recorded without
+    them """
+    prev = source.attempts.get(name, version - 1)
+    if prev and prev.result and "results" in prev.result:
+        return failed_tests(prev.result["results"])
+    prev_output = parent / "{}.{}".format(OUTFILE, version - 1)
+    if not prev_output.exists():
+        return []
+    with prev_output.open('rb') as prev_output_file:
+        return parse_output(prev_output_file)
+
 
-    dump_queue()
+# hard cap on concurrent graders (-j N); None leaves it to SCHEDULER, which
+# grows up to what the host's CPUs and memory allow
+MAX_THREADS = None
+BUDGETS_FILE = Path("budgets.json")
 
-MAX_THREADS = 6
+SCHEDULER = ResourceScheduler()
+
+# pool of in-process grading workers; None runs a new run_tests.py process
+# for every submission (enable with -w)
+WORKERS = None
 
 
 class Grader(Thread):
@@ -254,37 +584,343 @@ class Grader(Thread):
     def __init__(self, qe):
         super().__init__()
         self.qe = qe
+        self.start_time = datetime.now()
 
     def run(self):
-        self.start_time = datetime.now()
+        try:
+            with TRACER.trace(trace_id(self.qe)):
+                TRACER.record("queue.wait", self.qe.time.timestamp(),
+                              self.start_time.timestamp())
+                with TRACER.span("grade", source=self.qe.source.name,
+                                 team=self.qe.name, version=self.qe.version,
+                                 tests=self.qe.tests):
+                    self.grade()
+        finally:
+            # let the main loop hand out the free slot right away
+            WAKEUP.set()
+
+    def grade(self):
         logging.info("Grading %s version %s tests %s",
                      self.qe.name, self.qe.version, ' '.join(self.qe.tests))
         if "-n" not in sys.argv[1:]:
-            p = Popen(["python3", "run_tests.py", str(self.qe.parent)] +
-                      self.qe.tests, stdout=PIPE)
-            out, _ = p.communicate()
+            fingerprint = memo_fingerprint(self.qe)
+            if fingerprint and reuse_result(self.qe, fingerprint):
+                return
+            out_fn = output_path(self.qe)
+            results = TestResults()
+            with out_fn.open("wb") as outf:
+                # output is written as it arrives, so that tests are timed
+                if WORKERS:
+                    job = WORKERS.submit(self.qe.parent, self.qe.tests,
+                                         self.qe.source.script,
+                                         trace=TRACER.current_trace())
+                    chunks = job
+                else:
+                    p = Popen(["python3", self.qe.source.script, str(self.qe.parent)] +
+                              self.qe.tests, stdout=PIPE,
+                              env=dict(os.environ,
+                                       **{ENV_ID: TRACER.current_trace()}))
+                    chunks = iter(lambda: p.stdout.read1(OUTPUT_CHUNK_SIZE), b'')
+                for chunk in chunks:
+                    outf.write(chunk)
+                    results.feed(chunk)
+                returncode = job.returncode if WORKERS else p.wait()
+            record_result(self.qe, out_fn, returncode, results.close(),
+                          fingerprint=fingerprint)
 
-            GRADED[self.qe.name].add(self.qe.version)
 
-            out_fn = self.qe.parent / "{}.{}".format(OUTFILE, self.qe.version)
-            if out_fn.exists():
-                logging.warning("Warning, overwriting output file %s", out_fn)
-            with out_fn.open("wb") as outf:
-                outf.write(out)
-            if "-q" not in sys.argv[1:]:    # -q: don't commit
-                with svn_lock:
-                    try:
-                        check_call(["svn", "add", str(out_fn)])
-                        comment = "Autograder output for {} version {}".format(
-                            self.qe.name, self.qe.version)
-                        check_call(["svn", "commit", "-m", comment,
-                                    str(out_fn)], stdin=DEVNULL)
-                    except CalledProcessError:
-                        logging.error(
-                            "Error during svn commit of %s", str(out_fn))
+def memo_fingerprint(qe):
+    """ The submission's fingerprint, if its source memoizes results """
+    if not qe.source.memoize:
+        return None
+    try:
+        with TRACER.span("fingerprint"):
+            return qe.source.fingerprint(qe.parent)
+    except Exception:
+        log.exception("Could not fingerprint %s", qe.parent)
+        return None
+
+
+def previous_grade(source, name, fingerprint, tests):
+    """ The latest attempt by `name` with the same fingerprint that ran
+    all of `tests` (all tests if empty). Only attempts that finished cleanly
+    (exit status 0, with test results) count, so that an infrastructure
+    failure is not reused as the grade. """
+    for attempt in reversed(source.attempts.history(name)):
+        result = attempt.result or {}
+        if result.get("fingerprint") != fingerprint or \
+                result.get("returncode") != 0 or not result.get("results"):
+            continue
+        if not result["tests"] or (tests and
+                                   set(tests) <= set(result["tests"])):
+            return attempt
+    return None
+
+
+def reuse_result(qe, fingerprint):
+    """ Writes the output of an earlier grade of an identical submission
+    as this version's output; returns False if there is none to reuse """
+    prev = previous_grade(qe.source, qe.name, fingerprint, qe.tests)
+    if prev is None:
+        return False
+    prev_output = qe.parent / "{}.{}".format(OUTFILE, prev.version)
+    if not prev_output.exists():
+        return False
+    logging.info("Reusing results of %s version %s for version %s",
+                 qe.name, prev.version, qe.version)
+    out_fn = output_path(qe)
+    with out_fn.open("wb") as outf:
+        outf.write("Submission unchanged since version {}; results "
+                   "reused.\n\n".format(prev.version).encode())
+        with prev_output.open("rb") as prev_file:
+            shutil.copyfileobj(prev_file, outf)
+    results = prev.result.get("results")
+    if results and qe.tests:
+        results = {t: r for t, r in results.items() if t in qe.tests}
+    record_result(qe, out_fn, prev.result["returncode"], results,
+                  fingerprint=fingerprint, reused=prev.version)
+    return True
+
+
+def trace_id(qe):
+    return "{}/{}/{}".format(qe.source.name, qe.name, qe.version)
+
+
+def output_path(qe):
+    out_fn = qe.parent / "{}.{}".format(OUTFILE, qe.version)
+    if out_fn.exists():
+        logging.warning("Warning, overwriting output file %s", out_fn)
+    return out_fn
+
+
+OUTPUT_CHUNK_SIZE = 1 << 16
+
+
+def record_result(qe, out_fn, returncode, results, fingerprint=None,
+                  reused=None):
+    """ Records a finished attempt with its per-test `results` and hands
+    its output to the committer. `reused` is the version whose results were
+    reused, if any. """
+    result = {"returncode": returncode, "tests": qe.tests, "results": results}
+    if fingerprint:
+        result["fingerprint"] = fingerprint
+    if reused is not None:
+        result["reused"] = reused
+    qe.source.attempts.add(qe.name, qe.version, result=result)
+    if reused is None:
+        with STATE_LOCK:
+            qe.source.record_durations(result)
+    if COMMITTER:
+        COMMITTER.submit(out_fn, "Autograder output for {} version {}".format(
+            qe.name, qe.version), qe.source.svn_dir)
+
+
+# coordinator for remote workers (enable with -d HOST:PORT); None grades
+# locally
+COORDINATOR = None
+REMOTE_JOBS = {}
+_remote_ids = count()
+
+
+class RemoteGrader:
+    """ Stands in for a Grader in GRADERS while a remote worker grades the
+    submission (see dockergrader.distributed) """
+
+    def __init__(self, qe, fingerprint=None):
+        self.qe = qe
+        self.fingerprint = fingerprint
+        self.id = next(_remote_ids)
+        self.start_time = datetime.now()
+        self.done = Event()
+        self.outf = None
+        self.out_fn = None
+        self.results = TestResults()
+        if "-n" not in sys.argv[1:]:
+            self.out_fn = output_path(qe)
+            self.outf = self.out_fn.open("wb")
+
+    def job(self):
+        return {"name": self.qe.name, "version": self.qe.version,
+                "tests": self.qe.tests, "parent": str(self.qe.parent),
+                "trace": trace_id(self.qe),
+                "script": self.qe.source.script,
+                "fail_fast": fail_fast_mode(),
+                "archive": pack_submission(str(self.qe.parent))}
+
+    def output(self, chunk):
+        if self.outf:
+            self.outf.write(chunk)
+            self.results.feed(chunk)
+
+    def finish(self, returncode=None):
+        if self.outf:
+            self.outf.close()
+            if returncode is not None:
+                record_result(self.qe, self.out_fn, returncode,
+                              self.results.close(),
+                              fingerprint=self.fingerprint)
+        self.done.set()
+        WAKEUP.set()
+
+    def is_alive(self):
+        return not self.done.is_set()
+
+    def join(self):
+        self.done.wait()
+
+
+def take_remote_job():
+    with STATE_LOCK:
+        while True:
+            if STOPPING.is_set() or not QUEUE:
+                return None
+            qe = QUEUE.pop()
+            dump_queue()
+            fingerprint = None
+            if "-n" not in sys.argv[1:]:
+                fingerprint = memo_fingerprint(qe)
+            # reused under the lock, so that scan_dir does not queue the
+            # version again in the meantime
+            if not (fingerprint and reuse_result(qe, fingerprint)):
+                break
+        g = RemoteGrader(qe, fingerprint)
+        GRADERS.append(g)
+        REMOTE_JOBS[g.id] = g
+    logging.info("Grading %s version %s tests %s remotely", g.qe.name,
+                 g.qe.version, ' '.join(g.qe.tests))
+    with TRACER.trace(trace_id(g.qe)):
+        TRACER.record("queue.wait", g.qe.time.timestamp(),
+                      g.start_time.timestamp())
+    try:
+        return g.id, g.job()
+    except Exception:
+        requeue_remote_job(g.id)
+        raise
+
+
+def remote_job_output(job_id, chunk):
+    REMOTE_JOBS[job_id].output(chunk)
+
+
+def remote_job_done(job_id, returncode):
+    REMOTE_JOBS.pop(job_id).finish(returncode)
+
+
+def requeue_remote_job(job_id):
+    g = REMOTE_JOBS.pop(job_id)
+    g.finish()
+    with STATE_LOCK:
+        g.qe.source.queue.push(g.qe)
+        dump_queue()
+
+
+# seconds to gather finished outputs into one commit
+COMMIT_WINDOW = 2
+COMMIT_RETRIES = 3
+
+
+CommitItem = namedtuple('CommitItem', ['path', 'comment', 'submitted', 'trace',
+                                       'working_copy'])
+
+
+class Committer(Thread):
+    """ Commits grading outputs in the background. Outputs that finish
+    within COMMIT_WINDOW of each other are committed together, one commit
+    per working copy, so that graders never wait for svn. The svn lock is
+    held for each svn command only, so that svn update is not blocked while
+    a commit is retried. """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.pending = Queue()
+
+    def submit(self, path, comment, working_copy=None):
+        """ Queues `path` to be committed in the svn working copy
+        `working_copy` """
+        self.pending.put(CommitItem(path, comment, time.time(),
+                                    TRACER.current_trace(), working_copy))
+
+    def run(self):
+        done = False
+        while not done:
+            item = self.pending.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.time() + COMMIT_WINDOW
+            while time.time() < deadline:
+                try:
+                    item = self.pending.get(timeout=deadline - time.time())
+                except Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            # a single svn commit cannot span working copies
+            by_working_copy = OrderedDict()
+            for item in batch:
+                by_working_copy.setdefault(item.working_copy, []).append(item)
+            for items in by_working_copy.values():
+                if not self.commit(items) and len(items) > 1:
+                    # don't let one bad output hold up the others
+                    for item in items:
+                        self.commit([item])
+
+    def _svn(self, args, check=True):
+        """ Runs an svn command while holding the svn lock """
+        with TRACER.span("svn.lock_wait"):
+            svn_lock.acquire()
+        try:
+            if check:
+                check_call(args, stdin=DEVNULL)
+            else:
+                call(args, stdin=DEVNULL)
+        finally:
+            svn_lock.release()
+
+    def commit(self, batch):
+        paths = [str(item.path) for item in batch]
+        if len(batch) == 1:
+            message = batch[0].comment
+        else:
+            message = "Autograder output for {} submissions\n\n{}".format(
+                len(batch), '\n'.join(item.comment for item in batch))
+        for attempt in range(COMMIT_RETRIES):
+            try:
+                with TRACER.span("commit", outputs=len(batch)):
+                    self._svn(["svn", "add", "--force"] + paths)
+                    self._svn(["svn", "commit", "-m", message] + paths)
+                logging.info("Committed %d outputs", len(batch))
+                now = time.time()
+                for item in batch:
+                    with TRACER.trace(item.trace):
+                        TRACER.record("commit.latency", item.submitted, now)
+                return True
+            except CalledProcessError:
+                logging.warning("Error during svn commit of %s (attempt %d)",
+                                ', '.join(paths), attempt + 1)
+                # bring the outputs up to date, keeping our version
+                self._svn(["svn", "update", "--accept", "mine-full"] + paths,
+                          check=False)
+            time.sleep(2 ** attempt)
+        logging.error("Error during svn commit of %s", ', '.join(paths))
+        return False
+
+    def close(self):
+        """ Commits whatever is pending and stops """
+        self.pending.put(None)
+        self.join()
+
+
+# None if outputs should not be committed (-q)
+COMMITTER = None
 
 
 SVN_UPDATE_INTERVAL = 15
+# scan the whole tree every so often, in case something changed outside of
+# svn update
+FULL_SCAN_INTERVAL = 600
 last_svn_update = None
 def svn_update():
     global last_svn_update
@@ -292,42 +928,111 @@ def svn_update():
         if (datetime.now() - last_svn_update).seconds < SVN_UPDATE_INTERVAL:
             return
     last_svn_update = datetime.now()
-    with svn_lock:
-        try:
-            out = check_output(["svn", "update", str(SVN_DIR)], input=b'')
-            logging.info("Svn update: %s", out)
-        except KeyboardInterrupt:
-            logging.info("Terminating, cleaning up svn")
-            out = check_call(["svn", "cleanup", str(SVN_DIR)])
-            logging.info("Goodbye")
-            sys.exit(0)
-        except CalledProcessError:
-            logging.error("Error during svn update")
+    # sources may share a checkout; update each one once
+    changed = {}
+    for svn_dir in sorted({src.svn_dir for src in SOURCES}):
+        with svn_lock, TRACER.span("svn.update"):
+            try:
+                out = check_output(["svn", "update", str(svn_dir)], input=b'')
+                logging.info("Svn update: %s", out)
+                changed[svn_dir] = parse_svn_update(out)
+            except CalledProcessError:
+                logging.error("Error during svn update of %s", svn_dir)
 
-    scan_dir(SVN_DIR, VERSION_PAT)
+    for src in SOURCES:
+        src_changed = changed.get(src.svn_dir)
+        if src.last_full_scan is None or (datetime.now() -
+                src.last_full_scan).total_seconds() > FULL_SCAN_INTERVAL:
+            src_changed = None
+        if src_changed is None:
+            src.last_full_scan = datetime.now()
+        with STATE_LOCK, TRACER.span("scan", source=src.name,
+                                     full=src_changed is None):
+            scan_dir(src, src_changed)
 
 
-def grade_one():
-    svn_update()
-    # clean up finished graders
+# set whenever the main loop has something to do: a grader finished, a new
+# submission was queued, or it is time to stop
+WAKEUP = Event()
+STOPPING = Event()
+# protects QUEUE and GRADERS, which the watcher thread also looks at
+STATE_LOCK = RLock()
+# the main loop runs at least this often, even if nothing wakes it
+FALLBACK_TICK = 15
+STOP_CHECK_INTERVAL = 1
+
+
+class Watcher(Thread):
+    """ Runs svn updates and watches for the stop file in the background,
+    waking up the main loop when there is news """
+
+    def __init__(self):
+        super().__init__(daemon=True)
+
+    def run(self):
+        while not STOPPING.is_set():
+            if STOPFILE.exists():
+                log.info("Stop file found")
+                STOPPING.set()
+                WAKEUP.set()
+                return
+            try:
+                svn_update()
+            except Exception:
+                log.exception("Error while looking for new submissions")
+            STOPPING.wait(STOP_CHECK_INTERVAL)
+
+
+def reap_test_orphans():
+    """ Cleans up test containers and networks left behind by graders that
+    died, e.g. in a previous run of watch.py """
+    try:
+        from dockergrader.run_tests import reap_orphans
+        reap_orphans()
+    except Exception:
+        log.exception("Could not clean up orphaned test containers")
+
+
+def retry_if_unrecorded(qe):
+    """ Has the next scan queue a submission again if its grade ended
+    without a recorded result, e.g. because the grader crashed; scan_dir
+    would otherwise skip it until its VERSION file changes """
+    if "-n" in sys.argv[1:] or qe.source.attempts.has(qe.name, qe.version):
+        return
+    log.warning("No result recorded for %s version %s; will retry",
+                qe.name, qe.version)
+    qe.source.rescan.add(qe.parent / Path(qe.source.version_pat).name)
+
+
+def drop_finished():
+    """ Releases the slots of finished graders """
     global GRADERS
     if not all(g.is_alive() for g in GRADERS):
+        for g in GRADERS:
+            if not g.is_alive():
+                SCHEDULER.release(g.qe.key)
+                retry_if_unrecorded(g.qe)
         GRADERS = [g for g in GRADERS if g.is_alive()]
         dump_queue()
-    while QUEUE and len(GRADERS) < MAX_THREADS:
+
+
+def grade_one():
+    """ Cleans up finished graders and starts new ones while there is
+    capacity """
+    drop_finished()
+    if COORDINATOR:
+        # remote workers pull their jobs from the coordinator
+        return
+    while QUEUE and (MAX_THREADS is None or len(GRADERS) < MAX_THREADS):
+        qe = QUEUE.peek()
+        if not SCHEDULER.admit(qe.key, qe.tests):
+            break
         qe = QUEUE.pop()
         g = Grader(qe)
         g.start()
         GRADERS.append(g)
         dump_queue()
 
-    if not QUEUE and not GRADERS:
-        # nothing's up, sleep
-        time.sleep(15)
-    else:
-        # prevent spamming anyway
-        time.sleep(1)
-
 
 if __name__ == "__main__":
     sys.stdin.close()
@@ -336,30 +1041,100 @@ if __name__ == "__main__":
     if STOPFILE.exists():
         log.info("Deleting old stop file")
         STOPFILE.unlink()
-    SVN_DIR = Path(sys.argv[1])
-    VERSION_PAT = "*/{}/VERSION".format(sys.argv[2])
-    ATTEMPTS_FILE = "attempts.db"
-    LOCK_FILE = Path(ATTEMPTS_FILE + ".lock")
+    if sys.argv[1] == "-c":
+        # several sources, described in a JSON file
+        SOURCES = load_sources(sys.argv[2])
+        legacy_attempts_file = None
+    else:
+        # -m: reuse results for unchanged submissions graded with the same
+        # images
+        memoize = "-m" in sys.argv[3:]
+        SOURCES = [Source(sys.argv[2], sys.argv[1],
+                          "*/{}/VERSION".format(sys.argv[2]), "attempts.jsonl",
+                          memoize=memoize,
+                          images=mp_images(sys.argv[2]) if memoize else ())]
+        legacy_attempts_file = "attempts.db"
+    if BUDGETS_FILE.exists():
+        SCHEDULER.budgets = load_budgets(str(BUDGETS_FILE))
+    if "-j" in sys.argv[1:]:     # -j N: run at most N graders at once
+        MAX_THREADS = int(sys.argv[sys.argv.index("-j") + 1])
+    if MAX_THREADS:
+        SCHEDULER.max_jobs = MAX_THREADS
+        SCHEDULER.limit = min(SCHEDULER.limit, MAX_THREADS)
+    if "-t" in sys.argv[1:]:     # -t FILE: trace grading phases into FILE
+        trace_file = os.path.abspath(sys.argv[sys.argv.index("-t") + 1])
+        TRACER.open(trace_file)
+        # grading scripts add their spans to the same file
+        os.environ[ENV_FILE] = trace_file
+    if "-f" in sys.argv[1:]:     # -f: grading scripts stop tests early
+        # inherited by the grading scripts and worker processes
+        os.environ[ENV_FAIL_FAST] = "1"
+    if "-q" not in sys.argv[1:]:    # -q: don't commit
+        COMMITTER = Committer()
+        COMMITTER.start()
+    if "-w" in sys.argv[1:]:
+        from dockergrader.workers import WorkerPool
+        WORKERS = WorkerPool(SCHEDULER.max_jobs)
+    if "-d" in sys.argv[1:]:     # -d HOST:PORT: grade on remote workers
+        # workers must present the token from $DOCKERGRADER_TOKEN or
+        # ~/.dockergrader-token (see dockergrader.distributed)
+        COORDINATOR = Coordinator(sys.argv[sys.argv.index("-d") + 1],
+                                  take_remote_job, remote_job_output,
+                                  remote_job_done, requeue_remote_job)
+    if "-s" in sys.argv[1:]:     # -s HOST:PORT: serve the status over HTTP
+        STATUS.serve(sys.argv[sys.argv.index("-s") + 1])
+    lock_files = [Path(src.attempts_file + ".lock") for src in SOURCES]
     try:
-        with LOCK_FILE.open('w') as lock_file:
-            log.info("Acquiring shelf lock")
-            flock(lock_file.fileno(), LOCK_EX)
-            log.info("Shelf lock acquired")
-            with shelve.open(ATTEMPTS_FILE, writeback=True) as db:
-                if "attempts" not in db:
-                    db["attempts"] = defaultdict(set)
-                GRADED = db["attempts"]
-                while True:
+        with ExitStack() as stack:
+            for lock_path in lock_files:
+                lock_file = stack.enter_context(lock_path.open('w'))
+                log.info("Acquiring attempts lock %s", lock_path)
+                flock(lock_file.fileno(), LOCK_EX)
+            log.info("Attempts locks acquired")
+            for src in SOURCES:
+                src.open(legacy_attempts_file)
+                QUEUE.add_source(src)
+            if not COORDINATOR:
+                reap_test_orphans()
+            if COORDINATOR:
+                COORDINATOR.start()
+            Watcher().start()
+            while True:
+                delay = STATUS.delay()
+                WAKEUP.wait(FALLBACK_TICK if delay is None
+                            else min(delay, FALLBACK_TICK))
+                WAKEUP.clear()
+                if STOPPING.is_set():
+                    log.info("Waiting for graders to finish")
+                    for g in GRADERS:
+                        g.join()
+                    if COORDINATOR:
+                        COORDINATOR.close()
+                    if WORKERS:
+                        WORKERS.close()
+                    if COMMITTER:
+                        COMMITTER.close()
+                    with STATE_LOCK:
+                        drop_finished()
+                    flush_status(force=True)
+                    if TRACER.enabled:
+                        log.info("Trace summary (this process):\n%s",
+                                 format_summary(TRACER.summary()))
+                    break
+                with STATE_LOCK:
                     grade_one()
-                    db['attempts'] = GRADED
-                    db.sync()
-                    if STOPFILE.exists():
-                        log.info("Waiting for graders to finish")
-                        for g in GRADERS:
-                            g.join()
-                        db['attempts'] = GRADED
-                        db.sync()
-                        break
+                flush_status()
+            for src in SOURCES:
+                src.attempts.close()
+    except KeyboardInterrupt:
+        logging.info("Terminating, cleaning up svn")
+        STOPPING.set()
+        with svn_lock:
+            for svn_dir in {src.svn_dir for src in SOURCES}:
+                check_call(["svn", "cleanup", str(svn_dir)])
+        logging.info("Goodbye")
     finally:
-        log.info("Releasing lock")
-        LOCK_FILE.unlink()
+        log.info("Releasing locks")
+        for lock_path in lock_files:
+            if lock_path.exists():
+                lock_path.unlink()
@@ -0,0 +1,269 @@
+""" Long-lived worker processes that run the grading script in-process.
+
+Each worker imports the script's dependencies (docker-py, the dockergrader
+package and its docker.Client) once and then runs the script for job after
+job with runpy, so grading a submission does not pay for interpreter start-up
+and connection set-up. Everything the script writes to file descriptor 1,
+including the output of its subprocesses, is streamed back to the parent. """
+from collections import namedtuple
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import runpy
+import sys
+import threading
+import time
+import traceback
+
+from .stage import unstage_all
+from .trace import TRACER
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 16
+# how often the dispatcher checks that the workers are alive, in seconds
+CHECK_INTERVAL = 1
+# after this many workers in a row die before they are ready (e.g. the docker
+# daemon is unreachable), queued jobs are failed instead of left waiting
+MAX_STARTUP_FAILURES = 3
+# a worker that died before it was ready is respawned after this many
+# seconds, doubling with every further failure up to RESPAWN_MAX_DELAY
+RESPAWN_DELAY = 1
+RESPAWN_MAX_DELAY = 60
+
+WorkItem = namedtuple('WorkItem', ['id', 'script', 'args', 'trace'])
+
+
+class Job:
+    """ Handle for a submitted job. Iterating over it yields the output as
+    it arrives; `returncode` is set once the job is finished. """
+
+    def __init__(self, job_id):
+        self.id = job_id
+        self.chunks = queue.Queue()
+        self.returncode = None
+        self.finished = threading.Event()
+
+    def _output(self, chunk):
+        self.chunks.put(chunk)
+
+    def _finish(self, returncode):
+        self.returncode = returncode
+        self.finished.set()
+        self.chunks.put(None)
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        return self.returncode
+
+    def output(self):
+        return b''.join(self)
+
+
+def _exit_code(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+def _run(item, results):
+    """ Runs one job, redirecting fd 1 into a pipe that is forwarded to
+    `results` """
+    sys.stdout.flush()
+    saved_stdout = os.dup(1)
+    r, w = os.pipe()
+    os.dup2(w, 1)
+    os.close(w)
+
+    def forward():
+        while True:
+            chunk = os.read(r, CHUNK_SIZE)
+            if not chunk:
+                break
+            results.put((item.id, "output", chunk))
+    forwarder = threading.Thread(target=forward, daemon=True)
+    forwarder.start()
+
+    saved_argv = sys.argv
+    saved_path = list(sys.path)
+    sys.argv = [item.script] + list(item.args)
+    # as with `python3 script`, the script can import modules next to it
+    sys.path.insert(0, os.path.dirname(os.path.abspath(item.script)))
+    TRACER.trace_id = item.trace
+    try:
+        runpy.run_path(item.script, run_name="__main__")
+        code = 0
+    except SystemExit as e:
+        code = _exit_code(e)
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    finally:
+        # overlay mounts the script left for the tests to use; the worker
+        # outlives the job, so its exit is too late
+        unstage_all()
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+        sys.stdout.flush()
+        os.dup2(saved_stdout, 1)
+        os.close(saved_stdout)
+        forwarder.join()
+        os.close(r)
+    results.put((item.id, "done", code))
+
+
+def _worker_main(index, jobs, results):
+    # import the harness and create the docker client once per worker
+    try:
+        import dockergrader.config  # noqa: F401
+    except Exception:
+        results.put((None, "failed", (index, traceback.format_exc())))
+        sys.exit(1)
+    results.put((None, "ready", index))
+    while True:
+        item = jobs.get()
+        if item is None:
+            return
+        results.put((item.id, "start", index))
+        _run(item, results)
+
+
+class WorkerPool:
+    """ A pool of `size` worker processes running `script` (by default the
+    run_tests.py in the current directory) """
+
+    def __init__(self, size, script="run_tests.py", context="spawn"):
+        self.script = script
+        self.ctx = multiprocessing.get_context(context)
+        self.jobs = self.ctx.Queue()
+        self.results = self.ctx.Queue()
+        self.ids = itertools.count()
+        self.pending = {}   # job id -> Job
+        self.running = {}   # worker index -> job id
+        self.lock = threading.Lock()
+        self.closed = False
+        self.ready = [False] * size
+        self.respawn_at = [None] * size
+        self.startup_failures = 0   # workers in a row that died unready
+        self.startup_error = None
+        self.workers = [self._spawn(i) for i in range(size)]
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def _spawn(self, index):
+        self.ready[index] = False
+        p = self.ctx.Process(target=_worker_main,
+                             args=(index, self.jobs, self.results),
+                             daemon=True)
+        p.start()
+        return p
+
+    def submit(self, parent, tests, script=None, trace=None):
+        """ Queues a grading job, equivalent to running
+        `python3 run_tests.py parent tests...`; its spans go to `trace` """
+        job = Job(next(self.ids))
+        with self.lock:
+            self.pending[job.id] = job
+        self.jobs.put(WorkItem(job.id, script or self.script,
+                               [str(parent)] + list(tests), trace))
+        return job
+
+    def _dispatch(self):
+        last_check = time.time()
+        while not (self.closed and not self.pending):
+            # checked on a timer, since busy workers may keep the results
+            # queue from ever running dry
+            if time.time() - last_check >= CHECK_INTERVAL:
+                self._check_workers()
+                last_check = time.time()
+            try:
+                job_id, kind, data = self.results.get(timeout=CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            if kind == "ready":
+                self.ready[data] = True
+                self.startup_failures = 0
+                continue
+            if kind == "failed":
+                index, self.startup_error = data
+                log.error("Grading worker %d could not start:\n%s", index,
+                          self.startup_error)
+                continue
+            with self.lock:
+                job = self.pending.get(job_id)
+            if job is None:
+                continue
+            if kind == "start":
+                with self.lock:
+                    self.running[data] = job_id
+            elif kind == "output":
+                job._output(data)
+            elif kind == "done":
+                with self.lock:
+                    del self.pending[job_id]
+                    self.running = {w: j for w, j in self.running.items()
+                                    if j != job_id}
+                job._finish(data)
+
+    def _check_workers(self):
+        now = time.time()
+        for i, p in enumerate(self.workers):
+            if p.is_alive() or self.closed:
+                continue
+            if self.respawn_at[i] is None:
+                log.error("Grading worker %d died with exit code %s", i,
+                          p.exitcode)
+                with self.lock:
+                    job = self.pending.pop(self.running.pop(i, None), None)
+                if job is not None:
+                    job._output("Grading worker died with exit code {}\n"
+                                .format(p.exitcode).encode())
+                    job._finish(-1)
+                delay = 0
+                if not self.ready[i]:
+                    self.startup_failures += 1
+                    delay = min(RESPAWN_MAX_DELAY, RESPAWN_DELAY *
+                                2 ** (self.startup_failures - 1))
+                self.respawn_at[i] = now + delay
+            if now >= self.respawn_at[i]:
+                self.respawn_at[i] = None
+                self.workers[i] = self._spawn(i)
+        if self.startup_failures >= MAX_STARTUP_FAILURES:
+            self._fail_queued()
+
+    def _fail_queued(self):
+        """ Fails the jobs no worker has taken, since none can start """
+        while True:
+            try:
+                item = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:    # closing
+                self.jobs.put(None)
+                break
+            with self.lock:
+                job = self.pending.pop(item.id, None)
+            if job is not None:
+                job._output("No grading worker could start:\n{}".format(
+                    self.startup_error or "").encode())
+                job._finish(-1)
+
+    def close(self):
+        """ Lets the workers finish their current jobs and stops them """
+        self.closed = True
+        for _ in self.workers:
+            self.jobs.put(None)
+        for p in self.workers:
+            p.join()
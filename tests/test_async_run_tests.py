@@ -0,0 +1,68 @@
+import unittest
+import asyncio
+import dockergrader.async_run_tests
+import dockergrader.config
+
+
+class TestAsyncRunTests(unittest.TestCase):
+    def run_async(self, coro):
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def test_many_testcases(self):
+        containers_before = dockergrader.config.docker.containers(all=True, quiet=True)
+
+        async def body(test):
+            await test.add_command(image="ubuntu", command='bash -c "echo {}"'.format(
+                test.testcase_name), name="echo")
+            await test.add_command(image="ubuntu", command="false", name="false")
+            await test.run_commands(delay=0)
+            return (await test.logs("echo"), test.containers["false"]["StatusCode"])
+
+        async def main():
+            return await asyncio.gather(*[
+                dockergrader.async_run_tests.run_testcase("async{}".format(i), body)
+                for i in range(5)])
+
+        results = self.run_async(main())
+        for i, (logs, status) in enumerate(results):
+            assert logs.startswith("async{}".format(i).encode())
+            assert status == 1
+        # no waiters are left behind for containers that have exited
+        assert not dockergrader.async_run_tests.EXIT_EVENTS.waiters
+
+        containers_after = dockergrader.config.docker.containers(all=True, quiet=True)
+        assert containers_before == containers_after
+
+    def test_timeout_cleans_up(self):
+        containers_before = dockergrader.config.docker.containers(all=True, quiet=True)
+
+        async def body(test):
+            await test.add_command(image="ubuntu", command="sleep 60", name="sleep")
+            await test.run_commands()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_async(dockergrader.async_run_tests.run_testcase(
+                "async_timeout", body, timeout=5))
+
+        containers_after = dockergrader.config.docker.containers(all=True, quiet=True)
+        assert containers_before == containers_after
+
+
+    def test_cancel_during_create(self):
+        containers_before = dockergrader.config.docker.containers(all=True, quiet=True)
+
+        async def body(test):
+            for i in range(3):
+                await test.add_command(image="ubuntu", command="true")
+
+        # cancelled while a create_container call is in flight
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_async(dockergrader.async_run_tests.run_testcase(
+                "async_cancel", body, timeout=0.01))
+
+        containers_after = dockergrader.config.docker.containers(all=True, quiet=True)
+        assert containers_before == containers_after
+
+
+if __name__ == "__main__":
+    unittest.main()
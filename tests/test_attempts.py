@@ -0,0 +1,65 @@
+from dockergrader.attempts import AttemptsStore
+import os
+
+
+def test_attempts_store(tmpdir):
+    path = str(tmpdir.join("attempts.jsonl"))
+    store = AttemptsStore(path)
+    store.add("team1", 1, result={"returncode": 0})
+    store.add("team1", 2)
+    store.add("team2", 1)
+    assert store.has("team1", 2)
+    assert not store.has("team2", 2)
+    assert not store.has("team3", 1)
+    assert store.attempts("team1") == 2
+    assert store.attempts("team3") == 0
+    store.close()
+
+    store = AttemptsStore(path)
+    assert store.versions("team1") == {1, 2}
+    assert [a.version for a in store.history("team1")] == [1, 2]
+    assert store.get("team1", 1).result == {"returncode": 0}
+    assert len(store) == 3
+    store.close()
+
+
+def test_attempts_store_damaged(tmpdir):
+    path = str(tmpdir.join("attempts.jsonl"))
+    store = AttemptsStore(path)
+    store.add("team1", 1)
+    store.close()
+    size = os.path.getsize(path)
+    with open(path, 'a') as f:
+        f.write('{"team": "team1", "vers')   # crash in the middle of a write
+
+    store = AttemptsStore(path)
+    assert os.path.getsize(path) == size
+    assert store.versions("team1") == {1}
+    store.add("team1", 2)
+    store.close()
+    assert AttemptsStore(path).versions("team1") == {1, 2}
+
+
+def test_attempts_store_bad_lines(tmpdir):
+    path = str(tmpdir.join("attempts.jsonl"))
+    store = AttemptsStore(path)
+    store.add("team1", 1)
+    store.close()
+    with open(path, 'a') as f:
+        f.write('not json\n')
+        f.write('{"team": "team1", "version": 2}\n')    # no time
+        f.write('[1, 2]\n')
+    store = AttemptsStore(path)
+    store.add("team1", 3)
+    store.close()
+
+    store = AttemptsStore(path)
+    assert store.versions("team1") == {1, 3}
+    store.close()
+
+
+def test_import_graded(tmpdir):
+    store = AttemptsStore(str(tmpdir.join("attempts.jsonl")))
+    store.import_graded({"team1": {1, 2}, "team2": set()})
+    assert store.versions("team1") == {1, 2}
+    assert store.attempts("team2") == 0
@@ -0,0 +1,30 @@
+from benchmarks import svn_tree
+from benchmarks.fake_docker import FakeClient
+
+
+def test_svn_tree(tmpdir):
+    versions = svn_tree.generate(str(tmpdir), 20, max_version=3)
+    assert len(versions) == 20
+    assert all(1 <= int(v.read_text()) <= 3 for v in versions)
+    assert (versions[0].parent / "Makefile").exists()
+    before = {v: int(v.read_text()) for v in versions}
+    changed = svn_tree.bump(versions, 0.25, tests=["t1"])
+    assert len(changed) == 5
+    for v in changed:
+        assert v.read_text() == "{} t1\n".format(before[v] + 1)
+
+
+def test_fake_client():
+    client = FakeClient(latencies=dict.fromkeys(FakeClient().latencies, 0),
+                        output=b"hello\n")
+    client.latencies["run"] = 0.1
+    c = client.create_container("ubuntu", "false", name="c")
+    client.start(c["Id"])
+    assert client.inspect_container(c["Id"])["State"]["Running"]
+    assert b''.join(client.logs(c["Id"], stream=True, follow=True)) == \
+        b"hello\n"
+    assert client.wait(c["Id"]) == 1
+    assert not client.inspect_container(c["Id"])["State"]["Running"]
+    client.remove_container(c["Id"], force=True)
+    assert not client.containers(all=True)
+    assert client.calls["create_container"] == 1
@@ -5,6 +5,9 @@ from subprocess import check_output
 import unittest
 import hashlib
 import re
+import json
+import tarfile
+import io
 
 
 class BuildTestCase(unittest.TestCase):
@@ -32,6 +35,62 @@ COPY ./b /b
         assert re.match(pat, output.decode())
         dockergrader.config.docker.remove_image(image)
 
+    def test_build_cache(self):
+        mypath = Path(__file__).parent
+        dockerfile_str = """
+FROM alpine
+COPY ./Makefile /Makefile
+    """
+        cache = dockergrader.build.BuildCache()
+        image = dockergrader.build.build_custom_image(
+            dockerfile_str, mypath / 'goodmake', cache=cache)
+        assert (cache.hits, cache.misses) == (0, 1)
+        again = dockergrader.build.build_custom_image(
+            dockerfile_str, mypath / 'goodmake', cache=cache)
+        assert again == image
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        dockergrader.config.docker.remove_image(image)
+        assert cache.evict() == 1
+        assert len(cache) == 0
+
+    def test_parse_build_output(self):
+        records = [{"stream": "Step 1 : FROM alpine\n"},
+                   {"stream": "Successfully built 0123abcd\n"}]
+        data = ''.join(json.dumps(r) + "\r\n" for r in records).encode()
+        # split records at arbitrary chunk boundaries
+        chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+        lines = []
+        image = dockergrader.build._parse_build_output(chunks, lines.append)
+        assert image == "0123abcd"
+        assert lines == [r["stream"] for r in records]
+
+    def test_parse_build_error(self):
+        def stream():
+            for i in range(100):
+                yield json.dumps({"stream": "line {}\n".format(i)}).encode()
+            yield json.dumps({"error": "failed"}).encode()
+            raise AssertionError("stream consumed past error")
+        with self.assertRaises(dockergrader.build.BuildError) as cm:
+            dockergrader.build._parse_build_output(stream(), tail=10)
+        assert cm.exception.error == {"error": "failed"}
+        assert cm.exception.output[-1] == "line 99\n"
+        assert len(cm.exception.output) == 10
+
+    def test_context_stream(self):
+        mypath = Path(__file__).parent
+        paths = {'a': mypath / 'goodmake', 'b': mypath / 'gccfail'}
+        data = b''.join(dockergrader.build._context_stream(
+            "FROM alpine\n", paths, reproducible=True))
+        assert data == b''.join(dockergrader.build._context_stream(
+            "FROM alpine\n", paths, reproducible=True))
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            assert tar.getnames() == ['Dockerfile', 'a/Makefile',
+                                      'b/Makefile', 'b/foo.c']
+            assert tar.extractfile('Dockerfile').read() == b"FROM alpine\n"
+            with (mypath / 'gccfail' / 'foo.c').open('rb') as foo:
+                assert tar.extractfile('b/foo.c').read() == foo.read()
+
 
 if __name__ == "__main__":
     unittest.main()
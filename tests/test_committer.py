@@ -0,0 +1,43 @@
+import dockergrader.watch as watch
+from subprocess import CalledProcessError
+import threading
+
+
+def test_commit_per_working_copy(monkeypatch):
+    calls = []
+
+    def check_call(args, **kwargs):
+        # the svn lock is taken for each command only
+        assert watch.svn_lock.locked()
+        calls.append(args)
+    monkeypatch.setattr(watch, "check_call", check_call)
+    monkeypatch.setattr(watch, "COMMIT_WINDOW", 0.2)
+    committer = watch.Committer()
+    committer.start()
+    committer.submit("a/team1/out", "team1", "a")
+    committer.submit("b/team2/out", "team2", "b")
+    committer.submit("a/team3/out", "team3", "a")
+    committer.close()
+    commits = [c for c in calls if c[1] == "commit"]
+    assert [c[4:] for c in commits] == [["a/team1/out", "a/team3/out"],
+                                        ["b/team2/out"]]
+    assert not watch.svn_lock.locked()
+
+
+def test_update_during_retry(monkeypatch):
+    failing = threading.Event()
+
+    def check_call(args, **kwargs):
+        if args[1] == "commit" and not failing.is_set():
+            failing.set()
+            raise CalledProcessError(1, args)
+    monkeypatch.setattr(watch, "check_call", check_call)
+    monkeypatch.setattr(watch, "call", lambda args, **kwargs: 0)
+    committer = watch.Committer()
+    committer.start()
+    committer.submit("a/team1/out", "team1", "a")
+    assert failing.wait(10)
+    # svn update can run while the committer backs off
+    assert watch.svn_lock.acquire(timeout=0.5)
+    watch.svn_lock.release()
+    committer.close()
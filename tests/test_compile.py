@@ -43,6 +43,29 @@ class TestCompile(unittest.TestCase):
             ret = dockergrader.compile.compile(mypath + "/gccfail", realtmpdir, "testmp")
             assert ret is False
 
+    @patch('dockergrader.config.container_name', return_value=TEST_IMAGE)
+    def test_compile_pool(self, cont_func):
+        mypath = os.path.dirname(os.path.realpath(__file__))
+        pool = dockergrader.compile.CompilePool(TEST_IMAGE, size=1)
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                ret = dockergrader.compile.compile(mypath + "/goodmake", tmpdir,
+                                                   "testmp", pool=pool)
+                assert ret is True
+                assert (pathlib.Path(tmpdir) / 'compile' / 'testfile').exists()
+            # the container is reset and reused for the next submission
+            assert len(pool.idle) >= 1
+            # builds cannot leave anything behind outside /compile and /tmp
+            exit_code, _ = pool._exec(pool.idle[0][0], ["touch", "/usr/bin/cc"])
+            assert exit_code != 0
+            with tempfile.TemporaryDirectory() as tmpdir:
+                ret = dockergrader.compile.compile(mypath + "/gccfail", tmpdir,
+                                                   "testmp", pool=pool)
+                assert ret is False
+                assert not (pathlib.Path(tmpdir) / 'compile' / 'testfile').exists()
+        finally:
+            pool.close()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,149 @@
+from dockergrader.distributed import (Coordinator, Worker, pack_submission,
+                                      unpack_submission)
+from collections import deque
+import base64
+import io
+import os
+import tarfile
+import socket
+import threading
+import time
+import pytest
+
+TOKEN = "secret"
+
+
+class Jobs:
+    """ A minimal stand-in for the grading queue """
+
+    def __init__(self, n):
+        self.queue = deque(range(n))
+        self.output = {}
+        self.done = {}
+        self.requeued = []
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if not self.queue:
+                return None
+            job_id = self.queue.popleft()
+        return job_id, {"n": job_id}
+
+    def job_output(self, job_id, chunk):
+        self.output[job_id] = self.output.get(job_id, b'') + chunk
+
+    def job_done(self, job_id, returncode):
+        self.done[job_id] = returncode
+
+    def requeue(self, job_id):
+        with self.lock:
+            self.requeued.append(job_id)
+            self.output.pop(job_id, None)
+            self.queue.append(job_id)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+@pytest.fixture
+def jobs():
+    jobs = Jobs(10)
+    coordinator = Coordinator("127.0.0.1:0", jobs.take, jobs.job_output,
+                              jobs.job_done, jobs.requeue,
+                              token=TOKEN).start()
+    jobs.address = coordinator.address
+    yield jobs
+    coordinator.close()
+
+
+def run_job(job, output):
+    output("job {}\n".format(job["n"]).encode())
+    return job["n"] % 2
+
+
+def test_workers(jobs):
+    workers = [Worker(jobs.address, run_job, slots=2, poll_interval=0.05,
+                      token=TOKEN).start()
+               for _ in range(2)]
+    wait_for(lambda: len(jobs.done) == 10)
+    for w in workers:
+        w.stop()
+    assert jobs.done == {n: n % 2 for n in range(10)}
+    assert jobs.output[3] == b"job 3\n"
+    assert not jobs.requeued
+
+
+def test_worker_lost(jobs):
+    crashed = threading.Event()
+
+    def crash(job, output):
+        output(b"partial")
+        crashed.set()
+        raise SystemExit     # kills the slot thread and its connection
+
+    Worker(jobs.address, crash, poll_interval=0.05, token=TOKEN).start()
+    crashed.wait(10)
+    wait_for(lambda: jobs.requeued)
+
+    worker = Worker(jobs.address, run_job, poll_interval=0.05,
+                    token=TOKEN).start()
+    wait_for(lambda: len(jobs.done) == 10)
+    worker.stop()
+    assert jobs.output[jobs.requeued[0]].startswith(b"job ")
+
+
+def test_bad_token(jobs):
+    with socket.create_connection(jobs.address) as sock, \
+            sock.makefile('rwb') as f:
+        f.write(b'{"op": "pull"}\n')
+        f.flush()
+        assert f.readline() == b''
+    with socket.create_connection(jobs.address) as sock, \
+            sock.makefile('rwb') as f:
+        f.write(b'{"op": "auth", "token": "guess"}\n{"op": "pull"}\n')
+        f.flush()
+        assert f.readline() == b''
+    assert len(jobs.queue) == 10
+
+    worker = Worker(jobs.address, run_job, poll_interval=0.05,
+                    token="guess").start()
+    time.sleep(0.3)
+    worker.stop()
+    assert not jobs.done
+
+
+def test_pack_submission(tmpdir):
+    src = tmpdir.mkdir("src")
+    src.join("main.c").write("int main() {}\n")
+    src.mkdir(".svn").join("wc.db").write("")
+    dst = tmpdir.mkdir("dst")
+    unpack_submission(pack_submission(str(src)), str(dst))
+    assert dst.join("main.c").read() == "int main() {}\n"
+    assert not dst.join(".svn").check()
+
+
+def test_unpack_unsafe(tmpdir):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as tar:
+        link = tarfile.TarInfo("x")
+        link.type = tarfile.SYMTYPE
+        link.linkname = str(tmpdir)
+        tar.addfile(link)
+        for name in ["x/escaped", "../escaped", "ok"]:
+            data = b"data"
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o4777
+            tar.addfile(info, io.BytesIO(data))
+    dst = tmpdir.mkdir("dst")
+    unpack_submission(base64.b64encode(buf.getvalue()).decode(), str(dst))
+    # x/escaped lands in a real directory x
+    assert sorted(os.listdir(str(dst))) == ["ok", "x"]
+    assert not dst.join("x").islink()
+    assert not tmpdir.join("escaped").check()
+    assert dst.join("ok").stat().mode & 0o7777 == 0o755
@@ -0,0 +1,94 @@
+from dockergrader.watch import FairShareQueue, QueueEntry, Source
+import json
+
+
+def make_source(name, weight, teams):
+    source = Source(name, "svn", "*/mp/VERSION", None, weight=weight)
+    for i in range(teams):
+        source.queue.push(QueueEntry(attempts=0, time=i, version=1,
+            name='team{}'.format(i), tests=[], parent=None, source=source))
+    return source
+
+
+def test_weighted_share():
+    queue = FairShareQueue()
+    heavy = make_source('heavy', 1, 100)
+    light = make_source('light', 3, 100)
+    queue.add_source(heavy)
+    queue.add_source(light)
+
+    order = [queue.pop().source.name for _ in range(40)]
+    assert order.count('light') == 30
+    assert order.count('heavy') == 10
+    # within a source, the GradingQueue order is kept
+    assert [qe.name for qe in light.queue.sorted()][:2] == ['team30', 'team31']
+
+
+def test_sorted_matches_pop():
+    queue = FairShareQueue()
+    queue.add_source(make_source('a', 1, 5))
+    queue.add_source(make_source('b', 2, 5))
+    expected = [(qe.source.name, qe.name) for qe in queue.sorted()]
+    assert len(expected) == len(queue) == 10
+    assert [(qe.source.name, qe.name) for qe in
+            (queue.pop() for _ in range(10))] == expected
+    assert not queue
+
+
+def test_idle_source_does_not_bank_credit():
+    queue = FairShareQueue()
+    busy = make_source('busy', 1, 50)
+    idle = make_source('idle', 1, 0)
+    queue.add_source(busy)
+    queue.add_source(idle)
+    for _ in range(20):
+        assert queue.pop().source is busy
+
+    for i in range(10):
+        idle.queue.push(QueueEntry(attempts=0, time=i, version=1,
+            name='late{}'.format(i), tests=[], parent=None, source=idle))
+    order = [queue.pop().source.name for _ in range(10)]
+    # the two sources alternate, rather than 'idle' catching up on 20 jobs
+    assert order.count('idle') == 5
+
+
+def test_load_sources(tmpdir):
+    path = tmpdir.join("sources.json")
+    path.write(json.dumps([
+        {"name": "cs438-mp1", "svn_dir": "svn438", "mp": "mp1", "weight": 2},
+        {"name": "cs461-mp2", "svn_dir": "svn461",
+         "version_pattern": "*/mp2/VERSION", "script": "run_461.py"}]))
+    from dockergrader.watch import load_sources
+    mp1, mp2 = load_sources(str(path))
+    assert (mp1.version_pat, mp1.weight, mp1.attempts_file) == \
+        ("*/mp1/VERSION", 2, "attempts-cs438-mp1.jsonl")
+    assert (mp2.version_pat, mp2.weight, mp2.script) == \
+        ("*/mp2/VERSION", 1, "run_461.py")
+
+
+def test_load_sources_images(tmpdir, monkeypatch):
+    import dockergrader.watch as watch
+    monkeypatch.setattr(watch, "mp_images", lambda mp: [mp + "-test"])
+    path = tmpdir.join("sources.json")
+    path.write(json.dumps([
+        {"name": "a", "svn_dir": "svn", "mp": "mp1", "memoize": True},
+        {"name": "b", "svn_dir": "svn", "mp": "mp1", "memoize": True,
+         "images": ["custom"]},
+        {"name": "c", "svn_dir": "svn", "mp": "mp1"}]))
+    a, b, c = watch.load_sources(str(path))
+    # memoized grades depend on the MP's images unless others are given
+    assert list(a.images) == ["mp1-test"]
+    assert list(b.images) == ["custom"]
+    assert list(c.images) == []
+
+
+def test_cost_from_durations():
+    queue = FairShareQueue()
+    slow = make_source('slow', 1, 20)
+    fast = make_source('fast', 1, 20)
+    slow.record_durations({"results": {"t": {"passed": True, "seconds": 30}}})
+    fast.record_durations({"results": {"t": {"passed": True, "seconds": 10}}})
+    queue.add_source(slow)
+    queue.add_source(fast)
+    order = [queue.pop().source.name for _ in range(8)]
+    assert order.count('fast') == 6
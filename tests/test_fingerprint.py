@@ -0,0 +1,49 @@
+from dockergrader.fingerprint import FingerprintCache
+import os
+
+
+def make_submission(tmpdir):
+    sub = tmpdir.mkdir("mp1")
+    sub.join("server.c").write("int main() {}\n")
+    sub.join("Makefile").write("all:\n")
+    sub.join("VERSION").write("1\n")
+    sub.join("GRADING_OUTPUTv1.1").write("Test t1 Passed\n")
+    sub.mkdir("notes").join("README").write("notes\n")
+    return sub
+
+
+def test_fingerprint(tmpdir):
+    sub = make_submission(tmpdir)
+    cache = FingerprintCache()
+    fp = cache.fingerprint(str(sub))
+    assert list(cache.files(str(sub))) == ["Makefile", "server.c",
+                                           "notes/README"]
+
+    # versions and outputs don't count
+    sub.join("VERSION").write("2\n")
+    sub.join("GRADING_OUTPUTv1.2").write("Test t1 Failed\n")
+    assert cache.fingerprint(str(sub)) == fp
+    # nor do files outside the include list
+    include = ["*.c", "Makefile"]
+    fp_src = cache.fingerprint(str(sub), include)
+    sub.join("notes", "README").write("more notes\n")
+    assert cache.fingerprint(str(sub), include) == fp_src
+    assert cache.fingerprint(str(sub)) != fp
+
+    sub.join("server.c").write("int main() { return 1; }\n")
+    assert cache.fingerprint(str(sub), include) != fp_src
+    assert cache.fingerprint(str(sub), include, extra=["image x"]) != \
+        cache.fingerprint(str(sub), include)
+
+
+def test_digest_cache(tmpdir):
+    sub = make_submission(tmpdir)
+    cache = FingerprintCache()
+    path = str(sub.join("server.c"))
+    digest = cache.digest(path)
+    st = os.stat(path)
+    # same size and mtime: the cached digest is used without reading
+    cache.digests[path] = ((st.st_mtime_ns, st.st_size), "cached")
+    assert cache.digest(path) == "cached"
+    sub.join("server.c").write("changed\n")
+    assert cache.digest(path) not in ("cached", digest)
@@ -28,3 +28,55 @@ def test_queue_entry_sort():
 
     assert qe1 != None
     assert "asdf" != qe2
+
+
+def test_queue_peek():
+    queue = GradingQueue()
+    queue.push(QueueEntry(attempts=1, time=0, version=1, name='foo', tests=[],
+        parent=None))
+    queue.push(QueueEntry(attempts=0, time=0, version=1, name='bar', tests=[],
+        parent=None))
+    # a newer version replaces the queued one
+    queue.push(QueueEntry(attempts=1, time=1, version=2, name='bar', tests=[],
+        parent=None))
+    assert queue.peek().name == 'foo'
+    assert queue.pop().name == 'foo'
+    assert queue.peek().version == 2
+    assert len(queue) == 1
+
+
+def test_queue_update_remove():
+    import random
+    queue = GradingQueue()
+    entries = {}
+    for i in range(100):
+        name = 'team{}'.format(random.randrange(20))
+        qe = QueueEntry(attempts=random.randrange(5), time=i,
+            version=random.randrange(3), name=name,
+            tests=random.choice([[], ['a'], ['a', 'b']]), parent=None)
+        old = entries.get(name)
+        queue.push(qe)
+        if old is None or old.version != qe.version:
+            entries[name] = qe
+        elif old.tests != qe.tests:
+            assert qe.time == old.time
+            entries[name] = qe
+        if i % 10 == 9:
+            name = random.choice(list(entries))
+            assert queue.remove(name) is entries.pop(name)
+        assert len(queue) == len(entries)
+        assert list(queue.sorted()) == sorted(entries.values())
+
+    popped = [queue.pop() for _ in range(len(queue))]
+    assert popped == sorted(entries.values())
+    assert not queue
+
+
+def test_queue_same_version():
+    queue = GradingQueue()
+    queue.push(QueueEntry(attempts=0, time=0, version=1, name='foo',
+        tests=['a'], parent=None))
+    queue.push(QueueEntry(attempts=0, time=5, version=1, name='foo',
+        tests=['a'], parent=None))
+    assert queue.peek().time == 0
+    assert 'foo' in queue and 'bar' not in queue
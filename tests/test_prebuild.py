@@ -0,0 +1,59 @@
+from benchmarks.fake_docker import FakeClient, install
+from dockergrader.prebuild import PrebuildEntry, build_order, prebuild
+import sys
+import pytest
+
+
+def entry(tag, base):
+    return PrebuildEntry('mp', tag, "FROM {}\nRUN true\n".format(base), {}, tag)
+
+
+def test_build_order():
+    base = entry('base', 'ubuntu')
+    compile = entry('compile', 'base')
+    test = entry('test', 'compile')
+    other = entry('other', 'alpine')
+    stages = build_order([test, other, compile, base])
+    assert stages == [[other, base], [compile], [test]]
+
+
+def test_build_order_cycle():
+    with pytest.raises(ValueError):
+        build_order([entry('a', 'b'), entry('b', 'a')])
+
+
+@pytest.fixture
+def docker():
+    saved = getattr(sys.modules.get("dockergrader.config"), "docker", None)
+    client = install(FakeClient(dict.fromkeys(FakeClient().latencies, 0)))
+    yield client
+    if saved is not None:
+        sys.modules["dockergrader.config"].docker = saved
+
+
+def test_rebuilt_base(docker, tmpdir):
+    from dockergrader.build import BuildCache
+    context = tmpdir.mkdir("base")
+    context.join("setup.sh").write("v1\n")
+    base = PrebuildEntry('mp', 'base', "FROM ubuntu\n", str(context), 'base')
+    child = entry('child', 'base')
+    cache = BuildCache()
+    assert not any(r.cached for r in prebuild([base, child], cache=cache))
+    assert all(r.cached for r in prebuild([base, child], cache=cache))
+
+    # a new base image must not leave the child on the old one
+    context.join("setup.sh").write("v2\n")
+    results = {r.entry.tag: r for r in prebuild([base, child], cache=cache)}
+    assert not results["base"].cached
+    assert not results["child"].cached
+
+
+def test_api_error(docker):
+    from docker.errors import APIError
+
+    def build(**kwargs):
+        raise APIError("daemon error", None)
+    docker.build = build
+    results = prebuild([entry('a', 'ubuntu'), entry('b', 'a')])
+    assert [str(r.error) for r in results][1] == "base image failed"
+    assert isinstance(results[0].error, APIError)
@@ -0,0 +1,64 @@
+from dockergrader.results import TestResults as Results, \
+    TestPlan as Plan, parse_output
+import io
+
+OUTPUT = b"""Running ['svn/team1/mp1']
+Test echo Passed
+Test large_file Failed
+some log output
+Test chat.v2 Failed
+Test chat.v3 Skipped (chat.v2 did not pass)
+"""
+
+
+def test_streamed_results():
+    results = Results()
+    # split the output at awkward places
+    for i in range(0, len(OUTPUT), 7):
+        results.feed(OUTPUT[i:i + 7])
+    assert list(results.close()) == ["echo", "large_file", "chat.v2",
+                                     "chat.v3"]
+    assert results.results["echo"]["passed"]
+    assert results.results["echo"]["seconds"] >= 0
+    assert results.results["chat.v3"]["skipped"]
+    assert results.failed() == ["large_file", "chat.v2", "chat.v3"]
+
+
+def test_unterminated_last_line():
+    results = Results()
+    results.feed(b"Test echo Failed")
+    assert results.close() == {"echo": {"passed": False,
+                                        "seconds": results.results["echo"]["seconds"]}}
+
+
+def test_parse_output():
+    assert parse_output(io.BytesIO(OUTPUT)) == ["large_file", "chat.v2",
+                                                "chat.v3"]
+
+
+def run_plan(fail_fast):
+    plan = Plan(fail_fast=fail_fast)
+    ran = []
+
+    def test(name, ok):
+        ran.append(name)
+        return ok
+    plan.run("compile", test, "compile", False)
+    plan.run("echo", test, "echo", True, requires=["compile"])
+    plan.run("chat", test, "chat", True, requires=["echo"])
+    return ran
+
+
+def test_plan(capsys):
+    assert run_plan(False) == ["compile", "echo", "chat"]
+    assert capsys.readouterr().out == \
+        "Test compile Failed\nTest echo Passed\nTest chat Passed\n"
+
+    assert run_plan(True) == ["compile"]
+    out = capsys.readouterr().out
+    assert out == "Test compile Failed\n" \
+        "Test echo Skipped (compile did not pass)\n" \
+        "Test chat Skipped (echo did not pass)\n"
+    results = Results()
+    results.feed(out.encode())
+    assert results.failed() == ["compile", "echo", "chat"]
@@ -2,6 +2,10 @@ import unittest
 import dockergrader.run_tests
 import dockergrader.config
 import logging
+import os
+import socket
+import tempfile
+import time
 
 
 class TestRunTests(unittest.TestCase):
@@ -10,7 +14,7 @@ class TestRunTests(unittest.TestCase):
 
         for internal in [True,False]:
             # Check network creation
-            run_test.create_network(internal=internal)
+            run_test.create_network(internal=internal, pool=None)
             networks = {n["Name"]:n for n in
                 dockergrader.config.docker.networks()}
             assert run_test.network_name in networks
@@ -54,3 +58,135 @@ class TestRunTests(unittest.TestCase):
         assert run_test.logs("bar").startswith(b"bar")
 
         run_test.cleanup()
+
+    def test_ready_probe(self):
+        run_test = dockergrader.run_tests.RunTest("ready_testcase")
+
+        run_test.add_command(image="ubuntu", command='bash -c "echo ready; sleep 2"',
+                             name="server",
+                             ready=dockergrader.run_tests.LogProbe("ready"))
+        run_test.add_command(image="ubuntu", command="true", name="client")
+
+        start = time.time()
+        run_test.run_commands(delay=30)
+        # the client starts as soon as the server is ready, not after `delay`
+        assert time.time() - start < 30
+
+        assert run_test.containers["server"]["StatusCode"] == 0
+        assert run_test.containers["client"]["StatusCode"] == 0
+
+        run_test.cleanup()
+
+    def test_bounded_buffer(self):
+        buf = dockergrader.run_tests.BoundedBuffer(10)
+        for i in range(10):
+            buf.write(b"abcdef")
+        assert buf.truncated == 50
+        assert buf.getvalue() == b"abcde\n[... 50 bytes omitted ...]\nbcdef"
+
+    def test_log_lines(self):
+        capture = dockergrader.run_tests.LogCapture(
+            "unused", limit=8, patterns=[b"fail"])
+        partial = bytearray()
+        for chunk in [b"ok\nfa", b"il", b"ed\nx" + b"y" * 20, b"fail"]:
+            capture._lines(chunk, partial)
+        assert capture.matches == [(b"fail", b"failed")]
+        # long unfinished lines keep only their end
+        assert partial == b"yyyyfail"
+
+    def test_log_capture(self):
+        run_test = dockergrader.run_tests.RunTest(
+            "capture_testcase", log_limit=1000,
+            log_patterns=[r"Test \w+ Failed"])
+
+        run_test.add_command(image="ubuntu", name="spam",
+                             command='bash -c "echo Test foo Failed; yes | head -c 100000; echo err >&2"')
+
+        run_test.run_commands()
+
+        logs = run_test.logs("spam")
+        assert len(logs) < 1100
+        assert logs.startswith(b"Test foo Failed")
+        assert run_test.logs("spam", stdout=False) == b"err\n"
+        assert [m[1] for m in run_test.matches] == [b"Test \\w+ Failed"]
+
+        run_test.cleanup()
+
+    def test_fail_fast(self):
+        run_test = dockergrader.run_tests.RunTest("failfast_testcase",
+                                                  fail_fast=True)
+        run_test.add_command(image="ubuntu", name="server",
+                             command="sleep 60")
+        run_test.add_command(image="ubuntu", name="client", command="false")
+        run_test.add_command(image="ubuntu", name="late", command="true")
+
+        start = time.time()
+        assert not run_test.run_commands(timeout=60, delay=1)
+        assert time.time() - start < 30
+        assert run_test.stopped == "container client exited with status 1"
+        assert "late" not in run_test.started
+        run_test.cleanup()
+
+        run_test = dockergrader.run_tests.RunTest(
+            "failfast_pattern_testcase", fail_fast=True,
+            fail_patterns=["Segmentation fault"])
+        run_test.add_command(image="ubuntu", name="crash",
+                             command='bash -c "echo Segmentation fault; sleep 60"')
+        start = time.time()
+        assert not run_test.run_commands(timeout=60)
+        assert time.time() - start < 30
+        assert run_test.stopped.startswith("container crash printed")
+        run_test.cleanup()
+
+    def test_network_pool(self):
+        pool = dockergrader.run_tests.NetworkPool(size=2,
+                                                  lock_dir=tempfile.mkdtemp())
+        first = pool.lease(internal=True)
+        second = pool.lease(internal=True)
+        assert first.name != second.name
+        assert pool.lease(internal=True) is None
+        assert pool.in_use(first.name)
+
+        pool.release(first)
+        assert not pool.in_use(first.name)
+        again = pool.lease(internal=True)
+        assert (again.name, again.id) == (first.name, first.id)
+        pool.release(again)
+        pool.release(second)
+
+        run_test = dockergrader.run_tests.RunTest("pooled_testcase")
+        run_test.create_network(internal=True, pool=pool)
+        assert run_test.network_name == first.name
+        run_test.add_command(image="ubuntu", name="server",
+                             command="sleep 2")
+        run_test.add_command(image="ubuntu", name="client",
+                             command="getent hosts server")
+        run_test.run_commands(delay=0)
+        assert run_test.containers["client"]["StatusCode"] == 0
+        run_test.cleanup()
+        assert not pool.in_use(first.name)
+
+    def test_reap_orphans(self):
+        docker = dockergrader.config.docker
+        run_tests = dockergrader.run_tests
+        dead = {run_tests.OWNER_LABEL: "{}:{}".format(socket.gethostname(),
+                                                      2**22 + 1)}
+        # our own pid, but a different process start time
+        reused = {run_tests.OWNER_LABEL: "{}:{}:1".format(
+            socket.gethostname(), os.getpid())}
+        container = docker.create_container(image="ubuntu", command="true",
+                                            labels=dead)
+        network = docker.create_network(run_tests.NETWORK_PREFIX + "orphan",
+                                        labels=reused)
+        live = docker.create_network(run_tests.NETWORK_PREFIX + "live",
+                                     labels={run_tests.OWNER_LABEL:
+                                             run_tests.OWNER})
+        unlabeled = docker.create_network(run_tests.NETWORK_PREFIX + "new")
+        run_tests.reap_orphans()
+        ids = {c["Id"] for c in docker.containers(all=True)}
+        assert container["Id"] not in ids
+        networks = {n["Id"] for n in docker.networks()}
+        assert network["Id"] not in networks
+        assert live["Id"] in networks and unlabeled["Id"] in networks
+        docker.remove_network(live["Id"])
+        docker.remove_network(unlabeled["Id"])
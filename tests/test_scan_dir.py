@@ -0,0 +1,160 @@
+from pathlib import Path
+import dockergrader.watch as watch
+import pytest
+
+SVN_OUTPUT = b"""Updating 'svn':
+A    svn/team1/mp1/VERSION
+U    svn/team2/mp1/VERSION
+ U   svn/team2/mp1
+C    svn/team3/mp1/foo.c
+Updated to revision 42.
+"""
+
+
+def test_parse_svn_update():
+    assert watch.parse_svn_update(SVN_OUTPUT) == {
+        Path("svn/team1/mp1/VERSION"), Path("svn/team2/mp1/VERSION"),
+        Path("svn/team2/mp1"), Path("svn/team3/mp1/foo.c")}
+
+
+@pytest.fixture
+def source(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    monkeypatch.setattr(watch, "dump_queue", lambda: None)
+    svn = Path(str(tmpdir)) / "svn"
+    for team in ["team1", "team2"]:
+        (svn / team / "mp1").mkdir(parents=True)
+        (svn / team / "mp1" / "VERSION").write_text("1\n")
+    source = watch.Source("mp1", svn, "*/mp1/VERSION", "attempts.jsonl")
+    source.open()
+    return source
+
+
+def test_scan_dir(source):
+    watch.scan_dir(source)
+    assert sorted(qe.name for qe in source.queue.sorted()) == ["team1", "team2"]
+
+    source.queue.pop()
+    source.queue.pop()
+    # nothing changed, nothing queued
+    watch.scan_dir(source)
+    assert not source.queue
+
+    version = source.svn_dir / "team2" / "mp1" / "VERSION"
+    version.write_text("2 test_a test_b\n")
+    watch.scan_dir(source, changed={version})
+    qe = source.queue.pop()
+    assert (qe.name, qe.version, qe.tests) == ("team2", 2, ["test_a", "test_b"])
+    assert qe.source is source
+
+
+def test_scan_dir_graded(source):
+    source.attempts.add("team1", 1)
+    source.attempts.add("team2", 1)
+    source.attempts.add("team2", 2)
+    (source.svn_dir / "team2" / "mp1" / "VERSION").write_text("3\n")
+    watch.scan_dir(source)
+    qe = source.queue.pop()
+    assert (qe.name, qe.version, qe.attempts) == ("team2", 3, 2)
+    assert not source.queue
+
+
+def test_scan_dir_changed_only(source):
+    version = source.svn_dir / "team1" / "mp1" / "VERSION"
+    watch.scan_dir(source,
+                   changed={version, source.svn_dir / "team1" / "mp1" / "foo.c"})
+    assert [qe.name for qe in source.queue.sorted()] == ["team1"]
+
+
+def test_scan_dir_retests_failures(source):
+    source.attempts.add("team1", 1, result={
+        "returncode": 0, "tests": [],
+        "results": {"t1": {"passed": True, "seconds": 2},
+                    "t2": {"passed": False, "seconds": 5}}})
+    source.attempts.add("team2", 1)
+    # attempts recorded without results fall back to the output file
+    (source.svn_dir / "team2" / "mp1" / "GRADING_OUTPUTv1.1").write_text(
+        "Test t1 Failed\nTest t2 Passed\n")
+    for team in ["team1", "team2"]:
+        (source.svn_dir / team / "mp1" / "VERSION").write_text("2\n")
+    watch.scan_dir(source)
+    assert sorted((qe.name, qe.tests) for qe in source.queue.sorted()) == [
+        ("team1", ["t2"]), ("team2", ["t1"])]
+
+
+def test_estimate(source):
+    assert source.estimate([]) == watch.DEFAULT_JOB_SECONDS
+    source.record_durations({"results": {"t1": {"passed": True, "seconds": 2},
+                                         "t2": {"passed": False, "seconds": 6}}})
+    assert source.estimate([]) == 8
+    assert source.estimate(["t2"]) == 6
+    assert source.estimate(["t3"]) == 4     # unknown tests cost the average
+
+
+def test_reuse_result(source, monkeypatch):
+    monkeypatch.setattr(watch, "COMMITTER", None)
+    source.memoize = True
+    source.script = __file__
+    parent = source.svn_dir / "team1" / "mp1"
+    (parent / "server.c").write_text("int main() {}\n")
+    fingerprint = source.fingerprint(parent)
+    results = {"t1": {"passed": True, "seconds": 1},
+               "t2": {"passed": False, "seconds": 1}}
+    source.attempts.add("team1", 1, result={
+        "returncode": 0, "tests": [], "results": results,
+        "fingerprint": fingerprint})
+    (parent / "GRADING_OUTPUTv1.1").write_text("Test t1 Passed\nTest t2 Failed\n")
+
+    (parent / "VERSION").write_text("2\n")
+    watch.scan_dir(source)
+    qe = source.queue.pop()
+    assert qe.tests == ["t2"]
+    assert watch.memo_fingerprint(qe) == fingerprint
+    assert watch.reuse_result(qe, fingerprint)
+    assert (parent / "GRADING_OUTPUTv1.2").read_text().endswith(
+        "Test t1 Passed\nTest t2 Failed\n")
+    result = source.attempts.get("team1", 2).result
+    assert result["reused"] == 1
+    assert result["results"] == {"t2": results["t2"]}
+
+    # a crashed grade of the same content is not reused
+    source.attempts.add("team1", 3, result={
+        "returncode": -1, "tests": [], "results": {},
+        "fingerprint": fingerprint})
+    assert watch.previous_grade(source, "team1", fingerprint, []).version == 1
+
+    # a changed submission is graded again
+    (parent / "server.c").write_text("int main() { return 1; }\n")
+    assert not watch.reuse_result(qe, source.fingerprint(parent))
+
+
+def test_retry_unrecorded(source):
+    watch.scan_dir(source)
+    qe = source.queue.pop()
+    source.queue.pop()
+    watch.scan_dir(source)
+    assert not source.queue
+
+    # the grade crashed before recording a result
+    watch.retry_if_unrecorded(qe)
+    watch.scan_dir(source, set())
+    assert [e.name for e in source.queue.sorted()] == [qe.name]
+
+    # a recorded grade is not retried
+    qe = source.queue.pop()
+    source.attempts.add(qe.name, qe.version, result={"returncode": 0})
+    watch.retry_if_unrecorded(qe)
+    watch.scan_dir(source, set())
+    assert not source.queue
+
+
+def test_drop_finished(source, monkeypatch):
+    queue = watch.FairShareQueue()
+    queue.add_source(source)
+    monkeypatch.setattr(watch, "QUEUE", queue)
+    monkeypatch.setattr(watch, "GRADERS", [])
+    watch.scan_dir(source)
+    # used when stopping: nothing new may start
+    watch.drop_finished()
+    assert watch.GRADERS == []
+    assert len(list(source.queue.sorted())) == 2
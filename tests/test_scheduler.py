@@ -0,0 +1,93 @@
+from dockergrader.scheduler import ResourceScheduler, Budget, parse_mem, \
+    load_budgets
+import dockergrader.scheduler
+import json
+
+GB = 2**30
+
+
+def make_scheduler(load=0.0, available=64 * GB, **kwargs):
+    state = {"load": load, "available": available}
+    sched = ResourceScheduler(cpus=8, mem=16 * GB,
+                              load=lambda: state["load"],
+                              available_memory=lambda: state["available"],
+                              **kwargs)
+    return sched, state
+
+
+def test_parse_mem():
+    assert parse_mem('1G') == GB
+    assert parse_mem('512m') == 512 * 2**20
+    assert parse_mem(100) == 100
+
+
+def test_load_budgets(tmpdir):
+    path = tmpdir.join("budgets.json")
+    path.write(json.dumps({"chat": {"mem": "512m", "containers": 4},
+                           "compile": {"cpus": 2}}))
+    budgets = load_budgets(str(path))
+    assert budgets["chat"] == Budget(1, 2 * GB)
+    assert budgets["compile"] == Budget(2, GB)
+
+
+def test_small_host_default_jobs():
+    sched = ResourceScheduler(cpus=2, mem=16 * GB, load=lambda: 0.0,
+                              available_memory=lambda: 16 * GB)
+    for i in range(6):
+        assert sched.admit(i, [])
+    assert not sched.admit(6, [])
+    assert "concurrency" in sched.decisions[-1].reason
+
+
+def test_large_host_grows(monkeypatch):
+    monkeypatch.setattr(dockergrader.scheduler, "ADJUST_INTERVAL", 0)
+    sched = ResourceScheduler(cpus=64, mem=256 * GB, load=lambda: 1.0,
+                              available_memory=lambda: 256 * GB)
+    assert sched.max_jobs == 64
+    assert sched.limit == 6
+    for i in range(6):
+        assert sched.admit(i, [])
+    sched.adjust()
+    assert sched.limit == 7
+    assert sched.admit(6, [])
+
+
+def test_admission_budgets():
+    sched, _ = make_scheduler(budgets={'big': Budget(2, 5 * GB)})
+    assert sched.admit('a', ['big'])
+    assert sched.admit('b', ['big'])
+    # a third 5G job would go over 80% of 16G
+    assert not sched.admit('c', ['big'])
+    assert "memory" in sched.decisions[-1].reason
+    assert sched.admit('d', ['small'])
+    sched.release('a')
+    assert sched.admit('c', ['big'])
+
+
+def test_idle_host_always_admits():
+    sched, _ = make_scheduler(budgets={'huge': Budget(32, 64 * GB)})
+    assert sched.admit('a', ['huge'])
+    assert not sched.admit('b', [])
+
+
+def test_adaptive_limit(monkeypatch):
+    monkeypatch.setattr(dockergrader.scheduler, "ADJUST_INTERVAL", 0)
+    sched, state = make_scheduler(max_jobs=8, start_jobs=8)
+    for i in range(8):
+        assert sched.admit(i, ['t'])
+    assert not sched.admit(8, ['t'])
+
+    # overloaded: the limit drops below the number of running jobs
+    state["load"] = 20.0
+    sched.adjust()
+    assert sched.limit == 7
+    for i in range(8):
+        sched.release(i)
+    sched.adjust()
+    assert sched.limit == 1
+
+    # recovers once there is spare capacity
+    state["load"] = 1.0
+    assert sched.admit('x', ['t'])
+    sched.adjust()
+    assert sched.limit == 2
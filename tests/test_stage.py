@@ -0,0 +1,66 @@
+from dockergrader.stage import stage, unstage
+import os
+import pathlib
+import subprocess
+import tempfile
+import pytest
+
+mypath = pathlib.Path(__file__).parent
+
+
+def make_submission(root):
+    (root / "src").mkdir()
+    (root / "src" / "main.c").write_text("int main() {}\n")
+    (root / ".svn").mkdir()
+    (root / ".svn" / "wc.db").write_text("metadata")
+    (root / "Makefile").write_text("all:\n")
+    (root / "link.c").symlink_to("src/main.c")
+
+
+@pytest.mark.parametrize("mode", ["copy", "reflink"])
+def test_stage(mode):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = pathlib.Path(tmpdir) / "src"
+        src.mkdir()
+        make_submission(src)
+        dst = pathlib.Path(tmpdir) / "dst"
+        stage(str(src), str(dst), mode=mode, ignore=(".svn",))
+        assert (dst / "src" / "main.c").read_text() == "int main() {}\n"
+        assert (dst / "Makefile").exists()
+        assert not (dst / ".svn").exists()
+        # neither new files nor changes show up in the source
+        (dst / "main.o").write_text("")
+        assert not (src / "main.o").exists()
+        with (dst / "Makefile").open("a") as f:
+            f.write("\techo changed\n")
+        assert (src / "Makefile").read_text() == "all:\n"
+        # like shutil.copytree, symlinks are copied as what they point to
+        assert not (dst / "link.c").is_symlink()
+        assert (dst / "link.c").read_text() == "int main() {}\n"
+
+
+def test_stage_bad_mode():
+    with pytest.raises(ValueError):
+        stage(str(mypath / "goodmake"), "/nonexistent", mode="bogus")
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="overlay staging needs root")
+def test_stage_overlay(tmpdir):
+    src = pathlib.Path(str(tmpdir)) / "src"
+    src.mkdir()
+    make_submission(src)
+    dst = pathlib.Path(str(tmpdir)) / "dst"
+    try:
+        stage(str(src), str(dst), mode="overlay", ignore=(".svn",))
+    except subprocess.CalledProcessError:
+        pytest.skip("cannot mount overlayfs here")
+    try:
+        assert (dst / "Makefile").read_text() == "all:\n"
+        assert not (dst / ".svn").exists()
+        with (dst / "Makefile").open("a") as f:
+            f.write("\techo changed\n")
+        assert (src / "Makefile").read_text() == "all:\n"
+    finally:
+        unstage(str(dst))
+    assert sorted(p.name for p in pathlib.Path(str(tmpdir)).iterdir()) == \
+        ["src"]
@@ -0,0 +1,84 @@
+from dockergrader.status import QueueStatus, Row
+from datetime import datetime
+from urllib.request import urlopen
+import json
+import os
+import pytest
+
+NOW = datetime(2016, 10, 1, 12, 30)
+
+
+@pytest.fixture
+def rows():
+    return ([], [])     # running, waiting
+
+
+@pytest.fixture
+def status(tmpdir, rows):
+    return QueueStatus(lambda: rows, str(tmpdir.join("queue.html")),
+                       str(tmpdir.join("queue.json")), min_interval=0)
+
+
+def test_flush_only_on_change(status, rows):
+    running, waiting = rows
+    assert status.flush()
+    assert status.writes == 1
+    assert not status.flush()           # not marked changed
+
+    status.changed()
+    assert not status.flush()           # marked, but the rows are the same
+    assert status.writes == 1
+
+    waiting.append(Row("team1", None, 2, ["t1"], NOW, 3, None))
+    status.changed()
+    assert status.flush()
+    with open(status.json_path) as f:
+        data = json.load(f)
+    assert data["running"] == []
+    assert data["waiting"][0]["team"] == "team1"
+    assert data["waiting"][0]["tests"] == ["t1"]
+    with open(status.html_path) as f:
+        assert "team1" in f.read()
+    assert not [f for f in os.listdir(os.path.dirname(status.html_path))
+                if f.startswith('.')]
+
+
+def test_rate_limit(status, rows):
+    status.min_interval = 60
+    assert status.flush()
+    rows[1].append(Row("team1", None, 2, [], NOW, 0, None))
+    status.changed()
+    assert 0 < status.delay() <= 60
+    assert not status.flush()
+    assert status.flush(force=True)
+    assert status.delay() is None
+
+
+def test_heartbeat(status):
+    assert status.flush()
+    updated = status.updated
+    assert not status.flush()
+    status.last_write -= status.heartbeat     # a minute without changes
+    assert status.flush()
+    assert status.writes == 2
+    assert status.updated > updated
+
+
+def test_html_escape(status, rows):
+    rows[0].append(Row("<b>", "mp1", 1, [], NOW, 0, NOW))
+    status.flush()
+    assert b"&lt;b&gt; <small>(mp1)</small>" in status.html
+
+
+def test_serve(status):
+    status.flush()
+    server = status.serve("127.0.0.1:0")
+    try:
+        port = server.server_address[1]
+        with urlopen("http://127.0.0.1:{}/queue.json".format(port)) as r:
+            assert json.loads(r.read().decode())["waiting"] == []
+        with urlopen("http://127.0.0.1:{}/".format(port)) as r:
+            assert b"Autograder Queue" in r.read()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,66 @@
+from dockergrader.trace import Tracer, load, percentile, summarize
+import json
+import threading
+
+
+def test_disabled():
+    tracer = Tracer()
+    with tracer.span("phase") as span:
+        span.set(x=1)
+    tracer.record("phase", 0, 1)
+    assert not tracer.durations
+
+
+def test_spans(tmpdir):
+    path = str(tmpdir.join("trace.jsonl"))
+    tracer = Tracer(path, trace_id="default")
+    with tracer.trace("mp1/team1/3"):
+        with tracer.span("grade", team="team1") as outer:
+            with tracer.span("compile") as inner:
+                inner.set(ok=True)
+            tracer.record("queue.wait", 100, 104.5)
+    try:
+        with tracer.span("commit"):
+            raise OSError
+    except OSError:
+        pass
+    tracer.close()
+
+    with open(path) as f:
+        records = {r["name"]: r for r in map(json.loads, f)}
+    assert records["compile"]["trace"] == "mp1/team1/3"
+    assert records["compile"]["parent"] == outer.id
+    assert records["compile"]["ok"] is True
+    assert records["grade"]["parent"] is None
+    assert records["grade"]["team"] == "team1"
+    assert records["queue.wait"]["duration"] == 4.5
+    assert records["commit"]["trace"] == "default"
+    assert records["commit"]["error"] == "OSError"
+    assert set(load(path)) == set(records)
+
+
+def test_threads_have_own_stack():
+    tracer = Tracer()
+    tracer.enable()
+    with tracer.trace("a"), tracer.span("outer"):
+        result = {}
+
+        def other():
+            with tracer.span("inner") as span:
+                result["span"] = span
+        t = threading.Thread(target=other)
+        t.start()
+        t.join()
+    assert result["span"].parent is None
+    assert result["span"].trace is None
+
+
+def test_summary():
+    assert percentile(list(range(1, 101)), 50) == 50
+    assert percentile(list(range(1, 101)), 99) == 99
+    assert percentile([7], 90) == 7
+    summary = summarize({"wait": [3, 1, 2]})
+    assert summary["wait"]["count"] == 3
+    assert summary["wait"]["total"] == 6
+    assert summary["wait"]["p50"] == 2
+    assert summary["wait"]["max"] == 3
@@ -0,0 +1,85 @@
+from dockergrader.workers import WorkerPool
+import dockergrader.workers
+import sys
+import pytest
+
+SCRIPT = """
+import os, sys, subprocess, time
+import grading_helper      # next to the script
+print("pid", os.getpid())
+sys.stdout.flush()
+if sys.argv[1] == "stream":
+    for _ in range(100):
+        print("output", flush=True)
+        time.sleep(0.05)
+subprocess.check_call(["echo", "args"] + sys.argv[1:])
+if sys.argv[1] == "crash":
+    os._exit(7)
+sys.exit(len(sys.argv) - 2)
+"""
+
+
+def make_pool(tmpdir, size):
+    script = tmpdir.join("run_tests.py")
+    script.write(SCRIPT)
+    tmpdir.join("grading_helper.py").write("")
+    return WorkerPool(size, script=str(script))
+
+
+@pytest.fixture
+def pool(tmpdir):
+    pool = make_pool(tmpdir, 1)
+    yield pool
+    pool.close()
+
+
+def test_worker_pool(pool):
+    job = pool.submit("parent", ["test1", "test2"])
+    out = job.output()
+    assert job.returncode == 2
+    pid, args = out.decode().splitlines()
+    assert args == "args parent test1 test2"
+
+    # the same worker process runs the next job
+    job = pool.submit("parent", [])
+    assert job.output().decode().splitlines()[0] == pid
+    assert job.returncode == 0
+
+
+def test_worker_crash(pool):
+    job = pool.submit("crash", [])
+    assert b"died" in job.output()
+    assert job.returncode == -1
+
+    job = pool.submit("parent", ["test1"])
+    assert job.output().endswith(b"args parent test1\n")
+    assert job.returncode == 1
+
+
+def test_worker_crash_while_busy(tmpdir):
+    pool = make_pool(tmpdir, 2)
+    try:
+        busy = pool.submit("stream", [])
+        crashed = pool.submit("crash", [])
+        assert b"died" in crashed.output()
+        # noticed while the other worker was still streaming output
+        assert busy.returncode is None
+        assert busy.wait(30) == 0
+    finally:
+        pool.close()
+
+
+def test_worker_startup_failure(tmpdir, monkeypatch):
+    monkeypatch.setattr(dockergrader.workers, "RESPAWN_DELAY", 0)
+    # forked workers cannot import the harness, like without a docker daemon
+    monkeypatch.setitem(sys.modules, "dockergrader.config", None)
+    script = tmpdir.join("run_tests.py")
+    script.write(SCRIPT)
+    pool = WorkerPool(1, script=str(script), context="fork")
+    try:
+        job = pool.submit("parent", [])
+        assert job.wait(30) == -1
+        assert job.output().startswith(b"No grading worker could start")
+        assert pool.startup_failures >= dockergrader.workers.MAX_STARTUP_FAILURES
+    finally:
+        pool.close()